@@ -9,9 +9,15 @@
 #-----------------------------------------------------------------------------
 
 from string import strip
-from os import remove, access, F_OK, environ, path
+from os import remove, access, F_OK, environ, path, mkdir, close
+from os.path import abspath, join
 from random import choice
 from copy import copy
+from glob import glob
+from heapq import heapify, heapreplace
+from multiprocessing import Pool
+from shutil import rmtree
+from tempfile import mkdtemp, mkstemp, gettempdir
 
 from burrito.parameters import FlagParameter, ValuedParameter, MixedParameter
 from burrito.util import (CommandLineApplication, ResultPath,
@@ -24,6 +30,9 @@ from cogent.parse.blast import (LastProteinIds9, QMEBlast9, QMEPsiBlast9,
                                 BlastResult)
 from cogent.util.misc import app_path
 
+from bfillings.fasta_index import FastaIndex
+from bfillings.formatdb import build_blast_db_from_fasta_path
+
 
 class Blast(CommandLineApplication):
     """BLAST generic application controller"""
@@ -670,6 +679,157 @@ def blast_seqs(seqs,
     return blast_app(seqs)
 
 
+def split_records_by_residues(rec_lengths, num_shards):
+    """Assigns records to num_shards shards with balanced residue counts.
+
+    rec_lengths: list of the number of residues in each record.
+
+    Records are handed out longest first, each to the shard with the fewest
+    residues so far. Returns a list with the shard index of each record.
+    """
+    num_shards = max(1, min(num_shards, len(rec_lengths)))
+    shards = [(0, i) for i in range(num_shards)]
+    heapify(shards)
+    owners = [0] * len(rec_lengths)
+    by_length = sorted(range(len(rec_lengths)),
+                       key=lambda i: rec_lengths[i], reverse=True)
+    for rec_index in by_length:
+        residues, shard = shards[0]
+        owners[rec_index] = shard
+        heapreplace(shards, (residues + rec_lengths[rec_index], shard))
+    return owners
+
+def blast9_blocks(lines):
+    """Yields the -m 9 output of each query as a list of lines.
+
+    Each query's output starts with a '# BLAST' program line.
+    """
+    block = []
+    for line in lines:
+        if line.startswith('# BLAST') and block:
+            yield block
+            block = []
+        block.append(line)
+    if block:
+        yield block
+
+def _absolute_db_path(blast_db):
+    """Returns blast_db as an absolute path if it names local database files
+
+    Applications run in another working directory can then still find the
+    database. Names that are only found through BLASTDB (e.g. 'nr') are
+    returned unchanged.
+    """
+    if blast_db and not path.isabs(blast_db) and \
+            (glob(blast_db + '.*') or path.exists(blast_db)):
+        return abspath(blast_db)
+    return blast_db
+
+def _blast_shard(args):
+    """Runs one shard of blast_seqs_sharded; returns its output filepath.
+
+    Module-level so that it can be sent to a multiprocessing pool.
+    """
+    blast_constructor, shard_dir, params, blast_mat_root = args
+    params = dict(params)
+    params['-o'] = join(shard_dir, 'blast_out.txt')
+    blast_app = blast_constructor(
+                   params=params,
+                   blast_mat_root=blast_mat_root,
+                   InputHandler='_input_as_string',
+                   WorkingDir=shard_dir,
+                   SuppressStderr=True,
+                   SuppressStdout=True)
+    result = blast_app(join(shard_dir, 'queries.fasta'))
+    out_fp = result['BlastOut'].name
+    result.cleanUp()
+    return out_fp
+
+def blast_seqs_sharded(seqs,
+                 blast_constructor,
+                 out_filename,
+                 num_shards=2,
+                 blast_db=None,
+                 blast_mat_root=None,
+                 params={},
+                 add_seq_names=True,
+                 WorkingDir=None,
+                 input_handler=None):
+    """Blast sequences with one process per shard of the input.
+
+    The FASTA records from seqs (see blast_seqs for the accepted inputs) are
+    split into num_shards chunks with balanced total residues, and each
+    chunk is run through its own blast_constructor instance (in its own
+    working directory under WorkingDir) in a pool of num_shards processes.
+    The tabular outputs are then merged, in input order, into out_filename.
+
+    Only tabular output with comments (-m 9) can be merged. Each process
+    uses the number of processors given by -a (default 1).
+
+    Returns an open file object on out_filename.
+    """
+    params = dict(params)
+    if str(params.get('-m', '9')) != '9':
+        raise ValueError, "Sharded BLAST requires tabular output (-m 9)."
+    if blast_db:
+        params["-d"] = blast_db
+    # each shard runs in its own directory
+    if params.get("-d"):
+        params["-d"] = _absolute_db_path(params["-d"])
+    params.pop('-o', None)
+
+    ih = input_handler or guess_input_handler(seqs, add_seq_names)
+    # the records are needed twice, to balance the shards and to write
+    # them, and seqs may be a generator whatever the input handler
+    records = [[str(l).strip() for l in rec]
+               for rec in seqs_to_stream(seqs, ih)]
+
+    rec_lengths = [sum(len(l) for l in rec[1:]) for rec in records]
+    owners = split_records_by_residues(rec_lengths, num_shards)
+    num_shards = max(owners) + 1 if owners else 0
+
+    shards_dir = abspath(mkdtemp(dir=WorkingDir or gettempdir(),
+                                 prefix='blast_shards_'))
+    try:
+        shard_dirs = []
+        shard_files = []
+        for i in range(num_shards):
+            shard_dirs.append(join(shards_dir, str(i)))
+            mkdir(shard_dirs[-1])
+            shard_files.append(open(join(shard_dirs[-1], 'queries.fasta'),
+                                    'w'))
+        # records are written in input order, so each shard's output is too
+        for shard, rec in zip(owners, records):
+            shard_files[shard].write('\n'.join(rec))
+            shard_files[shard].write('\n')
+        for f in shard_files:
+            f.close()
+
+        pool = Pool(num_shards or 1)
+        try:
+            out_fps = pool.map(_blast_shard,
+                               [(blast_constructor, d, params, blast_mat_root)
+                                for d in shard_dirs])
+        finally:
+            pool.close()
+            pool.join()
+
+        shard_blocks = [blast9_blocks(open(fp)) for fp in out_fps]
+        out_f = open(out_filename, 'w')
+        for shard in owners:
+            try:
+                out_f.writelines(shard_blocks[shard].next())
+            except StopIteration:
+                out_f.close()
+                raise ValueError, \
+                    "BLAST output of shard %d is missing queries." % shard
+        out_f.close()
+    finally:
+        rmtree(shards_dir, ignore_errors=True)
+
+    return open(out_filename)
+
+
 def fasta_cmd_get_seqs(acc_list,
                  blast_db=None,
                  is_protein=None,
@@ -712,8 +872,15 @@ def fastacmd_is_crap(line):
 
 FastaCmdFinder = LabeledRecordFinder(is_fasta_label, ignore=fastacmd_is_crap)
 
-def seqs_from_fastacmd(acc_list, blast_db,is_protein=True):
-    """Get dict of description:seq from fastacmd."""
+def seqs_from_fastacmd(acc_list, blast_db,is_protein=True, seq_index=None):
+    """Get dict of description:seq from fastacmd.
+
+    If seq_index (a bfillings.fasta_index.FastaIndex over the FASTA file the
+    database was built from) is passed, the sequences are read from it
+    instead of running fastacmd.
+    """
+    if seq_index is not None:
+        return dict(seq_index.get_records(acc_list))
     fasta_cmd_res = fasta_cmd_get_seqs(acc_list, blast_db=blast_db, \
         is_protein=is_protein)
     recs = FastaCmdFinder(fasta_cmd_res['StdOut'])
@@ -742,7 +909,9 @@ def psiblast_n_neighbors(seqs,
                  SuppressStdout=None,
                  input_handler=None,
                  scorer=3,   #shotgun with 3 hits needed to keep
-                 second_db=None
+                 second_db=None,
+                 seq_index=None,
+                 num_workers=1
                  ):
     """PsiBlasts sequences, stopping when n neighbors are reached.
 
@@ -758,10 +927,23 @@ def psiblast_n_neighbors(seqs,
     add_seq_names: boolean. if True, sequence names are inserted in the list
         of sequences. if False, it assumes seqs is a list of lines of some
         proper format that the program can handle
+
+    seq_index: optional FastaIndex over the FASTA the database was built
+        from; used by the "iterative" method to fetch neighbour sequences
+        instead of running fastacmd.
+
+    num_workers: if greater than 1, queries are searched concurrently in a
+        pool of this many processes. Each query then runs in its own scratch
+        directory under WorkingDir (default: the system temp dir), which
+        holds its checkpoint files and is removed when the query is done.
+        In this mode scorer must be an int or a module-level function.
     """
     if blast_db:
         params["-d"] = blast_db
 
+    if method not in ("two-step", "lower_threshold", "iterative"):
+        raise TypeError, "Got unknown method %s" % method
+
     ih = input_handler or guess_input_handler(seqs, add_seq_names)
     recs = seqs_to_stream(seqs, ih) #checkpointing can only handle one seq...
 
@@ -769,111 +951,206 @@ def psiblast_n_neighbors(seqs,
     max_iterations = params['-j']
     params['-j'] = 2    #won't checkpoint with single iteration
 
-    app = PsiBlast(params=params,
-                   blast_mat_root=blast_mat_root,
-                   InputHandler='_input_as_lines',
-                   WorkingDir=WorkingDir,
-                   SuppressStderr=SuppressStderr,
-                   SuppressStdout=SuppressStdout,
-                   )
+    search_args = (n, method, max_iterations, core_threshold, extra_threshold,
+                   lower_threshold, step, scorer, second_db)
     result = {}
-    for seq in recs:
-        query_id = seq[0][1:].split(None,1)[0]
-        if method == "two-step":
-            result[query_id] = ids_from_seq_two_step(seq, n, max_iterations, \
-                app, core_threshold, extra_threshold, lower_threshold, second_db)
-        elif method == "lower_threshold":
-            result[query_id] = ids_from_seq_lower_threshold(seq, n, \
-                max_iterations, app, core_threshold, lower_threshold, step)
-        elif method == "iterative":
-            result[query_id] = ids_from_seqs_iterative(seq, app, \
-               QMEPsiBlast9, scorer, params['-j'], n)
+    try:
+        if num_workers > 1:
+            # each query runs in its own scratch directory
+            worker_params = dict(params)
+            if worker_params.get('-d'):
+                worker_params['-d'] = _absolute_db_path(worker_params['-d'])
+            search_args = search_args[:-1] + (_absolute_db_path(second_db),)
+            app_args = (worker_params, blast_mat_root, WorkingDir,
+                        SuppressStderr, SuppressStdout)
+            seq_index_fp = seq_index.FastaFp if seq_index is not None \
+                else None
+            pool = Pool(num_workers, _init_psiblast_worker, (seq_index_fp,))
+            try:
+                for query_id, ids in pool.imap_unordered(
+                        _psiblast_neighbors_in_scratch_dir,
+                        [(list(seq), app_args, search_args) for seq in recs]):
+                    result[query_id] = ids
+            finally:
+                pool.close()
+                pool.join()
         else:
-            raise TypeError, "Got unknown method %s" % method
-
-    params['-j'] = max_iterations
+            app = PsiBlast(params=params,
+                           blast_mat_root=blast_mat_root,
+                           InputHandler='_input_as_lines',
+                           WorkingDir=WorkingDir,
+                           SuppressStderr=SuppressStderr,
+                           SuppressStdout=SuppressStdout,
+                           )
+            for seq in recs:
+                query_id = seq[0][1:].split(None,1)[0]
+                result[query_id] = _psiblast_neighbors(seq, app, search_args,
+                                                       seq_index)
+    finally:
+        params['-j'] = max_iterations
     return result
 
+def _psiblast_neighbors(seq, app, search_args, seq_index=None,
+                        checkpoint_dir=None):
+    """Returns the neighbour ids of one query for psiblast_n_neighbors."""
+    n, method, max_iterations, core_threshold, extra_threshold, \
+        lower_threshold, step, scorer, second_db = search_args
+    if method == "two-step":
+        return ids_from_seq_two_step(seq, n, max_iterations, app,
+            core_threshold, extra_threshold, lower_threshold, second_db,
+            checkpoint_dir=checkpoint_dir)
+    elif method == "lower_threshold":
+        return ids_from_seq_lower_threshold(seq, n, max_iterations, app,
+            core_threshold, lower_threshold, step,
+            checkpoint_dir=checkpoint_dir)
+    elif method == "iterative":
+        return ids_from_seqs_iterative(seq, app, QMEPsiBlast9, scorer,
+            app.Parameters['-j'].Value, n, seq_index=seq_index)
+    else:
+        raise TypeError, "Got unknown method %s" % method
+
+# FastaIndex of each psiblast_n_neighbors worker process
+_worker_seq_index = None
+
+def _init_psiblast_worker(seq_index_fp):
+    """Opens the worker's FastaIndex, if psiblast_n_neighbors got one."""
+    global _worker_seq_index
+    if seq_index_fp is not None:
+        _worker_seq_index = FastaIndex(seq_index_fp)
+
+def _psiblast_neighbors_in_scratch_dir(args):
+    """Searches one query in its own scratch directory.
+
+    Returns (query_id, ids). Module-level so that it can be sent to a
+    multiprocessing pool.
+    """
+    seq, app_args, search_args = args
+    params, blast_mat_root, working_dir, suppress_stderr, suppress_stdout = \
+        app_args
+    query_id = seq[0][1:].split(None,1)[0]
+    scratch_dir = abspath(mkdtemp(dir=working_dir or gettempdir(),
+                                  prefix='psiblast_'))
+    try:
+        app = PsiBlast(params=params,
+                       blast_mat_root=blast_mat_root,
+                       InputHandler='_input_as_lines',
+                       WorkingDir=scratch_dir,
+                       SuppressStderr=suppress_stderr,
+                       SuppressStdout=suppress_stdout,
+                       )
+        ids = _psiblast_neighbors(seq, app, search_args, _worker_seq_index,
+                                  checkpoint_dir=scratch_dir)
+    finally:
+        rmtree(scratch_dir, ignore_errors=True)
+    return query_id, ids
+
 def ids_from_seq_two_step(seq, n, max_iterations, app, core_threshold, \
-    extra_threshold, lower_threshold, second_db=None):
+    extra_threshold, lower_threshold, second_db=None, checkpoint_dir=None):
     """Returns ids that match a seq, using a 2-tiered strategy.
 
     Optionally uses a second database for the second search.
+
+    Checkpoint files are written to checkpoint_dir (default: the current
+    directory) and are always removed before returning.
     """
     #first time through: reset 'h' and 'e' to core
     #-h is the e-value threshold for including seqs in the score matrix model
     app.Parameters['-h'].on(core_threshold)
     #-e is the e-value threshold for the final blast
     app.Parameters['-e'].on(core_threshold)
+    orig_db = app.Parameters['-d'].Value
     checkpoints = []
     ids = []
     last_num_ids = None
-    for i in range(max_iterations):
-        if checkpoints:
-            app.Parameters['-R'].on(checkpoints[-1])
-        curr_check = 'checkpoint_%s.chk' % i
-        app.Parameters['-C'].on(curr_check)
-
-        output = app(seq)
-        #if we didn't write a checkpoint, bail out
-        if not access(curr_check, F_OK):
-            break
-        #if we got here, we wrote a checkpoint file
-        checkpoints.append(curr_check)
-        result = list(output.get('BlastOut', output['StdOut']))
-        output.cleanUp()
-        if result:
-            ids = LastProteinIds9(result,keep_values=True,filter_identity=False)
-        num_ids = len(ids)
-        if num_ids >= n:
-            break
-        if num_ids == last_num_ids:
-            break
-        last_num_ids = num_ids
+    try:
+        for i in range(max_iterations):
+            if checkpoints:
+                app.Parameters['-R'].on(checkpoints[-1])
+            curr_check = _checkpoint_path(checkpoint_dir,
+                                          'checkpoint_%s.chk' % i)
+            app.Parameters['-C'].on(curr_check)
 
-    #if we didn't write any checkpoints, second run won't work, so return ids
-    if not checkpoints:
-        return ids
+            output = app(seq)
+            #if we didn't write a checkpoint, bail out
+            if not access(curr_check, F_OK):
+                break
+            #if we got here, we wrote a checkpoint file
+            checkpoints.append(curr_check)
+            result = list(output.get('BlastOut', output['StdOut']))
+            output.cleanUp()
+            if result:
+                ids = LastProteinIds9(result, keep_values=True,
+                                      filter_identity=False)
+            num_ids = len(ids)
+            if num_ids >= n:
+                break
+            if num_ids == last_num_ids:
+                break
+            last_num_ids = num_ids
 
-    #if we got too many ids and don't have a second database, return the ids we got
-    if (not second_db) and num_ids >= n:
+        #if we didn't write any checkpoints, second run won't work, so return
+        #ids
+        if not checkpoints:
+            return ids
+
+        #if we got too many ids and don't have a second database, return the
+        #ids we got
+        if (not second_db) and num_ids >= n:
+            return ids
+
+        #second time through: reset 'h' and 'e' to get extra hits, and switch
+        #the database if appropriate
+        app.Parameters['-h'].on(extra_threshold)
+        app.Parameters['-e'].on(lower_threshold)
+        if second_db:
+            app.Parameters['-d'].on(second_db)
+        #will always have last_check if we get here
+        for i in range(max_iterations):
+            app.Parameters['-R'].on(checkpoints[-1])
+            curr_check = _checkpoint_path(checkpoint_dir,
+                                          'checkpoint_b_%s.chk' % i)
+            app.Parameters['-C'].on(curr_check)
+            output = app(seq)
+            #bail out if we couldn't write a checkpoint
+            if not access(curr_check, F_OK):
+                break
+            #if we got here, the checkpoint worked
+            checkpoints.append(curr_check)
+            result = list(output.get('BlastOut', output['StdOut']))
+            if result:
+                ids = LastProteinIds9(result, keep_values=True,
+                                      filter_identity=False)
+            num_ids = len(ids)
+            if num_ids >= n:
+                break
+            if num_ids == last_num_ids:
+                break
+            last_num_ids = num_ids
+        #return the ids we got. may not be as many as we wanted.
         return ids
+    finally:
+        for c in checkpoints:
+            remove(c)
+        #don't let the next query restart from our checkpoints or database
+        app.Parameters['-R'].off()
+        if second_db:
+            app.Parameters['-d'].on(orig_db)
 
-    #second time through: reset 'h' and 'e' to get extra hits, and switch the
-    #database if appropriate
-    app.Parameters['-h'].on(extra_threshold)
-    app.Parameters['-e'].on(lower_threshold)
-    if second_db:
-        app.Parameters['-d'].on(second_db)
-    for i in range(max_iterations): #will always have last_check if we get here
-        app.Parameters['-R'].on(checkpoints[-1])
-        curr_check = 'checkpoint_b_%s.chk' % i
-        app.Parameters['-C'].on(curr_check)
-        output = app(seq)
-        #bail out if we couldn't write a checkpoint
-        if not access(curr_check, F_OK):
-            break
-        #if we got here, the checkpoint worked
-        checkpoints.append(curr_check)
-        result = list(output.get('BlastOut', output['StdOut']))
-        if result:
-            ids = LastProteinIds9(result,keep_values=True,filter_identity=False)
-        num_ids = len(ids)
-        if num_ids >= n:
-            break
-        if num_ids == last_num_ids:
-            break
-        last_num_ids = num_ids
-    #return the ids we got. may not be as many as we wanted.
-    for c in checkpoints:
-        remove(c)
-    return ids
+def _checkpoint_path(checkpoint_dir, name):
+    """Returns the path of checkpoint file name in checkpoint_dir."""
+    if checkpoint_dir is None:
+        return name
+    return join(checkpoint_dir, name)
 
 class ThresholdFound(Exception): pass
 
 def ids_from_seq_lower_threshold(seq, n, max_iterations, app, core_threshold, \
-    lower_threshold, step=100):
-    """Returns ids that match a seq, decreasing the sensitivity."""
+    lower_threshold, step=100, checkpoint_dir=None):
+    """Returns ids that match a seq, decreasing the sensitivity.
+
+    Checkpoint files are written to checkpoint_dir (default: the current
+    directory).
+    """
     last_num_ids = None
     checkpoints = []
     cp_name_base = make_unique_str()
@@ -893,8 +1170,8 @@ def ids_from_seq_lower_threshold(seq, n, max_iterations, app, core_threshold, \
                 #-R restarts from a previously stored file
                 app.Parameters['-R'].on(checkpoints[-1])
             #store the score model from this iteration
-            curr_check = 'checkpoint_' + cp_name_base + '_' + str(i) + \
-                    '.chk'
+            curr_check = _checkpoint_path(checkpoint_dir,
+                'checkpoint_' + cp_name_base + '_' + str(i) + '.chk')
             app.Parameters['-C'].on(curr_check)
             output = app(seq)
             result = list(output.get('BlastOut', output['StdOut']))
@@ -973,10 +1250,14 @@ def keep_everything_scorer(checked_ids):
 
 def ids_from_seqs_iterative(seqs, app, query_parser, \
     scorer=keep_everything_scorer, max_iterations=None, blast_db=None,\
-    max_seqs=None, ):
+    max_seqs=None, seq_index=None):
     """Gets the ids from each seq, then does each additional id until all done.
 
     If scorer is passed in as an int, uses shotgun scorer with that # hits.
+
+    If seq_index (a FastaIndex over the FASTA file the database was built
+    from) is passed, the sequences of new ids are read from it; otherwise
+    they are retrieved with fastacmd.
     """
     if isinstance(scorer, int):
         scorer = make_shotgun_scorer(scorer)
@@ -996,13 +1277,17 @@ def ids_from_seqs_iterative(seqs, app, query_parser, \
             if match_id not in checked_ids:
                 unchecked_ids[match_id] = True
         all_output.cleanUp()
-        if unchecked_ids:
-            seq_file = fasta_cmd_get_seqs(unchecked_ids.keys(),
-                app.Parameters['-d'].Value)['StdOut']
+        if unchecked_ids and seq_index is not None:
             seqs_to_check = []
-            for s in FastaCmdFinder(fasta_cmd_get_seqs(\
-                unchecked_ids.keys(), app.Parameters['-d'].Value)['StdOut']):
+            for label, seq in seq_index.get_records(unchecked_ids.keys()):
+                seqs_to_check.extend(['>' + label, seq])
+        elif unchecked_ids:
+            fasta_cmd_res = fasta_cmd_get_seqs(unchecked_ids.keys(),
+                app.Parameters['-d'].Value)
+            seqs_to_check = []
+            for s in FastaCmdFinder(fasta_cmd_res['StdOut']):
                 seqs_to_check.extend(s)
+            fasta_cmd_res.cleanUp()
         else:
             seqs_to_check = []
         #bail out if max iterations or max seqs was defined and we've reached it
@@ -1016,12 +1301,42 @@ def ids_from_seqs_iterative(seqs, app, query_parser, \
     return scorer(checked_ids)  #scorer should return list of good ids
 
 
+def _blastall_sharded(seqs, blast_db, params, num_shards, working_dir,
+                      blast_mat_root):
+    """Returns BlastResult of blastall run with blast_seqs_sharded, or None
+
+    Used by blastp and blastn when num_shards is greater than 1.
+    """
+    fd, out_filename = mkstemp(dir=working_dir, prefix='blast_sharded_',
+                               suffix='.txt')
+    close(fd)
+    try:
+        blast_out = blast_seqs_sharded(seqs,
+            Blastall,
+            out_filename,
+            num_shards=num_shards,
+            blast_mat_root=blast_mat_root,
+            blast_db=blast_db,
+            params=params,
+            add_seq_names=False,
+            WorkingDir=working_dir
+            )
+        lines = [x for x in blast_out]
+        blast_out.close()
+    finally:
+        remove(out_filename)
+    if lines:
+        return BlastResult(lines)
+    return None
+
 def blastp(seqs, blast_db="nr", e_value="1e-20", max_hits=200,
-           working_dir="/tmp", blast_mat_root=None, extra_params={}):
+           working_dir="/tmp", blast_mat_root=None, extra_params={},
+           num_shards=1):
     """
     Returns BlastResult from input seqs, using blastp.
 
-    Need to add doc string
+    num_shards: if greater than 1, the input is split across this many
+        blastall processes (see blast_seqs_sharded).
     """
 
     # set up params to use with blastp
@@ -1046,6 +1361,10 @@ def blastp(seqs, blast_db="nr", e_value="1e-20", max_hits=200,
     }
     params.update(extra_params)
 
+    if num_shards > 1:
+        return _blastall_sharded(seqs, blast_db, params, num_shards,
+                                 working_dir, blast_mat_root)
+
     # blast
     blast_res =  blast_seqs(seqs,
         Blastall,
@@ -1064,11 +1383,13 @@ def blastp(seqs, blast_db="nr", e_value="1e-20", max_hits=200,
     return None
 
 def blastn(seqs, blast_db="nt", e_value="1e-20", max_hits=200,
-           working_dir="/tmp", blast_mat_root=None, extra_params={}):
+           working_dir="/tmp", blast_mat_root=None, extra_params={},
+           num_shards=1):
     """
     Returns BlastResult from input seqs, using blastn.
 
-    Need to add doc string
+    num_shards: if greater than 1, the input is split across this many
+        blastall processes (see blast_seqs_sharded).
     """
 
     # set up params to use with blastp
@@ -1093,6 +1414,10 @@ def blastn(seqs, blast_db="nt", e_value="1e-20", max_hits=200,
     }
     params.update(extra_params)
 
+    if num_shards > 1:
+        return _blastall_sharded(seqs, blast_db, params, num_shards,
+                                 working_dir, blast_mat_root)
+
     # blast
     blast_res =  blast_seqs(seqs,
         Blastall,
@@ -1136,6 +1461,88 @@ def reciprocal_best_blast_hit(query_id, db_1, db_2, exclude_self_hits=True,\
 
     #make with factory functions for the blast hits
 
+def best_hits_from_blast9(lines, exclude_self_hits=True):
+    """Returns {query_id: (subject_id, bit_score, e_value)} from -m 9 lines.
+
+    Lines are streamed, and only the current best hit (highest bit score,
+    then lowest e-value, then first seen) of each query is kept.
+
+    exclude_self_hits: if True (the default), hits of a query to a subject
+    with the same id are ignored.
+    """
+    best_hits = {}
+    for line in lines:
+        if not line.strip() or line.startswith('#'):
+            continue
+        fields = line.rstrip('\n').split('\t')
+        query_id, subject_id = fields[0], fields[1]
+        if exclude_self_hits and query_id == subject_id:
+            continue
+        e_value, bit_score = float(fields[10]), float(fields[11])
+        best = best_hits.get(query_id)
+        if best is None or bit_score > best[1] or \
+           (bit_score == best[1] and e_value < best[2]):
+            best_hits[query_id] = (subject_id, bit_score, e_value)
+    return best_hits
+
+def reciprocal_best_blast_hits(fasta_1, fasta_2, db_1=None, db_2=None,
+                               is_protein=True, exclude_self_hits=True,
+                               num_shards=1, working_dir='/tmp',
+                               blast_mat_root=None, params=None):
+    """Returns reciprocal best hits between all the seqs of two FASTA files.
+
+    fasta_1, fasta_2: paths to the FASTA files to compare (e.g. proteomes)
+    db_1, db_2: optional BLAST databases built from fasta_1 and fasta_2;
+        when not given, temporary databases are built with formatdb.
+    is_protein: if True (the default) runs blastp, otherwise blastn.
+    exclude_self_hits: if True (the default), ignores hits with the same id
+        as the query.
+    num_shards: number of processes each BLAST direction is split across
+        (see blast_seqs_sharded).
+    params: additional blastall parameters.
+
+    Runs all of fasta_1 against db_2 and all of fasta_2 against db_1, keeping
+    only the best hit of each query, and returns the list of (id_1, id_2)
+    pairs that are each other's best hit, ordered by id_1.
+    """
+    blast_params = {'-p': 'blastp' if is_protein else 'blastn', '-m': 9}
+    blast_params.update(params or {})
+
+    # the databases are used from the shard directories (see
+    # blast_seqs_sharded), so all paths must be absolute
+    fasta_1, fasta_2 = abspath(fasta_1), abspath(fasta_2)
+    db_1, db_2 = _absolute_db_path(db_1), _absolute_db_path(db_2)
+    scratch_dir = abspath(mkdtemp(dir=working_dir,
+                                  prefix='reciprocal_best_hits_'))
+    try:
+        if db_1 is None:
+            db_1, _ = build_blast_db_from_fasta_path(fasta_1,
+                is_protein=is_protein, output_dir=scratch_dir)
+        if db_2 is None:
+            db_2, _ = build_blast_db_from_fasta_path(fasta_2,
+                is_protein=is_protein, output_dir=scratch_dir)
+
+        best_hits = []
+        for i, (queries, db) in enumerate([(fasta_1, db_2), (fasta_2, db_1)]):
+            out_f = blast_seqs_sharded(queries, Blastall,
+                join(scratch_dir, 'blast_out_%d.txt' % i),
+                num_shards=num_shards, blast_db=db,
+                blast_mat_root=blast_mat_root, params=blast_params,
+                add_seq_names=False, WorkingDir=scratch_dir,
+                input_handler='_input_as_string')
+            best_hits.append(best_hits_from_blast9(out_f, exclude_self_hits))
+            out_f.close()
+    finally:
+        rmtree(scratch_dir, ignore_errors=True)
+
+    best_1, best_2 = best_hits
+    result = []
+    for id_1, (id_2, _, _) in sorted(best_1.items()):
+        reverse_hit = best_2.get(id_2)
+        if reverse_hit is not None and reverse_hit[0] == id_1:
+            result.append((id_1, id_2))
+    return result
+
 
 if __name__ == "__main__":
 
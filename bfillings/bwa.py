@@ -10,13 +10,15 @@
 
 """Application controller for BWA 0.6.2 (release 19 June 2012)"""
 
-from os.path import isabs
+from os.path import isabs, join
 from tempfile import mkstemp
 
 from burrito.parameters import FlagParameter, ValuedParameter
 from burrito.util import (CommandLineApplication, ResultPath,
                             ApplicationError)
 
+from bfillings.cache import ContentCache, cache_key, file_digest
+
 __author__ = "Adam Robbins-Pianka"
 __copyright__ = "Copyright 2007-2012, The Cogent Project"
 __credits__ = ["Adam Robbins-Pianka", "Jai Ram Rideout"]
@@ -635,6 +637,43 @@ def create_bwa_index_from_fasta_file(fasta_in, params=None):
     return results
 
 
+def get_cached_bwa_index(fasta_in, cache_dir, params=None, max_size=None):
+    """Return an open cache entry holding a BWA index of fasta_in
+
+    fasta_in: the input fasta file from which to create the index
+    cache_dir: directory where indexes are cached
+    params: dict of bwa index specific parameters (e.g. -a); -p is set by
+     the cache and must not be passed
+    max_size: size budget of the cache in bytes; least recently used indexes
+     are removed when it is exceeded. None means no limit.
+
+    Indexes are keyed by the md5 of the contents of fasta_in and the index
+    parameters, so the same reference is only indexed once. Concurrent
+    callers building the same index wait for the first one to finish.
+
+    This method returns a bfillings.cache.CacheEntry; the index prefix is
+    available as its IndexPrefix attribute. The index is protected from
+    eviction until the entry is released.
+    """
+    if params is None:
+        params = {}
+    if '-p' in params:
+        raise InvalidArgumentApplicationError("The index prefix (-p) is set "
+                                              "by the index cache.")
+
+    cache = ContentCache(cache_dir, max_size=max_size)
+    key = cache_key('bwa index', file_digest(fasta_in), params)
+
+    def build_index(build_dir):
+        index_params = dict(params)
+        index_params['-p'] = join(build_dir, 'index')
+        create_bwa_index_from_fasta_file(fasta_in, index_params)
+
+    entry = cache.open_entry(key, build_index)
+    entry.IndexPrefix = join(entry.Path, 'index')
+    return entry
+
+
 def assign_reads_to_database(query, database_fasta, out_path, params=None):
     """Assign a set of query sequences to a reference database
 
@@ -655,6 +694,12 @@ def assign_reads_to_database(query, database_fasta, out_path, params=None):
             subcommand
             * if a temporary directory is not specified in params using dict
             key "temp_dir", it will be assumed to be /tmp
+            * params for bwa index can be passed using dict key
+            "index_params"
+            * to reuse the index of database_fasta across calls, specify a
+            cache directory using dict key "index_cache_dir" and,
+            optionally, a cache size budget in bytes using dict key
+            "index_cache_size" (see get_cached_bwa_index)
 
     This method returns an open file object (SAM format).
     """
@@ -697,38 +742,55 @@ def assign_reads_to_database(query, database_fasta, out_path, params=None):
     # same as the original minus these addendums
     subcommand_params = {}
     for k, v in params.iteritems():
-        if k not in ('algorithm', 'temp_dir', 'aln_params'):
+        if k not in ('algorithm', 'temp_dir', 'aln_params', 'index_params',
+                     'index_cache_dir', 'index_cache_size'):
             subcommand_params[k] = v
 
-    # build index from database_fasta
-    # get a temporary file name that is not in use
-    _, index_prefix = mkstemp(dir=params['temp_dir'], suffix='')
-
-    create_bwa_index_from_fasta_file(database_fasta, {'-p': index_prefix})
-
-    # if the algorithm is bwasw, things are pretty simple. Just instantiate
-    # the proper controller and set the files
-    if params['algorithm'] == 'bwasw':
-        bwa = BWA_bwasw(params=subcommand_params)
-        files = {'prefix': index_prefix, 'query_fasta': query}
-
-    # if the algorithm is bwa-short, it's not so simple
-    elif params['algorithm'] == 'bwa-short':
-        # we have to call bwa_aln to get the sai file needed for samse
-        # use the aln_params we ensured we had above
-        bwa_aln = BWA_aln(params=params['aln_params'])
-        aln_files = {'prefix': index_prefix, 'fastq_in': query}
-        # get the path to the sai file
-        sai_file_path = bwa_aln(aln_files)['output'].name
-
-        # we will use that sai file to run samse
-        bwa = BWA_samse(params=subcommand_params)
-        files = {'prefix': index_prefix, 'sai_in': sai_file_path,
-                 'fastq_in': query}
-
-    # run which ever app controller we decided was correct on the files
-    # we set up
-    result = bwa(files)
+    index_params = params.get('index_params', {})
+
+    # build index from database_fasta, or fetch it from the index cache
+    index_entry = None
+    if params.get('index_cache_dir') is not None:
+        index_entry = get_cached_bwa_index(database_fasta,
+                                           params['index_cache_dir'],
+                                           index_params,
+                                           params.get('index_cache_size'))
+        index_prefix = index_entry.IndexPrefix
+    else:
+        # get a temporary file name that is not in use
+        _, index_prefix = mkstemp(dir=params['temp_dir'], suffix='')
+
+        index_params = dict(index_params)
+        index_params['-p'] = index_prefix
+        create_bwa_index_from_fasta_file(database_fasta, index_params)
+
+    try:
+        # if the algorithm is bwasw, things are pretty simple. Just instantiate
+        # the proper controller and set the files
+        if params['algorithm'] == 'bwasw':
+            bwa = BWA_bwasw(params=subcommand_params)
+            files = {'prefix': index_prefix, 'query_fasta': query}
+
+        # if the algorithm is bwa-short, it's not so simple
+        elif params['algorithm'] == 'bwa-short':
+            # we have to call bwa_aln to get the sai file needed for samse
+            # use the aln_params we ensured we had above
+            bwa_aln = BWA_aln(params=params['aln_params'])
+            aln_files = {'prefix': index_prefix, 'fastq_in': query}
+            # get the path to the sai file
+            sai_file_path = bwa_aln(aln_files)['output'].name
+
+            # we will use that sai file to run samse
+            bwa = BWA_samse(params=subcommand_params)
+            files = {'prefix': index_prefix, 'sai_in': sai_file_path,
+                     'fastq_in': query}
+
+        # run which ever app controller we decided was correct on the files
+        # we set up
+        result = bwa(files)
+    finally:
+        if index_entry is not None:
+            index_entry.release()
 
     # they both return a SAM file, so return that
     return result['output']
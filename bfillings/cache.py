@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2013--, biocore development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+#-----------------------------------------------------------------------------
+
+"""On-disk cache for expensive, content-derived application outputs
+
+Several application controllers build artifacts (indexes, databases, sorted
+files) that depend only on the content of their inputs and on a handful of
+parameters. ContentCache stores these artifacts in a shared directory, keyed
+by a digest of those inputs, so that repeated calls can reuse them.
+
+Each cache entry is a directory, cache_dir/<key>, which is built in a
+temporary directory and then renamed into place, so readers never see a
+partially built entry. Builders of the same key are serialized with a file
+lock, entries in use are protected from eviction with a shared lock, and the
+least recently used entries are removed once the cache grows beyond its size
+budget.
+"""
+
+from fcntl import flock, LOCK_EX, LOCK_SH, LOCK_UN, LOCK_NB
+from hashlib import md5
+from os import listdir, makedirs, rename, utime, walk
+from os.path import abspath, exists, getmtime, getsize, isdir, join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+
+def file_digest(fp, block_size=2 ** 20):
+    """Return the hex md5 digest of the contents of the file at fp"""
+    digest = md5()
+    with open(fp, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# digests computed by stamped_file_digest, by (path, size, modification time)
+_stamped_digests = {}
+
+
+def stamped_file_digest(fp):
+    """Return file_digest(fp), reusing it if the file is unchanged
+
+    Digests are remembered for the life of the process, keyed by the path,
+    size and modification time of the file, so that repeated calls on the
+    same large input (e.g. a parameter sweep) read it only once.
+    """
+    fp = abspath(fp)
+    stamp = (fp, getsize(fp), getmtime(fp))
+    digest = _stamped_digests.get(stamp)
+    if digest is None:
+        digest = file_digest(fp)
+        _stamped_digests[stamp] = digest
+    return digest
+
+
+def cache_key(*parts):
+    """Return a cache key built from parts
+
+    parts can be strings (e.g. file digests) or dicts of parameters; dicts
+    are sorted so that the key does not depend on their ordering.
+    """
+    digest = md5()
+    for part in parts:
+        if isinstance(part, dict):
+            part = sorted((str(k), str(v)) for k, v in part.items())
+        digest.update(repr(part))
+        digest.update('\0')
+    return digest.hexdigest()
+
+
+def _dir_size(dir_path):
+    """Return the total size in bytes of the files under dir_path"""
+    total = 0
+    for root, dirs, files in walk(dir_path):
+        for f in files:
+            total += getsize(join(root, f))
+    return total
+
+
+class CacheEntry(object):
+    """A handle on a cache entry that is currently in use
+
+    While a CacheEntry is open, the entry is shared-locked and will not be
+    evicted. Call release (or use the entry as a context manager) when done
+    with it.
+    """
+
+    def __init__(self, path, lock_file):
+        self.Path = path
+        self._lock_file = lock_file
+
+    def release(self):
+        """Release the shared lock on the entry"""
+        if self._lock_file is not None:
+            flock(self._lock_file, LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+
+class ContentCache(object):
+    """Content-addressed on-disk cache of built artifacts
+
+    cache_dir: directory holding the cache (created if it does not exist)
+    max_size: size budget in bytes; once the entries exceed it the least
+     recently used entries that are not in use are removed. None disables
+     eviction.
+    """
+
+    _lock_suffix = '.lock'
+    _build_prefix = '.build_'
+
+    def __init__(self, cache_dir, max_size=None):
+        self.CacheDir = cache_dir
+        self.MaxSize = max_size
+        # entries handed out by acquire, by path
+        self._acquired = {}
+        if not isdir(cache_dir):
+            try:
+                makedirs(cache_dir)
+            except OSError:
+                # another process may have created it in the meantime
+                if not isdir(cache_dir):
+                    raise
+
+    def _entry_path(self, key):
+        return join(self.CacheDir, key)
+
+    def _lock_path(self, key):
+        return join(self.CacheDir, key + self._lock_suffix)
+
+    def __contains__(self, key):
+        return exists(self._entry_path(key))
+
+    def open_entry(self, key, build_f):
+        """Return an open CacheEntry for key, building it if necessary
+
+        key: the cache key (see cache_key)
+        build_f: function called with a single argument, an empty directory,
+         into which it must write the entry's files. It is only called if the
+         entry does not exist yet, and at most one process builds a given key
+         at a time.
+
+        The returned CacheEntry holds a shared lock on the entry until it is
+        released, so the entry cannot be evicted while in use. An existing
+        entry is opened under the shared lock alone, so any number of readers
+        can hold it at the same time; the exclusive lock is only taken to
+        build a missing entry.
+        """
+        entry_path = self._entry_path(key)
+        lock_file = open(self._lock_path(key), 'a')
+        try:
+            while True:
+                # fast path: the entry exists, so only a shared lock is
+                # needed (this also lets a process open an entry it
+                # already holds)
+                flock(lock_file, LOCK_SH)
+                if exists(entry_path):
+                    utime(entry_path, None)
+                    break
+                flock(lock_file, LOCK_EX)
+                if not exists(entry_path):
+                    build_dir = mkdtemp(dir=self.CacheDir,
+                                        prefix=self._build_prefix)
+                    try:
+                        build_f(build_dir)
+                        rename(build_dir, entry_path)
+                    except:
+                        rmtree(build_dir, ignore_errors=True)
+                        raise
+                # mark the entry as recently used
+                utime(entry_path, None)
+                # converting the lock is not atomic, so make sure the entry
+                # was not evicted in between
+                flock(lock_file, LOCK_SH)
+                if exists(entry_path):
+                    break
+        except:
+            flock(lock_file, LOCK_UN)
+            lock_file.close()
+            raise
+
+        entry = CacheEntry(entry_path, lock_file)
+        self.evict()
+        return entry
+
+    def get(self, key, build_f):
+        """Return the path of the entry for key, building it if necessary
+
+        Unlike open_entry, the entry is not protected from eviction once this
+        function returns.
+        """
+        with self.open_entry(key, build_f) as entry:
+            return entry.Path
+
+    def acquire(self, key, build_f):
+        """Return the path of the entry for key and hold it until released
+
+        Like open_entry, but the cache keeps track of the open entry: each
+        call must be matched by a call to release with the returned path.
+        The entry is not evicted while any process holds it.
+        """
+        entry = self.open_entry(key, build_f)
+        self._acquired.setdefault(entry.Path, []).append(entry)
+        return entry.Path
+
+    def release(self, path):
+        """Release an entry path returned by acquire"""
+        entries = self._acquired.get(path)
+        if not entries:
+            raise ValueError("%s is not held by this cache." % path)
+        entries.pop().release()
+        if not entries:
+            del self._acquired[path]
+
+    def ref_count(self, path):
+        """Return how many times this cache currently holds path"""
+        return len(self._acquired.get(path, []))
+
+    def entries(self):
+        """Return the keys of the complete entries in the cache"""
+        return [e for e in listdir(self.CacheDir)
+                if not e.startswith(self._build_prefix) and
+                not e.endswith(self._lock_suffix) and
+                isdir(self._entry_path(e))]
+
+    def size(self):
+        """Return the total size in bytes of the entries in the cache"""
+        return sum(_dir_size(self._entry_path(k)) for k in self.entries())
+
+    def evict(self):
+        """Remove least recently used entries until within the size budget
+
+        Entries that are in use (or being built) by any process are skipped.
+        Returns the list of evicted keys.
+        """
+        evicted = []
+        if self.MaxSize is None:
+            return evicted
+
+        sizes = {}
+        last_used = []
+        for key in self.entries():
+            entry_path = self._entry_path(key)
+            try:
+                sizes[key] = _dir_size(entry_path)
+                last_used.append((getmtime(entry_path), key))
+            except OSError:
+                # removed by another process while we were looking
+                continue
+        total = sum(sizes.values())
+
+        for _, key in sorted(last_used):
+            if total <= self.MaxSize:
+                break
+            lock_file = open(self._lock_path(key), 'a')
+            try:
+                flock(lock_file, LOCK_EX | LOCK_NB)
+            except IOError:
+                # in use
+                lock_file.close()
+                continue
+            try:
+                rmtree(self._entry_path(key), ignore_errors=True)
+            finally:
+                flock(lock_file, LOCK_UN)
+                lock_file.close()
+            total -= sizes[key]
+            evicted.append(key)
+        return evicted
+
+    def clear(self):
+        """Remove all entries that are not in use"""
+        max_size = self.MaxSize
+        self.MaxSize = -1
+        try:
+            return self.evict()
+        finally:
+            self.MaxSize = max_size
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2013--, biocore development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+#-----------------------------------------------------------------------------
+
+"""Exact dereplication of large sequence collections
+
+Dereplicator collapses identical sequences into one abundance-annotated
+record each, as done before Swarm or usearch61 clustering. It does not keep
+the sequences in memory: each sequence is keyed by a 128-bit digest of its
+2-bit packed form, unique sequences are streamed to a temporary file, and the
+original ids of each unique sequence are written to an id map side file
+(lines of "<unique label>\\t<original id>").
+
+Once more than max_uniques unique sequences have been seen, sequences that
+are not already known are spilled to hash partitions on disk, which are then
+dereplicated one at a time and merged back. A partition with more than
+max_uniques unique sequences is split again, on the next byte of the
+digests, so that memory use stays bounded by max_uniques whatever the size
+of the input. The output is the same with or without spilling: unique
+sequences in order of first occurrence, labelled after their first id.
+"""
+
+from array import array
+from binascii import unhexlify
+from hashlib import md5
+from heapq import merge
+from os import close, remove
+from os.path import exists
+from string import maketrans
+from tempfile import mkstemp
+
+_to_base4 = maketrans('ACGT', '0123')
+
+# bytes in a seq_digest
+_digest_size = 16
+
+
+def seq_digest(seq):
+    """Returns the 16 byte md5 digest of seq, 2-bit packed if possible
+
+    Sequences made only of A, C, G and T are packed to 2 bits per base
+    before hashing; others (e.g. with N or lower case bases) are hashed as
+    they are. Both forms are tagged, so distinct sequences never share a
+    packed form.
+    """
+    if seq and not seq.strip('ACGT'):
+        packed = '%x' % int(seq.translate(_to_base4), 4)
+        if len(packed) % 2:
+            packed = '0' + packed
+        return md5('P%d:%s' % (len(seq), unhexlify(packed))).digest()
+    return md5('R' + seq).digest()
+
+
+def read_id_map(id_map_fp):
+    """Returns a dict of unique label: list of original ids
+
+    id_map_fp: id map side file written by Dereplicator.dereplicate
+    """
+    id_map = {}
+    with open(id_map_fp, 'U') as id_map_f:
+        for line in id_map_f:
+            label, seq_id = line.rstrip('\n').split('\t')
+            try:
+                id_map[label].append(seq_id)
+            except KeyError:
+                id_map[label] = [seq_id]
+    return id_map
+
+
+class Dereplicator(object):
+    """Collapses identical sequences, spilling to disk beyond a budget
+
+    max_uniques: number of unique sequences kept track of in memory before
+     spilling to disk
+    num_partitions: number of hash partitions spilled sequences are split
+     into; each partition is dereplicated in memory on its own, or split
+     again into as many partitions if it holds more than max_uniques unique
+     sequences
+    label_prefix: prefix of the labels of unique sequences, which are
+     label_prefix + the first original id of the sequence
+    record_format: format of each unique record in the output FASTA, given
+     the label, the number of original sequences and the sequence. The
+     default is Swarm's; usearch uses '>%s;size=%d;\\n%s\\n'.
+    tmp_dir: directory for the temporary files
+    """
+
+    def __init__(self, max_uniques=1000000, num_partitions=16,
+                 label_prefix='ExactMatch.', record_format='>%s_%d\n%s\n',
+                 tmp_dir=None):
+        if max_uniques < 1:
+            raise ValueError("max_uniques must be at least 1.")
+        self.MaxUniques = max_uniques
+        self.NumPartitions = num_partitions
+        self.LabelPrefix = label_prefix
+        self.RecordFormat = record_format
+        self.TmpDir = tmp_dir
+
+    def _tmp_file(self, prefix):
+        fd, fp = mkstemp(prefix=prefix, suffix='.txt', dir=self.TmpDir)
+        close(fd)
+        return fp
+
+    def dereplicate(self, seqs, output_fasta_fp, id_map_fp):
+        """Writes the unique sequences in seqs and their id map
+
+        seqs: iterable of (label, seq); only the first word of each label is
+         used as the sequence id
+        output_fasta_fp: path of the abundance-annotated FASTA of unique
+         sequences, in order of first occurrence
+        id_map_fp: path of the id map side file, read with read_id_map
+
+        Returns the number of unique sequences.
+        """
+        label_prefix = self.LabelPrefix
+        # digest -> unique number, for the uniques tracked in memory
+        uniques = {}
+        counts = array('l')
+        first_ids = []
+        uniques_fp = self._tmp_file('derep_uniques_')
+        tmp_fps = [uniques_fp]
+        partition_fs = []
+        uniques_f = open(uniques_fp, 'w')
+        id_map_f = open(id_map_fp, 'w')
+
+        try:
+            for read_number, (label, seq) in enumerate(seqs):
+                seq_id = label.split()[0]
+                digest = seq_digest(seq)
+                unique = uniques.get(digest)
+                if unique is None and len(uniques) < self.MaxUniques:
+                    unique = len(uniques)
+                    uniques[digest] = unique
+                    counts.append(0)
+                    first_ids.append(seq_id)
+                    uniques_f.write(seq + '\n')
+                if unique is not None:
+                    counts[unique] += 1
+                    id_map_f.write('%s%s\t%s\n' % (label_prefix,
+                                                   first_ids[unique], seq_id))
+                    continue
+                # over budget: spill to the partition of the digest
+                if not partition_fs:
+                    for i in range(self.NumPartitions):
+                        tmp_fps.append(self._tmp_file('derep_part_'))
+                        partition_fs.append(open(tmp_fps[-1], 'w'))
+                partition_fs[ord(digest[0]) % self.NumPartitions].write(
+                    '%s\t%d\t%s\t%s\n' % (digest.encode('hex'), read_number,
+                                          seq_id, seq))
+            uniques_f.close()
+            num_uniques = len(uniques)
+            del uniques
+
+            # dereplicate each partition, giving files of
+            # (first read number, label, count, seq) sorted by read number
+            spilled_fps = []
+            for partition_f in partition_fs:
+                partition_f.close()
+                spilled_fp, num_spilled = self._dereplicate_partition(
+                    partition_f.name, id_map_f)
+                remove(partition_f.name)
+                tmp_fps.append(spilled_fp)
+                spilled_fps.append(spilled_fp)
+                num_uniques += num_spilled
+            id_map_f.close()
+
+            # uniques tracked in memory were all seen before any spilled one
+            output_f = open(output_fasta_fp, 'w')
+            record_format = self.RecordFormat
+            with open(uniques_fp) as uniques_f:
+                for unique, seq in enumerate(uniques_f):
+                    output_f.write(record_format %
+                                   (label_prefix + first_ids[unique],
+                                    counts[unique], seq[:-1]))
+            spilled_fs = [open(fp) for fp in spilled_fps]
+            for line in merge(*spilled_fs):
+                _, label, count, seq = line.rstrip('\n').split('\t')
+                output_f.write(record_format % (label, int(count), seq))
+            for spilled_f in spilled_fs:
+                spilled_f.close()
+            output_f.close()
+        finally:
+            uniques_f.close()
+            id_map_f.close()
+            for partition_f in partition_fs:
+                partition_f.close()
+            for fp in tmp_fps:
+                if exists(fp):
+                    remove(fp)
+
+        return num_uniques
+
+    def _dereplicate_partition(self, partition_fp, id_map_f, depth=1):
+        """Dereplicates one spilled partition
+
+        Writes the id map lines of the partition to id_map_f, and returns
+        the path of a file of "<first read number>\\t<label>\\t<count>\\t<seq>"
+        lines sorted by read number (zero padded, so that the files of all
+        partitions can be merged as text), and the number of lines in it.
+
+        depth: index of the digest byte the partition is split on if it
+         holds more than MaxUniques unique sequences
+        """
+        if self.NumPartitions > 1 and depth < _digest_size:
+            digests = set()
+            with open(partition_fp) as partition_f:
+                for line in partition_f:
+                    digests.add(line[:2 * _digest_size])
+                    if len(digests) > self.MaxUniques:
+                        del digests
+                        return self._split_partition(partition_fp, id_map_f,
+                                                     depth)
+            del digests
+
+        partition = {}
+        order = []
+        with open(partition_fp) as partition_f:
+            for line in partition_f:
+                digest, read_number, seq_id, seq = \
+                    line.rstrip('\n').split('\t')
+                record = partition.get(digest)
+                if record is None:
+                    record = [int(read_number),
+                              self.LabelPrefix + seq_id, 0, seq]
+                    partition[digest] = record
+                    order.append(record)
+                record[2] += 1
+                id_map_f.write('%s\t%s\n' % (record[1], seq_id))
+
+        result_fp = self._tmp_file('derep_spilled_')
+        with open(result_fp, 'w') as result_f:
+            for read_number, label, count, seq in order:
+                result_f.write('%020d\t%s\t%d\t%s\n'
+                               % (read_number, label, count, seq))
+        return result_fp, len(order)
+
+    def _split_partition(self, partition_fp, id_map_f, depth):
+        """Splits a partition on digest byte depth and dereplicates the parts
+
+        Returns the same as _dereplicate_partition, merging the results of
+        the parts.
+        """
+        part_fps = [self._tmp_file('derep_part_')
+                    for i in range(self.NumPartitions)]
+        result_fps = []
+        try:
+            part_fs = [open(fp, 'w') for fp in part_fps]
+            with open(partition_fp) as partition_f:
+                for line in partition_f:
+                    byte = int(line[2 * depth:2 * depth + 2], 16)
+                    part_fs[byte % self.NumPartitions].write(line)
+            for part_f in part_fs:
+                part_f.close()
+
+            num_uniques = 0
+            for part_fp in part_fps:
+                result_fp, num_part_uniques = self._dereplicate_partition(
+                    part_fp, id_map_f, depth + 1)
+                remove(part_fp)
+                result_fps.append(result_fp)
+                num_uniques += num_part_uniques
+
+            merged_fp = self._tmp_file('derep_spilled_')
+            result_fs = [open(fp) for fp in result_fps]
+            with open(merged_fp, 'w') as merged_f:
+                merged_f.writelines(merge(*result_fs))
+            for result_f in result_fs:
+                result_f.close()
+        finally:
+            for fp in part_fps + result_fps:
+                if exists(fp):
+                    remove(fp)
+        return merged_fp, num_uniques
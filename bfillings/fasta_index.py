@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2013--, biocore development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+#-----------------------------------------------------------------------------
+
+"""Random access to the records of a FASTA file
+
+FastaIndex scans a FASTA file once, recording the byte range of each record,
+and then serves lookups by sequence id from a memory map of the file, so that
+pulling a few records out of a large file does not require re-parsing it.
+
+The index can be persisted beside the FASTA file (fasta_fp + '.fidx'), so
+that later FastaIndex objects over the same file skip the scan. The persisted
+index records the size and modification time of the FASTA file, and is
+rebuilt when they no longer match.
+"""
+
+from collections import OrderedDict
+from mmap import mmap, ACCESS_READ
+from os import fdopen, rename, remove
+from os.path import abspath, basename, dirname, exists, getmtime, getsize
+from shutil import copymode
+from tempfile import mkstemp
+
+INDEX_SUFFIX = '.fidx'
+
+
+class FastaIndex(object):
+    """Byte offset index over the records of a FASTA file
+
+    fasta_fp: path to the FASTA file
+    cache_size: number of recently fetched records to keep in memory
+    persist: if True, the index is loaded from fasta_fp + '.fidx' when that
+     file matches the size and modification time of fasta_fp, and written
+     there otherwise (if the directory is writable)
+
+    Records are keyed by their id, the first whitespace-delimited word of the
+    label. If an id occurs more than once, only the first record is indexed.
+    """
+
+    def __init__(self, fasta_fp, cache_size=1000, persist=False):
+        self.FastaFp = fasta_fp
+        self.CacheSize = cache_size
+        self.IndexFp = fasta_fp + INDEX_SUFFIX if persist else None
+        self._cache = OrderedDict()
+        self._offsets = {}
+        self._file = open(fasta_fp, 'rb')
+        if getsize(fasta_fp) > 0:
+            self._map = mmap(self._file.fileno(), 0, access=ACCESS_READ)
+        else:
+            self._map = ''
+        if not (persist and self._load_index()):
+            self._build_index()
+            if persist:
+                self._save_index()
+
+    def _file_stamp(self):
+        return '%d\t%r' % (getsize(self.FastaFp), getmtime(self.FastaFp))
+
+    def _load_index(self):
+        """Loads the persisted index; returns False if missing or stale"""
+        if not exists(self.IndexFp):
+            return False
+        offsets = {}
+        index_f = open(self.IndexFp, 'U')
+        try:
+            if index_f.readline().rstrip('\n') != self._file_stamp():
+                return False
+            for line in index_f:
+                seq_id, start, end = line.rstrip('\n').split('\t')
+                offsets[seq_id] = (int(start), int(end))
+        except ValueError:
+            # truncated or otherwise corrupt index
+            return False
+        finally:
+            index_f.close()
+        self._offsets = offsets
+        return True
+
+    def _save_index(self):
+        """Writes the index beside the FASTA file, if possible"""
+        try:
+            tmp_fd, tmp_fp = mkstemp(prefix=basename(self.IndexFp) + '.',
+                                     suffix='.tmp',
+                                     dir=dirname(abspath(self.IndexFp)))
+        except (IOError, OSError):
+            return
+        index_f = fdopen(tmp_fd, 'w')
+        try:
+            # readable by whoever can read the FASTA file
+            copymode(self.FastaFp, tmp_fp)
+            index_f.write(self._file_stamp() + '\n')
+            for seq_id in self.ids():
+                start, end = self._offsets[seq_id]
+                index_f.write('%s\t%d\t%d\n' % (seq_id, start, end))
+            index_f.close()
+            rename(tmp_fp, self.IndexFp)
+        except (IOError, OSError):
+            index_f.close()
+            if exists(tmp_fp):
+                remove(tmp_fp)
+
+    def _build_index(self):
+        """Records the (start, end) byte range of each record
+
+        The scan jumps from one '\\n>' to the next with find, rather than
+        visiting sequence lines one by one.
+        """
+        offsets = self._offsets
+        data = self._map
+        size = len(data)
+        if size == 0:
+            return
+        if data[0] == '>':
+            start = 0
+        else:
+            start = data.find('\n>')
+            if start == -1:
+                return
+            start += 1
+        while True:
+            header_end = data.find('\n', start)
+            if header_end == -1:
+                header_end = size
+            next_header = data.find('\n>', header_end)
+            end = size if next_header == -1 else next_header + 1
+            fields = data[start + 1:header_end].split(None, 1)
+            seq_id = fields[0] if fields else ''
+            if seq_id not in offsets:
+                offsets[seq_id] = (start, end)
+            if next_header == -1:
+                break
+            start = end
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, seq_id):
+        return seq_id in self._offsets
+
+    def ids(self):
+        """Returns the indexed ids in file order"""
+        return sorted(self._offsets, key=self._offsets.get)
+
+    def get_raw(self, seq_id):
+        """Returns the unparsed text of the record for seq_id"""
+        start, end = self._offsets[seq_id]
+        return self._map[start:end]
+
+    def _parse_raw(self, raw):
+        lines = raw.splitlines()
+        label = lines[0][1:].strip()
+        seq = ''.join([l.strip() for l in lines[1:]])
+        return label, seq
+
+    def get_records(self, seq_ids):
+        """Returns a list of (label, seq) for the ids in seq_ids
+
+        Records are returned in the order of seq_ids, once per id, as
+        write_records does; ids that are not in the file are skipped. Records
+        that are not cached are read in file order.
+        """
+        seq_ids = list(seq_ids)
+        cache = self._cache
+        found = {}
+        to_read = []
+        for seq_id in seq_ids:
+            if seq_id in found:
+                continue
+            if seq_id in cache:
+                # move to the most recently used end
+                found[seq_id] = cache.pop(seq_id)
+                cache[seq_id] = found[seq_id]
+            elif seq_id in self._offsets:
+                to_read.append(seq_id)
+
+        for seq_id in sorted(to_read, key=self._offsets.get):
+            found[seq_id] = self._parse_raw(self.get_raw(seq_id))
+            cache[seq_id] = found[seq_id]
+            while len(cache) > self.CacheSize:
+                cache.popitem(last=False)
+
+        records = []
+        for seq_id in seq_ids:
+            record = found.pop(seq_id, None)
+            if record is not None:
+                records.append(record)
+        return records
+
+    def get_record(self, seq_id):
+        """Returns (label, seq) for seq_id; raises KeyError if missing"""
+        records = self.get_records([seq_id])
+        if not records:
+            raise KeyError(seq_id)
+        return records[0]
+
+    def iter_raw(self, seq_ids):
+        """Yields (seq_id, raw record text) for the ids in seq_ids
+
+        Records are yielded once each, in file order; ids that are not in the
+        file are skipped. The text always ends with a newline.
+        """
+        offsets = self._offsets
+        data = self._map
+        seq_ids = [seq_id for seq_id in set(seq_ids) if seq_id in offsets]
+        for seq_id in sorted(seq_ids, key=offsets.get):
+            start, end = offsets[seq_id]
+            raw = data[start:end]
+            if not raw.endswith('\n'):
+                raw += '\n'
+            yield seq_id, raw
+
+    def write_records(self, seq_ids, out_f):
+        """Copies the records for the ids in seq_ids to out_f, in file order
+
+        Records are copied as they are in the FASTA file, without parsing.
+        Returns the number of records written.
+        """
+        count = 0
+        for _, raw in self.iter_raw(seq_ids):
+            out_f.write(raw)
+            count += 1
+        return count
+
+    def close(self):
+        """Closes the underlying file"""
+        if self._map:
+            self._map.close()
+        self._file.close()
@@ -13,14 +13,18 @@ File created on 16 Sep 2009.
 """
 from __future__ import division
 from optparse import OptionParser
-from os.path import split, splitext
+from os.path import split, splitext, join, dirname
 from os import remove
 from glob import glob
+from hashlib import md5
+from shutil import copyfile
 from tempfile import mkstemp
 
 from burrito.util import CommandLineApplication, ResultPath
 from burrito.parameters import ValuedParameter, FilePath
 
+from bfillings.cache import ContentCache, cache_key, file_digest
+
 
 class FormatDb(CommandLineApplication):
     """ ApplicationController for formatting blast databases
@@ -85,8 +89,37 @@ class FormatDb(CommandLineApplication):
         return exit_status == 0
 
 
+def _cached_blast_db(fasta_path, digest, is_protein, cache, HALT_EXEC=False):
+    """Return the name of the cached blast db of fasta_path, building it if
+    needed
+
+        The database is keyed by digest (of the sequence content) and
+        is_protein, and is held in cache until release_cached_blast_db is
+        called with the returned name.
+    """
+    key = cache_key('formatdb', digest, {'-p': 'T' if is_protein else 'F'})
+
+    def build_db(build_dir):
+        db_fasta_path = join(build_dir, 'db.fasta')
+        copyfile(fasta_path, db_fasta_path)
+        build_blast_db_from_fasta_path(db_fasta_path, is_protein=is_protein,
+                                       HALT_EXEC=HALT_EXEC)
+
+    return join(cache.acquire(key, build_db), 'db.fasta')
+
+
+def release_cached_blast_db(db_name, cache):
+    """Release a blast db returned by one of the builders when using a cache
+
+        Once all users have released a database it can be evicted from the
+        cache (see bfillings.cache.ContentCache).
+    """
+    cache.release(dirname(db_name))
+
+
 def build_blast_db_from_fasta_path(fasta_path, is_protein=False,
-                                   output_dir=None, HALT_EXEC=False):
+                                   output_dir=None, HALT_EXEC=False,
+                                   cache=None):
     """Build blast db from fasta_path; return db name and list of files created
 
         **If using to create temporary blast databases, you can call
@@ -99,7 +132,16 @@ def build_blast_db_from_fasta_path(fasta_path, is_protein=False,
          (default: directory containing fasta_path)
         HALT_EXEC: halt just before running the formatdb command and
          print the command -- useful for debugging
+        cache: a bfillings.cache.ContentCache in which to keep the database.
+         If a database of the same sequences was already built, it is
+         reused. output_dir is ignored, the returned list of files is empty
+         (the files belong to the cache), and the database must be released
+         with release_cached_blast_db when done.
     """
+    if cache is not None:
+        return _cached_blast_db(fasta_path, file_digest(fasta_path),
+                                is_protein, cache, HALT_EXEC), []
+
     fasta_dir, fasta_filename = split(fasta_path)
     if not output_dir:
         output_dir = fasta_dir or '.'
@@ -130,7 +172,8 @@ def build_blast_db_from_fasta_path(fasta_path, is_protein=False,
 
 
 def build_blast_db_from_fasta_file(fasta_file, is_protein=False,
-                                   output_dir=None, HALT_EXEC=False):
+                                   output_dir=None, HALT_EXEC=False,
+                                   cache=None):
     """Build blast db from fasta_path; return db name and list of files created
 
         **If using to create temporary blast databases, you can call
@@ -143,6 +186,8 @@ def build_blast_db_from_fasta_file(fasta_file, is_protein=False,
          (default: directory containing fasta_path)
         HALT_EXEC: halt just before running the formatdb command and
          print the command -- useful for debugging
+        cache: a bfillings.cache.ContentCache in which to keep the database
+         (see build_blast_db_from_fasta_path)
     """
     output_dir = output_dir or '.'
     _, fasta_path = mkstemp(dir=output_dir, prefix="BLAST_temp_db_",
@@ -153,6 +198,15 @@ def build_blast_db_from_fasta_file(fasta_file, is_protein=False,
         fasta_f.write('%s\n' % line.strip())
     fasta_f.close()
 
+    if cache is not None:
+        try:
+            return build_blast_db_from_fasta_path(fasta_path,
+                                                  is_protein=is_protein,
+                                                  HALT_EXEC=HALT_EXEC,
+                                                  cache=cache)
+        finally:
+            remove(fasta_path)
+
     blast_db, db_filepaths = build_blast_db_from_fasta_path(fasta_path,
                                                             is_protein=is_protein,
                                                             output_dir=None,
@@ -165,7 +219,7 @@ def build_blast_db_from_fasta_file(fasta_file, is_protein=False,
 
 
 def build_blast_db_from_seqs(seqs, is_protein=False, output_dir='./',
-                             HALT_EXEC=False):
+                             HALT_EXEC=False, cache=None):
     """Build blast db from seqs; return db name and list of files created
 
         **If using to create temporary blast databases, you can call
@@ -178,16 +232,27 @@ def build_blast_db_from_seqs(seqs, is_protein=False, output_dir='./',
          (default: current directory)
         HALT_EXEC: halt just before running the formatdb command and
          print the command -- useful for debugging
+        cache: a bfillings.cache.ContentCache in which to keep the database
+         (see build_blast_db_from_fasta_path)
     """
+    fasta = seqs.toFasta()
 
     # Build a temp filepath
     _, tmp_fasta_filepath = mkstemp(prefix='Blast_tmp_db', suffix='.fasta')
     # open the temp file
     tmp_fasta_file = open(tmp_fasta_filepath, 'w')
     # write the sequence collection to file
-    tmp_fasta_file.write(seqs.toFasta())
+    tmp_fasta_file.write(fasta)
     tmp_fasta_file.close()
 
+    if cache is not None:
+        try:
+            return _cached_blast_db(tmp_fasta_filepath,
+                                    md5(fasta).hexdigest(), is_protein,
+                                    cache, HALT_EXEC), []
+        finally:
+            remove(tmp_fasta_filepath)
+
     # build the bast database
     db_name, db_filepaths = build_blast_db_from_fasta_path(tmp_fasta_filepath,
                                                            is_protein=is_protein,
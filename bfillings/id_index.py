@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2013--, biocore development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+#-----------------------------------------------------------------------------
+
+"""Integer indexing of ids for the columnar output parsers
+
+The columnar parsers (sortmerna_hits, rdp_assignments) store sequence ids,
+reference ids and taxon names as integer indices into an IdIndex, so that
+their arrays hold numbers only.
+"""
+
+import numpy as np
+
+
+class IdIndex(object):
+    """Assigns consecutive integer indices to ids, in order of first use
+
+    Ids: list of the ids, by index
+    """
+
+    def __init__(self):
+        self.Ids = []
+        self._index = {}
+
+    def __len__(self):
+        return len(self.Ids)
+
+    def __getitem__(self, i):
+        return self.Ids[i]
+
+    def index(self, seq_id):
+        """Returns the index of seq_id; raises KeyError if unknown"""
+        return self._index[seq_id]
+
+    def indices(self, ids):
+        """Returns an array of the indices of ids, adding unknown ones"""
+        index = self._index
+        known = self.Ids
+        for seq_id in ids:
+            if seq_id not in index:
+                index[seq_id] = len(known)
+                known.append(seq_id)
+        return np.fromiter(map(index.__getitem__, ids), dtype=np.int32,
+                           count=len(ids))
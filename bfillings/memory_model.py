@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2013--, biocore development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+#-----------------------------------------------------------------------------
+
+"""Peak memory estimates for application runs, corrected by measurements
+
+Wrappers that can run an application in several ways (e.g. usearch61's
+cluster_fast or cluster_smallmem, with more or fewer threads) use
+sequence_profile to size their input in one quick pass, estimate the peak
+memory of each way from a simple model of the application, and pick one that
+fits a memory budget.
+
+MemoryModel keeps, in a JSON file shared between runs, the peak memory that
+was actually measured for past estimates of each strategy. Later estimates
+are scaled by the largest measured/estimated ratio among recent runs, so that
+an application that uses more memory than its model says is not run out of
+memory twice.
+"""
+
+import json
+from os import getpid, rename, sysconf
+from os.path import exists
+from threading import Lock
+
+from skbio.parse.sequences import parse_fasta
+
+from bfillings.dereplicate import seq_digest
+
+
+def sequence_profile(seq_path, minlen=0):
+    """Returns a dict describing the sequences in seq_path
+
+    Only sequences of at least minlen bases are counted. The keys are
+    num_seqs, num_uniques (number of distinct sequences), unique_residues
+    (total length of the distinct sequences) and max_len.
+    """
+    digests = set()
+    num_seqs = unique_residues = max_len = 0
+    for label, seq in parse_fasta(seq_path):
+        seq_len = len(seq)
+        if seq_len < minlen:
+            continue
+        num_seqs += 1
+        max_len = max(max_len, seq_len)
+        digest = seq_digest(seq.upper())
+        if digest not in digests:
+            digests.add(digest)
+            unique_residues += seq_len
+    return {'num_seqs': num_seqs,
+            'num_uniques': len(digests),
+            'unique_residues': unique_residues,
+            'max_len': max_len}
+
+
+def physical_memory():
+    """Returns the physical memory of the machine in bytes, or None"""
+    try:
+        return sysconf('SC_PHYS_PAGES') * sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class MemoryModel(object):
+    """Estimates of peak memory, corrected by past measurements
+
+    stats_fp: path of the JSON file the measurements are kept in; if None,
+     measurements are only kept for the life of the object
+    history: number of recent measurements of each strategy that are used
+     to correct its estimates
+    """
+
+    _format_version = 1
+
+    def __init__(self, stats_fp=None, history=20):
+        self.StatsFp = stats_fp
+        self.History = history
+        self._lock = Lock()
+        self._runs = self._load()
+
+    def _load(self):
+        if self.StatsFp is None or not exists(self.StatsFp):
+            return {}
+        try:
+            with open(self.StatsFp) as f:
+                data = json.load(f)
+        except (ValueError, IOError):
+            # a truncated or corrupt file is the same as none
+            return {}
+        if data.get('format_version') != self._format_version:
+            return {}
+        return data['runs']
+
+    def correction(self, strategy):
+        """Returns the factor the estimates of strategy are scaled by
+
+        This is the largest measured/estimated ratio of the recent runs of
+        strategy, or 1.0 if none was recorded.
+        """
+        with self._lock:
+            runs = self._runs.get(strategy, [])
+        ratios = [peak / float(estimate) for estimate, peak in runs
+                  if estimate > 0]
+        return max(ratios) if ratios else 1.0
+
+    def estimate(self, strategy, base_estimate):
+        """Returns base_estimate, in bytes, corrected for strategy"""
+        return int(base_estimate * self.correction(strategy))
+
+    def record(self, strategy, base_estimate, peak_rss):
+        """Records the peak memory measured for a run of strategy
+
+        base_estimate: uncorrected estimate of the run, in bytes
+        peak_rss: measured peak resident set size of the run, in bytes
+
+        Measurements made by other processes since this object was created
+        are merged in before the file is rewritten.
+        """
+        with self._lock:
+            runs = self._load() if self.StatsFp is not None else self._runs
+            strategy_runs = runs.setdefault(strategy, [])
+            strategy_runs.append([int(base_estimate), int(peak_rss)])
+            del strategy_runs[:-self.History]
+            self._runs = runs
+            if self.StatsFp is not None:
+                self._save()
+
+    def _save(self):
+        data = {'format_version': self._format_version,
+                'runs': self._runs}
+        tmp_fp = '%s.%d.tmp' % (self.StatsFp, getpid())
+        try:
+            with open(tmp_fp, 'w') as f:
+                json.dump(data, f, indent=1, sort_keys=True)
+            rename(tmp_fp, self.StatsFp)
+        except (IOError, OSError):
+            # measurements are an optimisation; never fail a run over them
+            pass
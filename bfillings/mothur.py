@@ -24,6 +24,8 @@ from burrito.parameters import ValuedParameter
 from burrito.util import (CommandLineApplication, ResultPath,
                             CommandLineAppResult, ApplicationError)
 
+from bfillings.cache import ContentCache, cache_key, stamped_file_digest
+
 
 def is_empty(line):
     """Returns True empty lines and lines consisting only of whitespace."""
@@ -494,31 +496,26 @@ def parse_mothur_assignments(lines):
         yield seq_id, lineage, conf
 
 
-def mothur_classify_file(
-        query_file, ref_fp, tax_fp, cutoff=None, iters=None, ksize=None,
-        output_fp=None):
-    """Classify a set of sequences using Mothur's naive bayes method
-
-    Dashes are used in Mothur to provide multiple filenames.  A
-    filepath with a dash typically breaks an otherwise valid command
-    in Mothur.  This wrapper script makes a copy of both files, ref_fp
-    and tax_fp, to ensure that the path has no dashes.
+def _write_mothur_reference(ref_fp, tax_fp, ref_file, tax_file):
+    """Writes the copies of ref_fp and tax_fp given to Mothur
 
-    For convenience, we also ensure that each taxon list in the
-    id-to-taxonomy file ends with a semicolon.
+    Taxonomy lines are made to end with a semicolon, and lines of sequences
+    missing from ref_fp are dropped. Returns the (id, sequence) of the first
+    reference sequence, or None if there is none.
     """
     ref_seq_ids = set()
+    first_seq = None
 
     user_ref_file = open(ref_fp)
-    tmp_ref_file = NamedTemporaryFile(suffix=".ref.fa")
     for seq_id, seq in parse_fasta(user_ref_file):
         id_token = seq_id.split()[0]
         ref_seq_ids.add(id_token)
-        tmp_ref_file.write(">%s\n%s\n" % (seq_id, seq))
-    tmp_ref_file.seek(0)
+        ref_file.write(">%s\n%s\n" % (seq_id, seq))
+        if first_seq is None:
+            first_seq = (id_token, seq)
+    user_ref_file.close()
 
     user_tax_file = open(tax_fp)
-    tmp_tax_file = NamedTemporaryFile(suffix=".tax.txt")
     for line in user_tax_file:
         line = line.rstrip()
         if not line:
@@ -530,11 +527,94 @@ def mothur_classify_file(
 
         id_token, _, _ = line.partition("\t")
         if id_token in ref_seq_ids:
-            tmp_tax_file.write(line)
-            tmp_tax_file.write("\n")
-    tmp_tax_file.seek(0)
+            tax_file.write(line)
+            tax_file.write("\n")
+    user_tax_file.close()
+    return first_seq
+
+
+def get_cached_mothur_reference(ref_fp, tax_fp, cache_dir, ksize=None,
+                                max_size=None):
+    """Returns an open cache entry holding a prepared Mothur reference
+
+    The copies of ref_fp and tax_fp made by mothur_classify_file are
+    available as the ReferenceFp and TaxonomyFp attributes of the entry, and
+    are protected from eviction until the entry is released.
+
+    When an entry is built, one reference sequence is classified against
+    it, so that Mothur writes its k-mer database and training tree files
+    (*.8mer, *.tree.train, ...) next to the copies, where later runs find
+    them. Entries are kept in cache_dir, keyed by the md5 of the contents
+    of ref_fp and tax_fp and by ksize; once the files in cache_dir exceed
+    max_size bytes, the least recently used ones are removed (None disables
+    eviction).
+
+    Mothur is given the paths of the copies in cache_dir, so, as with the
+    paths this wrapper avoids, a cache_dir containing a dash raises a
+    ValueError.
+    """
+    if '-' in path.abspath(cache_dir):
+        raise ValueError("Mothur cannot use reference files under %s: the "
+                         "path contains a dash." % cache_dir)
+    cache = ContentCache(cache_dir, max_size)
+    key = cache_key('mothur classify.seqs', stamped_file_digest(ref_fp),
+                    stamped_file_digest(tax_fp), {'ksize': ksize})
+
+    def prepare_reference(build_dir):
+        ref_path = path.join(build_dir, 'reference.fa')
+        tax_path = path.join(build_dir, 'taxonomy.txt')
+        with open(ref_path, 'w') as ref_file:
+            with open(tax_path, 'w') as tax_file:
+                first_seq = _write_mothur_reference(
+                    ref_fp, tax_fp, ref_file, tax_file)
+        if first_seq is None:
+            return
+        params = {"reference": ref_path, "taxonomy": tax_path}
+        if ksize is not None:
+            params["ksize"] = ksize
+        app = MothurClassifySeqs(params, InputHandler='_input_as_lines')
+        result = app(['>%s' % first_seq[0], first_seq[1]])
+        result.cleanUp()
+
+    entry = cache.open_entry(key, prepare_reference)
+    entry.ReferenceFp = path.join(entry.Path, 'reference.fa')
+    entry.TaxonomyFp = path.join(entry.Path, 'taxonomy.txt')
+    return entry
+
 
-    params = {"reference": tmp_ref_file.name, "taxonomy": tmp_tax_file.name}
+def mothur_classify_file(
+        query_file, ref_fp, tax_fp, cutoff=None, iters=None, ksize=None,
+        output_fp=None, ref_cache_dir=None, ref_cache_max_size=None):
+    """Classify a set of sequences using Mothur's naive bayes method
+
+    Dashes are used in Mothur to provide multiple filenames.  A
+    filepath with a dash typically breaks an otherwise valid command
+    in Mothur.  This wrapper script makes a copy of both files, ref_fp
+    and tax_fp, to ensure that the path has no dashes.
+
+    For convenience, we also ensure that each taxon list in the
+    id-to-taxonomy file ends with a semicolon.
+
+    If ref_cache_dir is given, the copies, and the k-mer database and
+    training files Mothur builds from them, are kept there and reused by
+    later calls with the same references (see
+    get_cached_mothur_reference). ref_cache_max_size is the size budget of
+    ref_cache_dir, in bytes.
+    """
+    if ref_cache_dir is not None:
+        entry = get_cached_mothur_reference(
+            ref_fp, tax_fp, ref_cache_dir, ksize, ref_cache_max_size)
+        ref_path, tax_path = entry.ReferenceFp, entry.TaxonomyFp
+    else:
+        entry = None
+        tmp_ref_file = NamedTemporaryFile(suffix=".ref.fa")
+        tmp_tax_file = NamedTemporaryFile(suffix=".tax.txt")
+        _write_mothur_reference(ref_fp, tax_fp, tmp_ref_file, tmp_tax_file)
+        tmp_ref_file.seek(0)
+        tmp_tax_file.seek(0)
+        ref_path, tax_path = tmp_ref_file.name, tmp_tax_file.name
+
+    params = {"reference": ref_path, "taxonomy": tax_path}
     if cutoff is not None:
         params["cutoff"] = cutoff
     if ksize is not None:
@@ -542,12 +622,16 @@ def mothur_classify_file(
     if iters is not None:
         params["iters"] = iters
 
-    app = MothurClassifySeqs(params, InputHandler='_input_as_lines')
-    result = app(query_file)
+    try:
+        app = MothurClassifySeqs(params, InputHandler='_input_as_lines')
+        result = app(query_file)
 
-    # Force evaluation so we can safely clean up files
-    assignments = list(parse_mothur_assignments(result['assignments']))
-    result.cleanUp()
+        # Force evaluation so we can safely clean up files
+        assignments = list(parse_mothur_assignments(result['assignments']))
+        result.cleanUp()
+    finally:
+        if entry is not None:
+            entry.release()
 
     if output_fp is not None:
         f = open(output_fp, "w")
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2013--, biocore development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+#-----------------------------------------------------------------------------
+
+"""Columnar parsing and thresholding of RDP Classifier fixrank assignments
+
+parse_rdp_assignments loads the assignments written by the RDP Classifier in
+fixrank format (every line has a taxon, a rank and a confidence for each of
+the same ranks) into an RdpAssignments object, one fixed-size chunk of lines
+at a time. Taxa are replaced by integer codes and stored with their
+confidences as (sequences x ranks) NumPy arrays, so that the lineages at a
+given min_confidence are found for all sequences at once, and the same
+assignments can be thresholded at several confidences without re-parsing.
+"""
+
+from itertools import islice
+
+import numpy as np
+
+from bfillings.id_index import IdIndex
+
+
+def parse_rdp_assignments(assignment_lines, chunk_size=100000):
+    """Returns an RdpAssignments of the lines of a fixrank assignment file
+
+    assignment_lines: open assignment file, or list of its lines
+    chunk_size: number of lines parsed at a time
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1.")
+    assignments = RdpAssignments()
+    lines = iter(assignment_lines)
+    while True:
+        chunk = [line for line in islice(lines, chunk_size) if line.strip()]
+        if not chunk:
+            break
+        assignments._add_chunk(chunk)
+    assignments._concatenate()
+    return assignments
+
+
+class RdpAssignments(object):
+    """Fixrank RDP Classifier assignments, as columnar arrays
+
+    SeqIds: sequence ids, in file order
+    Ranks: rank names, as given on the first line
+    TaxonNames: IdIndex of the taxon names; Taxa holds their indices
+    Taxa: int32 array of the taxon of each sequence (row) at each rank
+     (column); -1 where there is none
+    Confidences: float64 array of the confidence of each taxon
+
+    As in assign_taxonomy, a leading Root taxon and ranks without a taxon
+    are not part of lineages, and do not end them.
+    """
+
+    def __init__(self):
+        self.SeqIds = []
+        self.Ranks = None
+        self.TaxonNames = IdIndex()
+        self.Taxa = np.zeros((0, 0), dtype=np.int32)
+        self.Confidences = np.zeros((0, 0))
+        self._chunks = []
+
+    def __len__(self):
+        return len(self.SeqIds)
+
+    def _add_chunk(self, lines):
+        """Parses lines, splitting them all at once into one flat list"""
+        num_fields = lines[0].rstrip('\r\n').count('\t') + 1
+        if (num_fields - 2) % 3:
+            raise ValueError(
+                "Expected assignments in a repeating series of (rank, name, "
+                "confidence), received %s" % lines[0].rstrip('\r\n'))
+        data = ''.join(lines)
+        if data.count('\t') != len(lines) * (num_fields - 1):
+            raise ValueError("Lines of fixrank assignments must all have "
+                             "the same number of ranks.")
+        if not data.endswith('\n'):
+            data += '\n'
+        fields = data.replace('\r', '').replace('\n', '\t').split('\t')
+        fields.pop()
+
+        num_ranks = (num_fields - 2) // 3
+        ranks = fields[3:num_fields:3]
+        if self.Ranks is None:
+            self.Ranks = ranks
+        elif len(ranks) != len(self.Ranks):
+            raise ValueError("Lines of fixrank assignments must all have "
+                             "the same number of ranks.")
+
+        taxa = np.empty((len(lines), num_ranks), dtype=np.int32)
+        confidences = np.empty((len(lines), num_ranks))
+        for rank in range(num_ranks):
+            offset = 2 + 3 * rank
+            names = [name.strip('"') for name in
+                     fields[offset::num_fields]]
+            codes = self.TaxonNames.indices(names)
+            codes[np.array(names) == ''] = -1
+            taxa[:, rank] = codes
+            confidences[:, rank] = np.array(
+                fields[offset + 2::num_fields]).astype(np.float64)
+        try:
+            root = self.TaxonNames.index('Root')
+        except KeyError:
+            root = None
+        if num_ranks and root is not None:
+            taxa[taxa[:, 0] == root, 0] = -1
+
+        self.SeqIds.extend(fields[0::num_fields])
+        self._chunks.append((taxa, confidences))
+
+    def _concatenate(self):
+        if self._chunks:
+            self.Taxa = np.concatenate([t for t, _ in self._chunks])
+            self.Confidences = np.concatenate([c for _, c in self._chunks])
+        self._chunks = []
+
+    def depths(self, min_confidence):
+        """Returns the number of leading ranks that pass min_confidence
+
+        Ranks without a taxon always pass.
+        """
+        passes = (self.Confidences >= min_confidence) | (self.Taxa == -1)
+        num_ranks = passes.shape[1]
+        return np.where(passes.all(axis=1), num_ranks,
+                        passes.argmin(axis=1))
+
+    def lineages(self, min_confidence):
+        """Yields (seq_id, lineage, confidence) for each sequence
+
+        lineage is the ';'-joined taxa down to the last rank that passes
+        min_confidence, and confidence the confidence of that rank;
+        sequences with no such rank are 'Unclassified', with confidence 1.0.
+        """
+        taxa = self.Taxa
+        if not len(self):
+            return
+        depths = self.depths(min_confidence)
+        in_lineage = (taxa != -1) & \
+            (np.arange(taxa.shape[1]) < depths[:, np.newaxis])
+        classified = in_lineage.any(axis=1)
+        last = taxa.shape[1] - 1 - in_lineage[:, ::-1].argmax(axis=1)
+        confidences = self.Confidences[np.arange(len(taxa)), last]
+
+        names = self.TaxonNames
+        joined = {}
+        for i, seq_id in enumerate(self.SeqIds):
+            if not classified[i]:
+                yield seq_id, 'Unclassified', 1.0
+                continue
+            codes = tuple(taxa[i, :depths[i]].tolist())
+            lineage = joined.get(codes)
+            if lineage is None:
+                lineage = ';'.join([names[c] for c in codes if c != -1])
+                joined[codes] = lineage
+            yield seq_id, lineage, float(confidences[i])
+
+    def to_dict(self, min_confidence, id_map=None, unassignable=()):
+        """Returns a dict of seq_id: (lineage, confidence)
+
+        id_map: dict mapping the ids in the assignment file to the ids to
+         report, as built by assign_taxonomy
+        unassignable: ids of sequences the classifier rejected, reported as
+         ('Unassignable', 1.0) unless they were also assigned
+        """
+        assignments = dict((seq_id, ('Unassignable', 1.0))
+                           for seq_id in unassignable)
+        for seq_id, lineage, confidence in self.lineages(min_confidence):
+            if id_map is not None:
+                seq_id = id_map[seq_id]
+            assignments[seq_id] = (lineage, confidence)
+        return assignments
+
+    def write(self, output_f, min_confidence, id_map=None, unassignable=()):
+        """Writes the assignments at min_confidence to the open output_f
+
+        Lines are written as they are made, in the format of
+        assign_taxonomy. See to_dict for id_map and unassignable.
+        """
+        assigned = set()
+        for seq_id, lineage, confidence in self.lineages(min_confidence):
+            if id_map is not None:
+                seq_id = id_map[seq_id]
+            assigned.add(seq_id)
+            output_f.write('%s\t%s\t%1.3f\n' % (seq_id, lineage, confidence))
+        for seq_id in unassignable:
+            if seq_id not in assigned:
+                output_f.write('%s\tUnassignable\t%1.3f\n' % (seq_id, 1.0))
@@ -11,12 +11,19 @@
 """
 
 
+import atexit
+from hashlib import md5
+from itertools import islice
 import os.path
 import re
-from os import environ, getenv
+import sys
+from os import close, environ, getenv, pathsep, remove
 from optparse import OptionParser
 from shutil import rmtree
+from subprocess import Popen, PIPE
 import tempfile
+from threading import Lock, Semaphore, Thread, Timer
+from time import time
 import warnings
 
 from burrito.parameters import ValuedParameter
@@ -26,6 +33,59 @@ from burrito.util import (CommandLineApplication, FilePath, ResultPath,
 
 from burrito.util import which
 
+from bfillings.cache import ContentCache, cache_key, stamped_file_digest
+from bfillings.rdp_assignments import parse_rdp_assignments
+
+# Default directory of the compiled RDP worker class
+RDP_WORKER_CACHE_DIR = os.path.join(tempfile.gettempdir(),
+                                    'bfillings_rdp_worker')
+
+# Java side of RdpClassifierWorker: runs the classifier's command line
+# main class once per request line read from stdin, in the same JVM, and
+# answers each request with a status line on stdout. If the classifier
+# calls System.exit, the JVM exits instead of answering; the Python side
+# then reads the exit status (see RdpClassifierWorker.classify).
+_RDP_WORKER_SOURCE = """\
+import java.io.*;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+
+public class BfillingsRdpWorker {
+    public static void main(String[] args) throws Exception {
+        Method classifierMain =
+            Class.forName(args[0]).getMethod("main", String[].class);
+        BufferedReader requests =
+            new BufferedReader(new InputStreamReader(System.in));
+        PrintStream replies = System.out;
+        String request;
+        while ((request = requests.readLine()) != null) {
+            // query, output, messages, format[, training properties]
+            String[] fields = request.split("\\t");
+            String[] classifierArgs = fields.length > 4 ?
+                new String[] {"-q", fields[0], "-o", fields[1],
+                              "-f", fields[3], "-t", fields[4]} :
+                new String[] {"-q", fields[0], "-o", fields[1],
+                              "-f", fields[3]};
+            PrintStream messages =
+                new PrintStream(new FileOutputStream(fields[2]), true);
+            String status = "OK";
+            System.setOut(messages);
+            try {
+                classifierMain.invoke(null, (Object) classifierArgs);
+            } catch (InvocationTargetException e) {
+                status = "ERROR\\t" + e.getCause();
+            } finally {
+                System.out.flush();
+                System.setOut(replies);
+                messages.close();
+            }
+            replies.println(status.replace('\\n', ' '));
+            replies.flush();
+        }
+    }
+}
+"""
+
 
 class RdpClassifier(CommandLineApplication):
 
@@ -350,6 +410,220 @@ class RdpTrainer(RdpClassifier):
         return result
 
 
+def _compile_rdp_worker(cache_dir=None):
+    """Returns the directory holding the compiled RDP worker class
+
+    The class is compiled with javac once, and kept in a ContentCache in
+    cache_dir (default: RDP_WORKER_CACHE_DIR).
+    """
+    if not which('javac'):
+        raise ApplicationNotFoundError(
+            "Cannot find javac, which is needed to compile the persistent "
+            "RDP classifier worker. Is a JDK installed? Is it in your path?")
+    cache = ContentCache(cache_dir or RDP_WORKER_CACHE_DIR)
+
+    def compile_worker(build_dir):
+        source_fp = os.path.join(build_dir, 'BfillingsRdpWorker.java')
+        with open(source_fp, 'w') as source_f:
+            source_f.write(_RDP_WORKER_SOURCE)
+        javac = Popen(['javac', '-d', build_dir, source_fp], stdout=PIPE,
+                      stderr=PIPE)
+        stdout, stderr = javac.communicate()
+        if javac.returncode != 0:
+            raise ApplicationError(
+                "Failed to compile the RDP classifier worker:\n%s%s"
+                % (stdout, stderr))
+
+    return cache.get(cache_key('javac', _RDP_WORKER_SOURCE), compile_worker)
+
+
+class RdpClassifierWorker(object):
+    """A long-lived RDP Classifier JVM, classifying batches of sequences
+
+    training_data_fp: training properties file (-t); None for the
+     classifier's default training set
+    max_memory: maximum heap size of the JVM (-Xmx, default 1000m)
+    idle_timeout: seconds after which an unused worker stops its JVM; it is
+     started again on the next batch. None keeps it running until closed.
+    tmp_dir: directory for temporary files
+
+    The JVM is started on the first batch. Each batch is handed to the
+    classifier's command line entry point in the running JVM, so that JVM
+    start-up and class loading are paid once per worker rather than once
+    per batch. The training model is loaded by the classifier for each
+    batch. If the classifier calls System.exit(0) after a batch, that batch
+    succeeds but the JVM has to be started again for the next one, which
+    makes the worker no faster than running the classifier directly; such
+    exits are counted in BatchExits, and the first one issues a
+    RuntimeWarning. Use get_rdp_worker to share workers.
+    """
+
+    ClassifierClass = 'edu.msu.cme.rdp.classifier.ClassifierCmd'
+    WorkerClass = 'BfillingsRdpWorker'
+
+    def __init__(self, training_data_fp=None, max_memory=None,
+                 idle_timeout=600, tmp_dir=None):
+        if training_data_fp is not None:
+            training_data_fp = os.path.abspath(training_data_fp)
+        self.TrainingDataFp = training_data_fp
+        self.MaxMemory = max_memory or \
+            RdpClassifier._jvm_parameters['-Xmx'].Value
+        self.IdleTimeout = idle_timeout
+        self.TmpDir = tmp_dir or tempfile.gettempdir()
+        self._lock = Lock()
+        self._process = None
+        self._stderr = None
+        self._timer = None
+        self._last_used = time()
+        self.BatchExits = 0
+
+    def _start(self):
+        # checks for java and the RDP jar file
+        jar_fp = os.path.abspath(RdpClassifier()._get_jar_fp())
+        class_dir = _compile_rdp_worker()
+        self._stderr = tempfile.TemporaryFile(dir=self.TmpDir)
+        self._process = Popen(
+            ['java', '-Xmx%s' % self.MaxMemory,
+             '-cp', pathsep.join([jar_fp, class_dir]),
+             self.WorkerClass, self.ClassifierClass],
+            stdin=PIPE, stdout=PIPE, stderr=self._stderr)
+
+    def _stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._process is not None:
+            try:
+                self._process.stdin.close()
+            except IOError:
+                pass
+            exit_status = self._process.wait()
+            self._process = None
+        else:
+            exit_status = None
+        if self._stderr is not None:
+            self._stderr.close()
+            self._stderr = None
+        return exit_status
+
+    def _stderr_text(self):
+        if self._stderr is None:
+            return ''
+        self._stderr.seek(0)
+        return self._stderr.read()
+
+    @property
+    def IsRunning(self):
+        """True if the JVM of the worker is running"""
+        return self._process is not None and self._process.poll() is None
+
+    def classify(self, query_fp, assignments_fp, fixrank=True):
+        """Classifies the sequences in query_fp
+
+        The assignments are written to assignments_fp, in fixrank or allrank
+        format. Returns the list of lines the classifier printed, which
+        report the sequences that could not be classified.
+        """
+        fd, messages_fp = tempfile.mkstemp(prefix='RdpMessages_',
+                                           suffix='.txt', dir=self.TmpDir)
+        close(fd)
+        request = [os.path.abspath(query_fp), os.path.abspath(assignments_fp),
+                   messages_fp, 'fixrank' if fixrank else 'allrank']
+        if self.TrainingDataFp is not None:
+            request.append(self.TrainingDataFp)
+
+        try:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if not self.IsRunning:
+                    self._stop()
+                    self._start()
+                try:
+                    self._process.stdin.write('\t'.join(request) + '\n')
+                    self._process.stdin.flush()
+                    reply = self._process.stdout.readline()
+                except IOError:
+                    reply = ''
+                if not reply:
+                    stderr = self._stderr_text()
+                    # a classifier that calls System.exit(0) once done
+                    # ends the JVM with the batch; the next one restarts it
+                    if self._stop() != 0:
+                        raise ApplicationError(
+                            "The RDP classifier worker exited unexpectedly:"
+                            "\n%s" % stderr)
+                    self.BatchExits += 1
+                    if self.BatchExits == 1:
+                        warnings.warn(
+                            "The RDP classifier exited after classifying %s, "
+                            "so its JVM is started again for every batch."
+                            % query_fp, RuntimeWarning)
+                    reply = 'OK\n'
+                self._last_used = time()
+                if self.IdleTimeout is not None:
+                    self._timer = Timer(self.IdleTimeout, self._close_if_idle)
+                    self._timer.daemon = True
+                    self._timer.start()
+            if reply.startswith('ERROR'):
+                raise ApplicationError(
+                    "The RDP classifier failed on %s: %s"
+                    % (query_fp, reply.rstrip('\n').split('\t', 1)[-1]))
+            with open(messages_fp, 'U') as messages_f:
+                return messages_f.readlines()
+        finally:
+            remove(messages_fp)
+
+    def _close_if_idle(self):
+        with self._lock:
+            if self.IdleTimeout is not None and \
+                    time() - self._last_used >= self.IdleTimeout:
+                self._stop()
+
+    def close(self):
+        """Stops the JVM of the worker"""
+        with self._lock:
+            self._stop()
+
+
+# workers shared by assign_taxonomy calls, by training set and heap size
+_rdp_workers = {}
+_rdp_workers_lock = Lock()
+
+
+def get_rdp_worker(training_data_fp=None, max_memory=None,
+                   idle_timeout=600, tmp_dir=None):
+    """Returns the shared RdpClassifierWorker for a training set
+
+    One worker is kept per training properties file and maximum heap size,
+    and reused by later calls. Workers stop their JVM after idle_timeout
+    seconds without use, and when the interpreter exits.
+    """
+    if training_data_fp is not None:
+        training_data_fp = os.path.abspath(training_data_fp)
+    key = (training_data_fp, max_memory)
+    with _rdp_workers_lock:
+        worker = _rdp_workers.get(key)
+        if worker is None:
+            worker = RdpClassifierWorker(training_data_fp, max_memory,
+                                         idle_timeout, tmp_dir)
+            _rdp_workers[key] = worker
+        else:
+            worker.IdleTimeout = idle_timeout
+    return worker
+
+
+@atexit.register
+def close_rdp_workers():
+    """Stops the JVMs of all the shared RDP classifier workers"""
+    with _rdp_workers_lock:
+        workers = _rdp_workers.values()
+        _rdp_workers.clear()
+    for worker in workers:
+        worker.close()
+
+
 def parse_command_line_parameters(argv=None):
     """ Parses command line arguments """
     usage =\
@@ -376,13 +650,17 @@ def parse_command_line_parameters(argv=None):
 
 def assign_taxonomy(
         data, min_confidence=0.80, output_fp=None, training_data_fp=None,
-        fixrank=True, max_memory=None, tmp_dir=None):
+        fixrank=True, max_memory=None, tmp_dir=None, persistent=False,
+        idle_timeout=600):
     """Assign taxonomy to each sequence in data with the RDP classifier
 
         data: open fasta file object or list of fasta lines
         confidence: minimum support threshold to assign taxonomy to a sequence
         output_fp: path to write output; if not provided, result will be
          returned in a dict of {seq_id:(taxonomy_assignment,confidence)}
+        persistent: if True, classify with the shared RdpClassifierWorker of
+         the training set (see get_rdp_worker) instead of starting a new
+         JVM; its JVM is stopped after idle_timeout seconds without use
     """
     # Going to iterate through this twice in succession, best to force
     # evaluation now
@@ -394,48 +672,85 @@ def assign_taxonomy(
     for seq_id, seq in parse_fasta(data):
         seq_id_lookup[seq_id.split()[0]] = seq_id
 
-    app_kwargs = {}
-    if tmp_dir is not None:
-        app_kwargs['TmpDir'] = tmp_dir
-    app = RdpClassifier(**app_kwargs)
-
-    if max_memory is not None:
-        app.Parameters['-Xmx'].on(max_memory)
-
     temp_output_file = tempfile.NamedTemporaryFile(
         prefix='RdpAssignments_', suffix='.txt', dir=tmp_dir)
-    app.Parameters['-o'].on(temp_output_file.name)
-    if training_data_fp is not None:
-        app.Parameters['-t'].on(training_data_fp)
 
-    if fixrank:
-        app.Parameters['-f'].on('fixrank')
+    if persistent:
+        worker = get_rdp_worker(training_data_fp, max_memory, idle_timeout,
+                                tmp_dir)
+        query_file = tempfile.NamedTemporaryFile(
+            prefix='RdpQuery_', suffix='.fasta', dir=tmp_dir)
+        query_file.write('\n'.join(line.rstrip('\n') for line in data))
+        query_file.flush()
+        stdout_lines = worker.classify(query_file.name,
+                                       temp_output_file.name, fixrank)
+        query_file.close()
+        assignment_lines = open(temp_output_file.name, 'U')
     else:
-        app.Parameters['-f'].on('allrank')
+        app_kwargs = {}
+        if tmp_dir is not None:
+            app_kwargs['TmpDir'] = tmp_dir
+        app = RdpClassifier(**app_kwargs)
+
+        if max_memory is not None:
+            app.Parameters['-Xmx'].on(max_memory)
 
-    app_result = app(data)
+        app.Parameters['-o'].on(temp_output_file.name)
+        if training_data_fp is not None:
+            app.Parameters['-t'].on(training_data_fp)
+
+        if fixrank:
+            app.Parameters['-f'].on('fixrank')
+        else:
+            app.Parameters['-f'].on('allrank')
 
-    assignments = {}
+        app_result = app(data)
+        stdout_lines = app_result['StdOut']
+        assignment_lines = app_result['Assignments']
 
     # ShortSequenceException messages are written to stdout
     # Tag these ID's as unassignable
-    for line in app_result['StdOut']:
+    unassignable = []
+    for line in stdout_lines:
         excep = parse_rdp_exception(line)
         if excep is not None:
             _, rdp_id = excep
-            orig_id = seq_id_lookup[rdp_id]
-            assignments[orig_id] = ('Unassignable', 1.0)
-
-    for line in app_result['Assignments']:
-        rdp_id, direction, taxa = parse_rdp_assignment(line)
-        if taxa[0][0] == "Root":
-            taxa = taxa[1:]
-        orig_id = seq_id_lookup[rdp_id]
-        lineage, confidence = get_rdp_lineage(taxa, min_confidence)
-        if lineage:
-            assignments[orig_id] = (';'.join(lineage), confidence)
+            unassignable.append(seq_id_lookup[rdp_id])
+
+    try:
+        if fixrank:
+            # every line has the same ranks: parse into arrays, and write
+            # straight from them
+            rdp_assignments = parse_rdp_assignments(assignment_lines)
         else:
-            assignments[orig_id] = ('Unclassified', 1.0)
+            assignments = dict((orig_id, ('Unassignable', 1.0))
+                               for orig_id in unassignable)
+            for line in assignment_lines:
+                rdp_id, direction, taxa = parse_rdp_assignment(line)
+                if taxa[0][0] == "Root":
+                    taxa = taxa[1:]
+                orig_id = seq_id_lookup[rdp_id]
+                lineage, confidence = get_rdp_lineage(taxa, min_confidence)
+                if lineage:
+                    assignments[orig_id] = (';'.join(lineage), confidence)
+                else:
+                    assignments[orig_id] = ('Unclassified', 1.0)
+    finally:
+        assignment_lines.close()
+
+    if fixrank:
+        if output_fp:
+            try:
+                output_file = open(output_fp, 'w')
+            except OSError:
+                raise OSError(
+                    "Can't open output file for writing: %s" % output_fp)
+            rdp_assignments.write(output_file, min_confidence,
+                                  seq_id_lookup, unassignable)
+            output_file.close()
+            return None
+        return rdp_assignments.to_dict(min_confidence, seq_id_lookup,
+                                       unassignable)
 
     if output_fp:
         try:
@@ -452,6 +767,118 @@ def assign_taxonomy(
         return assignments
 
 
+def _fasta_chunks(data, chunk_size):
+    """Yields lists of fasta lines holding chunk_size sequences of data
+
+    data: open fasta file object or list of fasta lines
+    """
+    records = parse_fasta(data)
+    while True:
+        chunk = []
+        for label, seq in islice(records, chunk_size):
+            chunk.append('>%s' % label)
+            chunk.append(seq)
+        if not chunk:
+            break
+        yield chunk
+
+
+def _split_jvm_memory(max_memory, num_jvms):
+    """Returns the -Xmx value of each of num_jvms sharing max_memory
+
+    max_memory: JVM memory size, e.g. '4000m' or '8g'
+    """
+    match = re.match(r'^(\d+)([kKmMgG]?)$', str(max_memory))
+    if match is None:
+        raise ValueError("Invalid JVM memory size: %s" % max_memory)
+    kilobytes = int(match.group(1)) * \
+        {'': 1. / 1024, 'k': 1, 'm': 1024, 'g': 1024 ** 2}[
+            match.group(2).lower()]
+    share = int(kilobytes // num_jvms)
+    if share < 1024:
+        raise ValueError("max_memory of %s is too small for %d JVMs."
+                         % (max_memory, num_jvms))
+    return '%dm' % (share // 1024)
+
+
+def assign_taxonomy_chunked(
+        data, output_fp, min_confidence=0.80, training_data_fp=None,
+        fixrank=True, max_memory=None, tmp_dir=None, chunk_size=10000,
+        workers=1):
+    """Assign taxonomy to the sequences in data, a chunk at a time
+
+        data: open fasta file object or list of fasta lines
+        output_fp: path to write the assignments to, in the format of
+         assign_taxonomy
+        chunk_size: number of sequences classified by each RDP classifier
+         run
+        workers: number of RDP classifier runs (JVMs) at once
+        max_memory: total maximum heap size of the concurrent JVMs (e.g.
+         '8g'), split evenly between them; if None, each JVM gets the
+         default of RdpClassifier
+
+    The input is read chunk_size sequences at a time, and only while fewer
+    than workers chunks are being classified, so only the sequences (and
+    identifier lookup tables) of the chunks in flight are held in memory.
+    Assignments are appended to output_fp as each chunk finishes, so lines
+    are in no particular order. Other parameters are as for
+    assign_taxonomy.
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1.")
+    if workers < 1:
+        raise ValueError("workers must be at least 1.")
+    jvm_memory = None
+    if max_memory is not None:
+        jvm_memory = _split_jvm_memory(max_memory, workers)
+
+    try:
+        output_file = open(output_fp, 'w')
+    except (IOError, OSError):
+        raise OSError("Can't open output file for writing: %s" % output_fp)
+
+    slots = Semaphore(workers)
+    output_lock = Lock()
+    errors = []
+    running = []
+
+    def classify(chunk):
+        try:
+            assignments = assign_taxonomy(
+                chunk, min_confidence=min_confidence,
+                training_data_fp=training_data_fp, fixrank=fixrank,
+                max_memory=jvm_memory, tmp_dir=tmp_dir)
+            lines = ['%s\t%s\t%1.3f\n' % (seq_id, lineage, confidence)
+                     for seq_id, (lineage, confidence)
+                     in assignments.iteritems()]
+            with output_lock:
+                output_file.writelines(lines)
+        except BaseException:
+            with output_lock:
+                errors.append(sys.exc_info())
+        finally:
+            slots.release()
+
+    try:
+        for chunk in _fasta_chunks(data, chunk_size):
+            # wait for a free worker before reading further
+            slots.acquire()
+            if errors:
+                break
+            worker = Thread(target=classify, args=(chunk,))
+            worker.daemon = True
+            worker.start()
+            running = [w for w in running if w.is_alive()] + [worker]
+        for worker in running:
+            worker.join()
+    finally:
+        output_file.close()
+
+    if errors:
+        error_type, error, traceback = errors[0]
+        raise error_type, error, traceback
+
+
 def train_rdp_classifier(
         training_seqs_file, taxonomy_file, model_output_dir, max_memory=None,
         tmp_dir=None):
@@ -485,10 +912,67 @@ def train_rdp_classifier(
     return app(training_seqs_file)
 
 
+def _file_object_digest(file_obj):
+    """Returns the md5 digest of the contents of file_obj
+
+    Files on disk are digested by path (see stamped_file_digest); other
+    file-like objects are read, then rewound.
+    """
+    name = getattr(file_obj, 'name', None)
+    if isinstance(name, basestring) and os.path.isfile(name):
+        return stamped_file_digest(name)
+    digest = md5()
+    for block in iter(lambda: file_obj.read(2 ** 20), ''):
+        digest.update(block)
+    file_obj.seek(0)
+    return digest.hexdigest()
+
+
+def get_cached_rdp_model(
+        training_seqs_file, taxonomy_file, cache_dir, max_memory=None,
+        max_size=None, tmp_dir=None):
+    """Returns an open cache entry holding an RDP model of the training data
+
+        training_seqs_file, taxonomy_file: file-like objects used to
+            train the RDP Classifier (see train_rdp_classifier)
+        cache_dir: directory of the model store
+        max_size: size budget of the store in bytes; least recently used
+            models are removed when it is exceeded (None: no limit)
+
+    The model's properties file, to be passed to assign_taxonomy as
+    training_data_fp, is the PropertiesFp attribute of the entry. The model
+    is protected from eviction until the entry is released.
+
+    Models are keyed by the md5 of the training sequences and of the
+    taxonomy, and by the training parameters, so the same model is only
+    trained once. It is trained in a temporary directory that is renamed
+    into place when complete, and concurrent callers training the same
+    model wait for the first one to finish.
+    """
+    params = dict((name, RdpTrainer._parameters[name].Value) for name in
+                  ('training_set_id', 'taxonomy_version',
+                   'modification_info'))
+    params['TrainingClass'] = RdpTrainer.TrainingClass
+    key = cache_key('RdpTrainer', _file_object_digest(training_seqs_file),
+                    _file_object_digest(taxonomy_file), params)
+
+    def train_model(build_dir):
+        training_results = train_rdp_classifier(
+            training_seqs_file, taxonomy_file, build_dir,
+            max_memory=max_memory, tmp_dir=tmp_dir)
+        for name in 'bergeyTree', 'probabilityList', 'probabilityIndex', \
+                'wordPrior', 'properties':
+            training_results[name].close()
+
+    entry = ContentCache(cache_dir, max_size).open_entry(key, train_model)
+    entry.PropertiesFp = os.path.join(entry.Path, RdpTrainer.PropertiesFile)
+    return entry
+
+
 def train_rdp_classifier_and_assign_taxonomy(
         training_seqs_file, taxonomy_file, seqs_to_classify, min_confidence=0.80,
         model_output_dir=None, classification_output_fp=None, max_memory=None,
-        tmp_dir=None):
+        tmp_dir=None, model_cache_dir=None, model_cache_max_size=None):
     """ Train RDP Classifier and assign taxonomy in one fell swoop
 
     The file objects training_seqs_file and taxonomy_file are used to
@@ -504,7 +988,24 @@ def train_rdp_classifier_and_assign_taxonomy(
     The results are saved to classification_output_fp if provided,
     otherwise a dict of {seq_id:(taxonomy_assignment,confidence)} is
     returned.
+
+    If model_cache_dir is provided (and model_output_dir is not), the
+    model is taken from the model store in that directory, and trained
+    into it if missing, instead of being trained into a temporary
+    directory (see get_cached_rdp_model). model_cache_max_size is the
+    size budget of the store in bytes.
     """
+    if model_output_dir is None and model_cache_dir is not None:
+        with get_cached_rdp_model(
+                training_seqs_file, taxonomy_file, model_cache_dir,
+                max_memory=max_memory, max_size=model_cache_max_size,
+                tmp_dir=tmp_dir) as model:
+            return assign_taxonomy(
+                seqs_to_classify, min_confidence=min_confidence,
+                output_fp=classification_output_fp,
+                training_data_fp=model.PropertiesFp, max_memory=max_memory,
+                fixrank=False, tmp_dir=tmp_dir)
+
     if model_output_dir is None:
         training_dir = tempfile.mkdtemp(prefix='RdpTrainer_', dir=tmp_dir)
     else:
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2013--, biocore development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+#-----------------------------------------------------------------------------
+
+"""Columnar parsing of SortMeRNA alignment files
+
+SortmernaHits loads the alignments written by sortmerna_map (--blast 1 to 3
+tabular output, or SAM output) into NumPy structured arrays of HIT_DTYPE, one
+fixed-size chunk of lines at a time. Read and reference ids are replaced by
+integer indices, and each hit records the byte offset of its line in the
+file, from which its CIGAR string can be fetched when needed, so that large
+alignment files can be filtered without building a Python object per hit.
+
+filter_hits, best_hits and otu_map work on such arrays with vectorised
+operations.
+"""
+
+from itertools import compress, islice
+import re
+
+import numpy as np
+
+from bfillings.id_index import IdIndex
+
+HIT_DTYPE = np.dtype([('query', np.int32),
+                      ('subject', np.int32),
+                      ('pid', np.float32),
+                      ('evalue', np.float64),
+                      ('bitscore', np.float32),
+                      ('coverage', np.float32),
+                      ('offset', np.int64)])
+
+_cigar_re = re.compile(r'(\d+)([MIDNSHP=X])')
+
+
+def _line_layout(data):
+    """Returns the start offset and the number of tabs of each line of data
+
+    data: text ending with a newline
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(buf == ord('\n'))
+    starts = np.r_[0, ends[:-1] + 1]
+    tabs_before = np.searchsorted(np.flatnonzero(buf == ord('\t')), ends)
+    return starts, np.diff(np.r_[0, tabs_before])
+
+
+def _cigar_lengths(cigar):
+    """Returns the (query aligned, alignment, read) lengths of a CIGAR"""
+    aligned = columns = read = 0
+    for length, op in _cigar_re.findall(cigar):
+        length = int(length)
+        if op in 'M=XI':
+            aligned += length
+            read += length
+        elif op in 'SH':
+            read += length
+        if op in 'M=XID':
+            columns += length
+    return aligned, columns, read
+
+
+class SortmernaHits(object):
+    """Parser of SortMeRNA alignment files into structured arrays
+
+    fmt: 'blast' for the tabular output (--blast 1, 2 or 3), 'sam' for the
+     SAM output
+    chunk_size: number of lines parsed at a time
+
+    Read and reference ids are indexed in QueryIds and SubjectIds, which are
+    shared by everything parsed with the same SortmernaHits, so that arrays
+    from several files can be combined.
+
+    The columns of the arrays (HIT_DTYPE) are the read and reference
+    indices, the percent identity, the E-value, the bit score, the percent
+    query coverage and the byte offset of the line of the hit. --blast 1
+    and 2 output has no coverage, and SAM output has no E-value; those
+    columns are NaN. For SAM output, the bit score column holds the
+    alignment score (AS tag), and the identity and coverage are computed
+    from the CIGAR string and the NM tag.
+
+    Reads without alignment (NULL alignments of --print_all_reads, or
+    unmapped SAM records) are skipped.
+    """
+
+    Formats = ('blast', 'sam')
+
+    def __init__(self, fmt='blast', chunk_size=100000):
+        if fmt not in self.Formats:
+            raise ValueError("Unknown alignment format: %s" % fmt)
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1.")
+        self.Format = fmt
+        self.ChunkSize = chunk_size
+        self.QueryIds = IdIndex()
+        self.SubjectIds = IdIndex()
+
+    def iter_chunks(self, alignments_fp):
+        """Yields arrays of the hits in alignments_fp, a chunk at a time"""
+        parse_chunk = getattr(self, '_parse_%s' % self.Format)
+        offset = 0
+        with open(alignments_fp, 'rb') as f:
+            while True:
+                lines = list(islice(f, self.ChunkSize))
+                if not lines:
+                    break
+                data = ''.join(lines)
+                if not data.endswith('\n'):
+                    data += '\n'
+                starts, tabs = _line_layout(data)
+                hits = parse_chunk(lines, data, starts + offset, tabs)
+                offset += len(data)
+                if len(hits):
+                    yield hits
+
+    def read(self, alignments_fp, min_pid=None, min_coverage=None,
+             max_evalue=None, best=False):
+        """Returns an array of the hits in alignments_fp
+
+        The hits are filtered (see filter_hits) and, if best is True,
+        reduced to the best hit of each read (see best_hits), one chunk at a
+        time, so only the retained hits are held in memory at once.
+        """
+        retained = []
+        for hits in self.iter_chunks(alignments_fp):
+            hits = filter_hits(hits, min_pid, min_coverage, max_evalue)
+            retained.append(best_hits(hits) if best else hits)
+        if not retained:
+            return np.zeros(0, dtype=HIT_DTYPE)
+        hits = np.concatenate(retained)
+        # the hits of a read can span chunks; earlier hits win ties
+        return best_hits(hits) if best else hits
+
+    def cigar(self, alignments_fp, offset):
+        """Returns the CIGAR string of the hit at offset in alignments_fp
+
+        Returns None if the line has no CIGAR string (--blast 1 output).
+        """
+        with open(alignments_fp, 'rb') as f:
+            f.seek(offset)
+            fields = f.readline().rstrip('\r\n').split('\t')
+        column = 12 if self.Format == 'blast' else 5
+        if len(fields) <= column:
+            return None
+        return fields[column]
+
+    def _hits(self, query_ids, subject_ids, offsets):
+        """Returns an array of hits, with the ids and offsets filled in"""
+        hits = np.empty(len(offsets), dtype=HIT_DTYPE)
+        hits['query'] = self.QueryIds.indices(query_ids)
+        hits['subject'] = self.SubjectIds.indices(subject_ids)
+        hits['offset'] = offsets
+        return hits
+
+    def _parse_blast(self, lines, data, offsets, tabs):
+        """Parses a chunk of tabular alignments
+
+        The lines of a chunk are split all at once into one flat list of
+        fields, from which each column is a slice.
+        """
+        # all hits have at least the 12 m8 columns
+        kept = np.flatnonzero(tabs >= 11)
+        if not len(kept):
+            return np.zeros(0, dtype=HIT_DTYPE)
+        num_columns = tabs[kept].min() + 1
+        if len(kept) == len(lines) and tabs.max() + 1 == num_columns:
+            fields = data.replace('\r', '').replace('\n', '\t').split('\t')
+            fields.pop()
+        else:
+            fields = []
+            for i in kept:
+                fields.extend(lines[i].rstrip('\r\n').split('\t')[
+                    :num_columns])
+
+        def column(i, dtype):
+            values = fields[i::num_columns]
+            return np.fromiter(map(float, values), dtype=dtype,
+                               count=len(values))
+
+        # skip the NULL alignments of reads without hits
+        subjects = fields[1::num_columns]
+        aligned = np.array(subjects) != '*'
+        if not aligned.any():
+            return np.zeros(0, dtype=HIT_DTYPE)
+        queries = fields[0::num_columns]
+        if not aligned.all():
+            queries = list(compress(queries, aligned))
+            subjects = list(compress(subjects, aligned))
+        hits = self._hits(queries, subjects, offsets[kept][aligned])
+        hits['pid'] = column(2, np.float32)[aligned]
+        hits['evalue'] = column(10, np.float64)[aligned]
+        hits['bitscore'] = column(11, np.float32)[aligned]
+        if num_columns > 13:
+            hits['coverage'] = column(13, np.float32)[aligned]
+        else:
+            hits['coverage'] = np.nan
+        return hits
+
+    def _parse_sam(self, lines, data, offsets, tabs):
+        rows = []
+        kept = []
+        pids = []
+        coverages = []
+        scores = []
+        for i, line in enumerate(lines):
+            if line.startswith('@'):
+                continue
+            fields = line.rstrip('\r\n').split('\t')
+            if len(fields) < 11 or fields[2] == '*' or \
+                    int(fields[1]) & 4:
+                continue
+            aligned, alignment_columns, read = _cigar_lengths(fields[5])
+            edits = score = None
+            for tag in fields[11:]:
+                if tag.startswith('NM:i:'):
+                    edits = int(tag[5:])
+                elif tag.startswith('AS:i:'):
+                    score = int(tag[5:])
+            if edits is None or not alignment_columns:
+                pids.append(np.nan)
+            else:
+                pids.append(100.0 * (alignment_columns - edits) /
+                            alignment_columns)
+            coverages.append(100.0 * aligned / read if read else np.nan)
+            scores.append(np.nan if score is None else score)
+            rows.append(fields)
+            kept.append(i)
+        if not rows:
+            return np.zeros(0, dtype=HIT_DTYPE)
+        hits = self._hits([fields[0] for fields in rows],
+                          [fields[2] for fields in rows], offsets[kept])
+        hits['pid'] = pids
+        hits['evalue'] = np.nan
+        hits['bitscore'] = scores
+        hits['coverage'] = coverages
+        return hits
+
+
+def filter_hits(hits, min_pid=None, min_coverage=None, max_evalue=None):
+    """Returns the hits passing the given thresholds
+
+    min_pid, min_coverage: minimum percent identity and percent query
+     coverage
+    max_evalue: maximum E-value
+
+    Hits whose value is NaN (unknown) fail the corresponding threshold.
+    """
+    keep = np.ones(len(hits), dtype=bool)
+    if min_pid is not None:
+        keep &= hits['pid'] >= min_pid
+    if min_coverage is not None:
+        keep &= hits['coverage'] >= min_coverage
+    if max_evalue is not None:
+        keep &= hits['evalue'] <= max_evalue
+    return hits[keep]
+
+
+def best_hits(hits):
+    """Returns the hit with the highest bit score of each read
+
+    Ties go to the earliest hit. The result is sorted by read index.
+    """
+    if not len(hits):
+        return hits
+    order = np.lexsort((np.arange(len(hits)), -hits['bitscore'],
+                        hits['query']))
+    hits = hits[order]
+    first = np.ones(len(hits), dtype=bool)
+    first[1:] = hits['query'][1:] != hits['query'][:-1]
+    return hits[first]
+
+
+def otu_map(hits, query_ids, subject_ids):
+    """Returns a dict of reference id: list of the ids of its reads
+
+    query_ids, subject_ids: the IdIndex objects the hits were indexed with
+     (SortmernaHits.QueryIds and SubjectIds)
+
+    Reads are listed in the order of their hits; a read with several hits
+    is listed under each of their references (use best_hits first to
+    assign each read to one reference only).
+    """
+    if not len(hits):
+        return {}
+    order = np.argsort(hits['subject'], kind='mergesort')
+    subjects = hits['subject'][order]
+    queries = hits['query'][order]
+    bounds = np.flatnonzero(subjects[1:] != subjects[:-1]) + 1
+    otus = {}
+    for start, end in zip(np.r_[0, bounds], np.r_[bounds, len(subjects)]):
+        otus[subject_ids[subjects[start]]] = [query_ids[q] for q in
+                                              queries[start:end].tolist()]
+    return otus
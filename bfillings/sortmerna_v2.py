@@ -22,14 +22,22 @@ Application controller for SortMeRNA version 2.0
 # ----------------------------------------------------------------------------
 
 
-from os.path import split, splitext, dirname, join
+from os import remove, symlink
+from os.path import split, splitext, dirname, join, abspath
 from glob import glob
+from tempfile import gettempdir
 import re
 
 from burrito.util import CommandLineApplication, ResultPath
 from burrito.parameters import ValuedParameter, FlagParameter
 from skbio.parse.sequences import parse_fasta
 
+from bfillings.cache import ContentCache, cache_key, stamped_file_digest
+
+
+# Default directory of the index registry, shared by the processes of a host
+SORTMERNA_INDEX_CACHE_DIR = join(gettempdir(), 'bfillings_sortmerna_indexes')
+
 
 class IndexDB(CommandLineApplication):
     """ SortMeRNA generic application controller for building databases
@@ -45,6 +53,12 @@ class IndexDB(CommandLineApplication):
         '--max_pos': ValuedParameter('--', Name='max_pos', Delimiter=' ',
                                      IsPath=False, Value="10000"),
 
+        # Amount of memory (in Mbytes) for building the index
+        '-m': ValuedParameter('-', Name='m', Delimiter=' ', IsPath=False),
+
+        # Seed length
+        '-L': ValuedParameter('-', Name='L', Delimiter=' ', IsPath=False),
+
         # tmp folder for storing unique L-mers (prior to calling CMPH
         # in indexdb_rna), this tmp file is removed by indexdb_rna
         # after it is not used any longer
@@ -74,7 +88,9 @@ class IndexDB(CommandLineApplication):
 def build_database_sortmerna(fasta_path,
                              max_pos=None,
                              output_dir=None,
-                             HALT_EXEC=False):
+                             HALT_EXEC=False,
+                             memory=None,
+                             seed_length=None):
     """ Build sortmerna db from fasta_path; return db name
         and list of files created
 
@@ -92,6 +108,11 @@ def build_database_sortmerna(fasta_path,
             halt just before running the indexdb_rna command
             and print the command -- useful for debugging
             [default: False].
+        memory : integer, optional
+            amount of memory (in Mbytes) for building the index
+            [default: indexdb_rna's].
+        seed_length : integer, optional
+            seed length [default: indexdb_rna's].
 
         Return
         ------
@@ -130,6 +151,14 @@ def build_database_sortmerna(fasta_path,
     if max_pos is not None:
         sdb.Parameters['--max_pos'].on(max_pos)
 
+    # Set memory for building the index
+    if memory is not None:
+        sdb.Parameters['-m'].on(memory)
+
+    # Set seed length
+    if seed_length is not None:
+        sdb.Parameters['-L'].on(seed_length)
+
     # Run indexdb_rna
     app_result = sdb()
 
@@ -143,6 +172,94 @@ def build_database_sortmerna(fasta_path,
     return db_name, db_filepaths
 
 
+def get_cached_sortmerna_db(fasta_path,
+                            cache_dir=None,
+                            max_pos=None,
+                            memory=None,
+                            seed_length=None,
+                            max_size=None,
+                            HALT_EXEC=False):
+    """ Return an open cache entry holding a sortmerna db of fasta_path
+
+        Parameters
+        ----------
+        fasta_path : string
+            path to fasta file of sequences to build database.
+        cache_dir : string, optional
+            directory of the index registry
+            [default: SORTMERNA_INDEX_CACHE_DIR].
+        max_pos, memory, seed_length : integer, optional
+            indexing parameters, see build_database_sortmerna.
+        max_size : integer, optional
+            size budget of the registry in bytes; least recently
+            used indexes are removed when it is exceeded
+            [default: None, no limit].
+        HALT_EXEC : boolean, optional
+            halt just before running the indexdb_rna command
+            and print the command -- useful for debugging
+            [default: False].
+
+        Return
+        ------
+        entry : bfillings.cache.CacheEntry
+            the indexed database is available as its DbName
+            attribute. It is protected from eviction until the
+            entry is released.
+
+        Indexes are keyed by the md5 of the contents of fasta_path
+        and the indexing parameters, so the same reference is
+        only indexed once, and indexes are shared by all the
+        processes using the same cache_dir. Concurrent callers
+        building the same index wait for the first one to
+        finish. The indexed database must be used with a
+        reference file of the same contents as fasta_path.
+    """
+    if fasta_path is None:
+        raise ValueError("Error: path to fasta reference "
+                         "sequences must exist.")
+
+    if cache_dir is None:
+        cache_dir = SORTMERNA_INDEX_CACHE_DIR
+
+    params = {'--max_pos': max_pos, '-m': memory, '-L': seed_length}
+    cache = ContentCache(cache_dir, max_size=max_size)
+    key = cache_key('indexdb_rna', stamped_file_digest(fasta_path), params)
+
+    def build_index(build_dir):
+        # index a link to the reference, so that the database is
+        # named the same whatever the name of fasta_path
+        link_path = join(build_dir, 'reference.fasta')
+        symlink(abspath(fasta_path), link_path)
+        try:
+            build_database_sortmerna(link_path,
+                                     max_pos=max_pos,
+                                     output_dir=build_dir,
+                                     HALT_EXEC=HALT_EXEC,
+                                     memory=memory,
+                                     seed_length=seed_length)
+        finally:
+            remove(link_path)
+
+    entry = cache.open_entry(key, build_index)
+    entry.DbName = join(entry.Path, 'reference')
+    return entry
+
+
+def _resolve_sortmerna_db(refseqs_fp, sortmerna_db, index_cache_dir,
+                          HALT_EXEC):
+    """ Return the indexed database to use and the registry entry
+        holding it (None if sortmerna_db was given)
+    """
+    if sortmerna_db is not None:
+        return sortmerna_db, None
+    if refseqs_fp is None:
+        raise ValueError("Error: an indexed database or the reference "
+                         "sequences it is built from must be given.")
+    entry = get_cached_sortmerna_db(refseqs_fp, cache_dir=index_cache_dir,
+                                    HALT_EXEC=HALT_EXEC)
+    return entry.DbName, entry
+
+
 class Sortmerna(CommandLineApplication):
     """ SortMeRNA generic application controller for OTU picking
     """
@@ -302,7 +419,8 @@ def sortmerna_ref_cluster(seq_path=None,
                           coverage=0.97,
                           threads=1,
                           best=1,
-                          HALT_EXEC=False
+                          HALT_EXEC=False,
+                          index_cache_dir=None
                           ):
     """Launch sortmerna OTU picker
 
@@ -310,8 +428,10 @@ def sortmerna_ref_cluster(seq_path=None,
         ----------
         seq_path : str
             filepath to query sequences.
-        sortmerna_db : str
-            indexed reference database.
+        sortmerna_db : str, optional
+            indexed reference database. If None, the index of
+            refseqs_fp is taken from the index registry, and
+            built there if missing (see get_cached_sortmerna_db).
         refseqs_fp : str
             filepath of reference sequences.
         result_path : str
@@ -329,6 +449,9 @@ def sortmerna_ref_cluster(seq_path=None,
         best : int, optional
             number of best alignments to output per read
             [default: 1].
+        index_cache_dir : str, optional
+            directory of the index registry
+            [default: SORTMERNA_INDEX_CACHE_DIR].
 
         Returns
         -------
@@ -348,14 +471,6 @@ def sortmerna_ref_cluster(seq_path=None,
     else:
         raise ValueError("Error: a read file is mandatory input.")
 
-    # Set the input reference sequence + indexed database path
-    if sortmerna_db is not None:
-        smr.Parameters['--ref'].on("%s,%s" % (refseqs_fp, sortmerna_db))
-    else:
-        raise ValueError("Error: an indexed database for reference set %s must"
-                         " already exist.\nUse indexdb_rna to index the"
-                         " database." % refseqs_fp)
-
     if result_path is None:
         raise ValueError("Error: the result path must be set.")
 
@@ -393,8 +508,17 @@ def sortmerna_ref_cluster(seq_path=None,
     if threads is not None:
         smr.Parameters['-a'].on(threads)
 
-    # Run sortmerna
-    app_result = smr()
+    # Set the input reference sequence + indexed database path, and run
+    # sortmerna, keeping the index from eviction meanwhile; the index is
+    # taken from the registry right before the try, so it is always released
+    sortmerna_db, index_entry = _resolve_sortmerna_db(
+        refseqs_fp, sortmerna_db, index_cache_dir, HALT_EXEC)
+    try:
+        smr.Parameters['--ref'].on("%s,%s" % (refseqs_fp, sortmerna_db))
+        app_result = smr()
+    finally:
+        if index_entry is not None:
+            index_entry.release()
 
     # Put clusters into a map of lists
     f_otumap = app_result['OtuMap']
@@ -419,7 +543,7 @@ def sortmerna_ref_cluster(seq_path=None,
 def sortmerna_map(seq_path,
                   output_dir,
                   refseqs_fp,
-                  sortmerna_db,
+                  sortmerna_db=None,
                   e_value=1,
                   threads=1,
                   best=None,
@@ -429,6 +553,7 @@ def sortmerna_map(seq_path,
                   sam_SQ_tags=False,
                   blast_format=3,
                   print_all_reads=True,
+                  index_cache_dir=None,
                   ):
     """Launch sortmerna mapper
 
@@ -440,8 +565,10 @@ def sortmerna_map(seq_path,
             dirpath to sortmerna output.
         refseqs_fp : str
             filepath of reference sequences.
-        sortmerna_db : str
-            indexed reference database.
+        sortmerna_db : str, optional
+            indexed reference database. If None, the index of
+            refseqs_fp is taken from the index registry, and
+            built there if missing (see get_cached_sortmerna_db).
         e_value : float, optional
             E-value threshold [default: 1].
         threads : int, optional
@@ -467,6 +594,9 @@ def sortmerna_map(seq_path,
         print_all_reads : bool, optional
             output NULL alignments for non-aligned reads
             [default: True].
+        index_cache_dir : str, optional
+            directory of the index registry
+            [default: SORTMERNA_INDEX_CACHE_DIR].
 
         Returns
         -------
@@ -484,9 +614,6 @@ def sortmerna_map(seq_path,
     # Instantiate the object
     smr = Sortmerna(HALT_EXEC=HALT_EXEC)
 
-    # Set the input reference sequence + indexed database path
-    smr.Parameters['--ref'].on("%s,%s" % (refseqs_fp, sortmerna_db))
-
     # Set input query sequences path
     smr.Parameters['--reads'].on(seq_path)
 
@@ -536,7 +663,16 @@ def sortmerna_map(seq_path,
     smr.Parameters['--id'].off()
     smr.Parameters['--coverage'].off()
 
-    # Run sortmerna
-    app_result = smr()
+    # Set the input reference sequence + indexed database path, and run
+    # sortmerna, keeping the index from eviction meanwhile; the index is
+    # taken from the registry right before the try, so it is always released
+    sortmerna_db, index_entry = _resolve_sortmerna_db(
+        refseqs_fp, sortmerna_db, index_cache_dir, HALT_EXEC)
+    try:
+        smr.Parameters['--ref'].on("%s,%s" % (refseqs_fp, sortmerna_db))
+        app_result = smr()
+    finally:
+        if index_entry is not None:
+            index_entry.release()
 
     return app_result
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2013--, biocore development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+#-----------------------------------------------------------------------------
+
+"""Dependency-aware execution of the stages of multi-step wrappers
+
+Wrappers such as usearch_qf chain many application calls, some of which only
+depend on an earlier step and not on each other (e.g. de novo and reference
+based chimera checking of the same error corrected sequences). StageExecutor
+starts each stage as soon as the stages it depends on have finished, within a
+budget of concurrently running stages (workers) and of threads used by the
+applications they call.
+
+StageManifest makes such wrappers resumable: it records, in a JSON file in
+the output directory, the digests of the files each stage read, its
+parameters and the version of the application it ran. A stage whose record
+still matches, and whose outputs are unchanged on disk, is skipped and its
+recorded result reused.
+"""
+
+import json
+import sys
+from collections import OrderedDict
+from os import rename
+from os.path import exists, getmtime, getsize
+from threading import Condition, Lock, Thread
+
+from bfillings.cache import cache_key, file_digest
+
+
+def _result_files(result):
+    """Returns the filepaths in a stage result
+
+    A result is taken to name files if it is a string, or a list or tuple
+    whose items are strings; other results name no files.
+    """
+    if isinstance(result, basestring):
+        return [result]
+    if isinstance(result, (list, tuple)):
+        return [r for r in result if isinstance(r, basestring)]
+    return []
+
+
+def _file_stat(fp):
+    return [getsize(fp), getmtime(fp)]
+
+
+class StageManifest(object):
+    """Record of completed stages, used to skip them on reruns
+
+    manifest_fp: path to the JSON manifest file; it is created if missing
+    tool_version: version of the application run by the stages, e.g. the
+     output of its --version option; records made with another version are
+     out of date
+
+    Stage results are stored in the manifest, so they must be JSON
+    serializable (tuples are returned as lists). File digests are memoized by
+    size and modification time, so unchanged inputs are only read once.
+    """
+
+    _format_version = 1
+
+    def __init__(self, manifest_fp, tool_version=None):
+        self.ManifestFp = manifest_fp
+        self.ToolVersion = tool_version
+        self._lock = Lock()
+        self._stages = {}
+        self._digests = {}
+        if exists(manifest_fp):
+            try:
+                with open(manifest_fp) as f:
+                    data = json.load(f)
+            except ValueError:
+                # a truncated or corrupt manifest is the same as none
+                data = {}
+            if data.get('format_version') == self._format_version:
+                self._stages = data['stages']
+                self._digests = data['digests']
+
+    def _digest(self, fp):
+        """Returns the digest of fp, reusing it if the file is unchanged"""
+        stat = _file_stat(fp)
+        with self._lock:
+            memo = self._digests.get(fp)
+        if memo is not None and memo[:2] == stat:
+            return memo[2]
+        digest = file_digest(fp)
+        with self._lock:
+            self._digests[fp] = stat + [digest]
+        return digest
+
+    def _save(self):
+        data = {'format_version': self._format_version,
+                'stages': self._stages,
+                'digests': self._digests}
+        tmp_fp = self.ManifestFp + '.tmp'
+        with open(tmp_fp, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        rename(tmp_fp, self.ManifestFp)
+
+    def is_current(self, name, input_fps, params):
+        """Returns True if stage name can be skipped
+
+        That is, if it was recorded with the same tool version, params and
+        input file contents, and its outputs have not changed since.
+        """
+        with self._lock:
+            record = self._stages.get(name)
+        if record is None or record['tool_version'] != self.ToolVersion or \
+                record['params'] != cache_key(params) or \
+                sorted(record['inputs']) != sorted(set(input_fps)):
+            return False
+        for fp, stat in record['outputs'].iteritems():
+            if not exists(fp) or _file_stat(fp) != stat:
+                return False
+        for fp, digest in record['inputs'].iteritems():
+            if not exists(fp) or self._digest(fp) != digest:
+                return False
+        return True
+
+    def record(self, name, input_fps, params, output_fps, result):
+        """Records that stage name completed, and saves the manifest"""
+        record = {'tool_version': self.ToolVersion,
+                  'params': cache_key(params),
+                  'inputs': dict((fp, self._digest(fp)) for fp in input_fps),
+                  'outputs': dict((fp, _file_stat(fp)) for fp in output_fps
+                                  if exists(fp)),
+                  'result': result}
+        with self._lock:
+            self._stages[name] = record
+            self._save()
+
+    def result(self, name):
+        """Returns the recorded result of stage name"""
+        with self._lock:
+            return self._stages[name]['result']
+
+    def run_stage(self, name, func, args, input_fps, params, output_fps=()):
+        """Returns func(*args), or the recorded result if name is current
+
+        input_fps: files read by the stage
+        params: dict of the parameters that affect the outputs of the stage
+        output_fps: files written by the stage, in addition to those named
+         by its result
+        """
+        if self.is_current(name, input_fps, params):
+            return self.result(name)
+        result = func(*args)
+        self.record(name, input_fps, params,
+                    list(output_fps) + _result_files(result), result)
+        return result
+
+
+class StageExecutor(object):
+    """Runs named stages, each as soon as its dependencies have finished
+
+    max_workers: maximum number of stages running at once. With 1, stages are
+     run in the order in which they were added, in the calling thread.
+    max_threads: maximum total number of threads used by the running stages,
+     as declared by add_stage; defaults to max_workers.
+    manifest: StageManifest used to skip the stages added with params that
+     are up to date; if None, all stages are run.
+    """
+
+    def __init__(self, max_workers=1, max_threads=None, manifest=None):
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1.")
+        if max_threads is None:
+            max_threads = max_workers
+        if max_threads < 1:
+            raise ValueError("max_threads must be at least 1.")
+        self.MaxWorkers = max_workers
+        self.MaxThreads = max_threads
+        self.Manifest = manifest
+        self._stages = OrderedDict()
+
+    def add_stage(self, name, func, deps=(), threads=1, params=None,
+                  inputs=(), outputs=()):
+        """Adds a stage
+
+        name: name of the stage, used as key of the results of run
+        func: function called with the results of the stages in deps, in
+         order, as positional arguments
+        deps: names of the stages this stage depends on; they must have been
+         added already
+        threads: number of threads the stage uses, counted against
+         max_threads (a stage needing more than max_threads is run alone)
+        params: dict of the parameters that affect the outputs of the stage.
+         If given and the executor has a manifest, the stage is resumable:
+         it is skipped when the manifest shows it was run with the same
+         params on the same input files. The input files are those named by
+         the results of deps plus inputs, and the output files those named
+         by its own result plus outputs.
+        inputs: files read by the stage other than the results of deps
+        outputs: files written by the stage other than its result
+        """
+        if name in self._stages:
+            raise ValueError("Stage %s was already added." % name)
+        for dep in deps:
+            if dep not in self._stages:
+                raise ValueError("Stage %s depends on unknown stage %s."
+                                 % (name, dep))
+        self._stages[name] = (func, tuple(deps), min(threads,
+                                                      self.MaxThreads),
+                              params, tuple(inputs), tuple(outputs))
+
+    def __contains__(self, name):
+        return name in self._stages
+
+    def run(self):
+        """Runs all stages, returns a dict of stage name: result
+
+        If a stage raises an exception, no further stages are started and,
+        once the running stages have finished, the exception is re-raised.
+        """
+        if self.MaxWorkers == 1:
+            return self._run_serial()
+        return self._run_concurrent()
+
+    def _run_stage(self, name, args):
+        """Runs stage name with args, unless the manifest shows it is current
+        """
+        func, _, _, params, inputs, outputs = self._stages[name]
+        if self.Manifest is None or params is None:
+            return func(*args)
+        input_fps = [fp for fp in inputs if fp]
+        for arg in args:
+            input_fps.extend(_result_files(arg))
+        return self.Manifest.run_stage(name, func, args, input_fps, params,
+                                       outputs)
+
+    def _run_serial(self):
+        results = {}
+        for name, stage in self._stages.iteritems():
+            deps = stage[1]
+            results[name] = self._run_stage(name,
+                                            [results[dep] for dep in deps])
+        return results
+
+    def _run_concurrent(self):
+        results = {}
+        errors = []
+        pending = self._stages.keys()
+        running = {}
+        ready = Condition()
+
+        def run_stage(name, args):
+            try:
+                result = self._run_stage(name, args)
+                error = None
+            except BaseException:
+                error = sys.exc_info()
+            ready.acquire()
+            try:
+                if error is None:
+                    results[name] = result
+                else:
+                    errors.append(error)
+                del running[name]
+                ready.notify()
+            finally:
+                ready.release()
+
+        ready.acquire()
+        try:
+            while True:
+                if not errors:
+                    for name in list(pending):
+                        if len(running) >= self.MaxWorkers:
+                            break
+                        deps, threads = self._stages[name][1:3]
+                        if not all(dep in results for dep in deps):
+                            continue
+                        if sum(running.values()) + threads > self.MaxThreads:
+                            continue
+                        pending.remove(name)
+                        running[name] = threads
+                        args = [results[dep] for dep in deps]
+                        worker = Thread(target=run_stage,
+                                        args=(name, args))
+                        worker.daemon = True
+                        worker.start()
+                if not running:
+                    break
+                # a timeout keeps the main thread responsive to
+                # KeyboardInterrupt
+                ready.wait(1.0)
+        finally:
+            ready.release()
+
+        if errors:
+            error_type, error, traceback = errors[0]
+            raise error_type, error, traceback
+        return results
@@ -21,10 +21,23 @@ Application controller for SumaClust version 1.0
 # The full license is in the file COPYING.txt, distributed with this software.
 # ----------------------------------------------------------------------------
 
-from os.path import split, isdir, dirname, isfile, exists, realpath
+from os import chmod, fdopen, remove, rename, umask
+from os.path import (basename, split, isdir, dirname, isfile, exists,
+                     realpath, join, getsize)
+from collections import OrderedDict
+from shutil import copyfileobj, copymode, rmtree
+from tempfile import mkdtemp, mkstemp
 
 from burrito.util import CommandLineApplication, ResultPath
 from burrito.parameters import ValuedParameter, FlagParameter
+from skbio.parse.sequences import parse_fasta
+
+from bfillings.fasta_index import FastaIndex
+
+
+# Abundance given to the existing centroids when clustering new reads
+# with them, so that SumaClust takes them as cluster seeds first
+CENTROID_COUNT = 10 ** 9
 
 
 class Sumaclust(CommandLineApplication):
@@ -171,3 +184,196 @@ def sumaclust_denovo_cluster(seq_path=None,
 
     # Return clusters
     return clusters
+
+
+def _read_otu_map(otu_map_fp):
+    """ Return an OrderedDict of OTU id: list of members
+        from a SumaClust OTU map
+    """
+    otus = OrderedDict()
+    with open(otu_map_fp, 'U') as otu_map_f:
+        for line in otu_map_f:
+            fields = line.strip().split('\t')
+            if fields[0]:
+                otus[fields[0]] = fields[1:]
+    return otus
+
+
+def _write_atomically(fp, write_f):
+    """ Write fp with write_f(open file), through a uniquely
+        named temporary file in the same directory renamed into
+        place, so fp is never left half written
+    """
+    tmp_fd, tmp_fp = mkstemp(prefix=basename(fp) + '.',
+                             suffix='.tmp', dir=dirname(realpath(fp)))
+    try:
+        # mkstemp files are private; give fp the usual permissions
+        if exists(fp):
+            copymode(fp, tmp_fp)
+        else:
+            mask = umask(0)
+            umask(mask)
+            chmod(tmp_fp, 0o666 & ~mask)
+        with fdopen(tmp_fd, 'w') as tmp_f:
+            write_f(tmp_f)
+        rename(tmp_fp, fp)
+    except:
+        if exists(tmp_fp):
+            remove(tmp_fp)
+        raise
+
+
+def sumaclust_update_clusters(seq_path=None,
+                              otu_map_fp=None,
+                              centroids_fp=None,
+                              shortest_len=True,
+                              similarity=0.97,
+                              threads=1,
+                              exact=False,
+                              HALT_EXEC=False
+                              ):
+    """ Function  : grow a persisted SumaClust OTU map with
+                    a batch of new reads
+
+        Parameters: seq_path, filepath to the new reads;
+                    otu_map_fp, filepath to the OTU map, in
+                    SumaClust's format (OTU id, which is the id
+                    of its centroid, then its members);
+                    centroids_fp, filepath to the FASTA file of
+                    the OTU centroids;
+                    shortest_len, similarity, threads, exact,
+                    as for sumaclust_denovo_cluster
+
+        Return    : clusters, list of lists (all the OTUs of
+                    the updated map, in order)
+
+        New reads identical to a centroid are added to its OTU
+        directly. The other reads are clustered by SumaClust
+        together with the centroids, which are given a high
+        abundance (count=CENTROID_COUNT) so that they seed the
+        clustering: reads within the similarity threshold of a
+        centroid join its OTU, and the remaining reads form new
+        OTUs. The OTU map and the centroids file are then
+        updated in place (new OTUs are appended; existing OTUs
+        are never merged or split).
+
+        Existing centroids are not clustered against each
+        other: two centroids within the similarity threshold
+        stay separate OTUs. SumaClust may however place one of
+        them in the cluster of the other, in which case the
+        reads close to both join the OTU of the latter; reads
+        identical to either centroid still join its own OTU.
+
+        If neither otu_map_fp nor centroids_fp exists yet, all
+        reads are clustered and both files are created.
+    """
+
+    # Sequence path is mandatory
+    if (seq_path is None
+            or not exists(seq_path)):
+        raise ValueError("Error: FASTA query sequence filepath is "
+                         "mandatory input.")
+
+    # OTU map and centroids paths are mandatory
+    if otu_map_fp is None or centroids_fp is None:
+        raise ValueError("Error: OTU map and centroids filepaths are "
+                         "mandatory input.")
+
+    if not isdir(dirname(realpath(otu_map_fp))):
+        raise ValueError("Error: output directory is mandatory input.")
+
+    if exists(otu_map_fp) and not exists(centroids_fp):
+        raise ValueError("Error: centroids file %s of OTU map %s does "
+                         "not exist." % (centroids_fp, otu_map_fp))
+
+    if exists(centroids_fp) and not exists(otu_map_fp):
+        raise ValueError("Error: OTU map %s of centroids file %s does "
+                         "not exist." % (otu_map_fp, centroids_fp))
+
+    if threads <= 0:
+        raise ValueError("Number of threads must be positive.")
+
+    otus = OrderedDict()
+    centroid_seqs = {}
+    if exists(otu_map_fp):
+        otus = _read_otu_map(otu_map_fp)
+        for label, seq in parse_fasta(centroids_fp):
+            otu_id = label.split()[0]
+            if otu_id in otus:
+                centroid_seqs.setdefault(seq.upper(), otu_id)
+
+    scratch_dir = mkdtemp(prefix='sumaclust_update_',
+                          dir=dirname(realpath(otu_map_fp)))
+    try:
+        # Assign reads identical to a centroid, keep the others
+        leftovers_fp = join(scratch_dir, 'leftovers.fasta')
+        num_leftovers = 0
+        with open(leftovers_fp, 'w') as leftovers_f:
+            for label, seq in parse_fasta(seq_path):
+                otu_id = centroid_seqs.get(seq.upper())
+                if otu_id is not None:
+                    otus[otu_id].append(label.split()[0])
+                else:
+                    leftovers_f.write('>%s\n%s\n' % (label, seq))
+                    num_leftovers += 1
+
+        new_otu_ids = []
+        if num_leftovers:
+            # Cluster the leftovers, seeded by the existing centroids
+            input_fp = join(scratch_dir, 'input.fasta')
+            with open(input_fp, 'w') as input_f:
+                if otus:
+                    for label, seq in parse_fasta(centroids_fp):
+                        input_f.write('>%s count=%d;\n%s\n'
+                                      % (label.split()[0], CENTROID_COUNT,
+                                         seq))
+                with open(leftovers_fp) as leftovers_f:
+                    copyfileobj(leftovers_f, input_f)
+
+            new_otu_map_fp = join(scratch_dir, 'otu_map.txt')
+            sumaclust_denovo_cluster(seq_path=input_fp,
+                                     result_path=new_otu_map_fp,
+                                     shortest_len=shortest_len,
+                                     similarity=similarity,
+                                     threads=threads,
+                                     exact=exact,
+                                     HALT_EXEC=HALT_EXEC)
+
+            # Merge the clusters into the OTU map
+            old_otu_ids = set(otus)
+            for centroid, members in \
+                    _read_otu_map(new_otu_map_fp).iteritems():
+                # existing centroids stay in their own OTU
+                new_reads = [seq_id for seq_id in members
+                             if seq_id not in old_otu_ids]
+                if centroid in old_otu_ids:
+                    otus[centroid].extend(new_reads)
+                elif new_reads:
+                    otus[centroid] = new_reads
+                    new_otu_ids.append(centroid)
+
+        # Persist the new centroids, then the OTU map
+        if new_otu_ids or not exists(centroids_fp):
+            leftovers_index = FastaIndex(leftovers_fp)
+            try:
+                def write_centroids(centroids_f):
+                    if exists(centroids_fp) and getsize(centroids_fp):
+                        with open(centroids_fp) as old_f:
+                            copyfileobj(old_f, centroids_f)
+                            old_f.seek(-1, 2)
+                            if old_f.read(1) != '\n':
+                                centroids_f.write('\n')
+                    leftovers_index.write_records(new_otu_ids,
+                                                  centroids_f)
+                _write_atomically(centroids_fp, write_centroids)
+            finally:
+                leftovers_index.close()
+
+        def write_otu_map(otu_map_f):
+            for otu_id, members in otus.iteritems():
+                otu_map_f.write('\t'.join([otu_id] + members) + '\n')
+        _write_atomically(otu_map_fp, write_otu_map)
+    finally:
+        rmtree(scratch_dir, ignore_errors=True)
+
+    return otus.values()
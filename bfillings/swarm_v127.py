@@ -21,17 +21,17 @@ Application controller for Swarm version 1.2.7
 # The full license is in the file COPYING.txt, distributed with this software.
 # ----------------------------------------------------------------------------
 
-from os.path import exists
-from tempfile import mkstemp
-from os import close, linesep
-from subprocess import Popen, PIPE
-import re
-
-from burrito.util import (CommandLineApplication, ResultPath,
-                            ApplicationNotFoundError)
-from burrito.parameters import ValuedParameter
+from os.path import exists, join
+from tempfile import mkstemp, mkdtemp
+from os import close
+from shutil import rmtree
+
+from burrito.util import CommandLineApplication, ResultPath
+from burrito.parameters import FlagParameter, ValuedParameter
 from skbio.parse.sequences import parse_fasta
-from skbio.util import remove_files
+
+from bfillings.dereplicate import Dereplicator, read_id_map
+from bfillings.stages import StageExecutor
 
 
 class Swarm(CommandLineApplication):
@@ -50,21 +50,34 @@ class Swarm(CommandLineApplication):
         # Threads
         '-t': ValuedParameter('-', Name='t', Delimiter=' ',
                               Value=1, IsPath=False),
+        # Output the data for breaking chains of amplicons to stderr
+        '-b': FlagParameter('-', Name='b'),
     }
 
     _synonyms = {}
     _input_handler = '_input_as_string'
     _supress_stdout = False
     _supress_stderr = False
-    files_to_remove = []
+    # Number of unique sequences tracked in memory during de-replication
+    MaxUniques = 1000000
+    # Chain breaking: minimum abundance of the peaks between which chains
+    # are looked for, and abundance ratio of a peak to the valley linking
+    # it to a higher peak (the values used by swarm_breaker.py)
+    BreakerAbundant = 100
+    BreakerRatio = 50
+
+    def __init__(self, *args, **kwargs):
+        super(Swarm, self).__init__(*args, **kwargs)
+        # temporary files of this instance (in its TmpDir)
+        self.files_to_remove = []
 
     def __call__(self, seq_path):
         """
             Input : seq_path, a filepath to input FASTA reads
 
             Method: de-replicate FASTA reads,
-                    launch Swarm followed by swarm_breaker.py,
-                    expand clusters
+                    launch Swarm, break chains of
+                    amplicons, expand clusters
 
             Return: clusters, a list of lists
         """
@@ -73,99 +86,72 @@ class Swarm(CommandLineApplication):
         exact_match_id_map, seq_path =\
             self._apply_identical_sequences_prefilter(seq_path)
 
-        # Run Swarm
-        super(Swarm, self).__call__(seq_path)
-
-        # Run swarm_breaker.py to refine the clusters
-        clusters = self._swarm_breaker(seq_path)
+        # Run Swarm, with the pairs of amplicons linked while
+        # growing each OTU output to stderr
+        self.Parameters['-b'].on()
+        app_result = super(Swarm, self).__call__(seq_path)
 
-        # Expand clusters
-        clusters = self._map_filtered_clusters_to_full_clusters(
-            clusters, exact_match_id_map)
+        try:
+            # Break chains of amplicons, expanding the refined
+            # clusters as they are produced
+            clusters = self._map_filtered_clusters_to_full_clusters(
+                self._swarm_breaker(app_result['StdErr'],
+                                    exact_match_id_map),
+                exact_match_id_map)
+        finally:
+            app_result.cleanUp()
 
         return clusters
 
     def _swarm_breaker(self,
-                       seq_path):
+                       break_data,
+                       exact_match_id_map):
         """
-            Input : seq_path, a filepath to de-replicated
-                    input FASTA reads
+            Input : break_data, the lines of Swarm's -b
+                    output (stderr)
+                    exact_match_id_map, a dictionary storing
+                    de-replicated amplicon ID as key and
+                    all original FASTA IDs with identical
+                    sequences as values; the abundance of
+                    an amplicon is its number of reads
 
-            Method: using swarm_breaker.py, break
-                    chains of amplicons based on
-                    abundance information. Abundance
-                    is stored after the final
-                    underscore '_' in each sequence
-                    label (recommended procedure for
-                    Swarm)
+            Method: break chains of amplicons based on
+                    abundance information, as
+                    swarm_breaker.py does, reading the
+                    Swarm OTU-map one OTU at a time
 
-            Return: clusters, a list of lists
+            Return: a generator of clusters, lists of
+                    de-replicated amplicon IDs
         """
-        swarm_breaker_command = ["swarm_breaker.py",
-                                 "-f",
-                                 seq_path,
-                                 "-s",
-                                 self.Parameters['-o'].Value,
-                                 "-d",
-                                 str(self.Parameters['-d'].Value)]
+        parents, children = parse_swarm_graph(break_data,
+                                              exact_match_id_map)
 
-        try:
-            # launch swarm_breaker.py as a subprocess,
-            # pipe refined OTU-map to the standard stream
-            proc = Popen(swarm_breaker_command,
-                         stdout=PIPE,
-                         stderr=PIPE,
-                         close_fds=True)
-
-            stdout, stderr = proc.communicate()
-
-            if stderr:
-                raise StandardError("Process exited with %s" % stderr)
-
-            # store refined clusters in list of lists
-            clusters = []
-            for line in stdout.split(linesep):
-                # skip line if contains only the newline character
-                if not line:
-                    break
-                seq_ids = re.split("\t| ", line.strip())
+        with open(self.Parameters['-o'].Value, 'U') as otu_map:
+            for line in otu_map:
                 # remove the abundance information from the labels
-                for i in range(len(seq_ids)):
-                    seq_ids[i] = seq_ids[i].rsplit("_", 1)[0]
-                clusters.append(seq_ids)
-        except OSError:
-            raise ApplicationNotFoundError("Cannot find swarm_breaker.py "
-                                           "in the $PATH directories.")
-
-        return clusters
-
-    def _prefilter_exact_matches(self,
-                                 seqs):
-        """
-        """
-        unique_sequences = {}
-        seq_id_map = {}
-        filtered_seqs = []
-        for seq_id, seq in seqs:
-            seq_id = seq_id.split()[0]
-            try:
-                temp_seq_id = unique_sequences[seq]
-            except KeyError:
-                temp_seq_id = 'ExactMatch.%s' % seq_id
-                unique_sequences[seq] = temp_seq_id
-                seq_id_map[temp_seq_id] = []
-                filtered_seqs.append((temp_seq_id, seq))
-            seq_id_map[temp_seq_id].append(seq_id)
-        return filtered_seqs, seq_id_map
+                amplicons = [label.rsplit("_", 1)[0]
+                             for label in line.split()]
+                if not amplicons:
+                    continue
+                for cluster in break_swarm_chains(amplicons,
+                                                  parents,
+                                                  children,
+                                                  exact_match_id_map,
+                                                  self.BreakerAbundant,
+                                                  self.BreakerRatio):
+                    yield cluster
 
     def _apply_identical_sequences_prefilter(self,
                                              seq_path):
         """
             Input : seq_path, a filepath to input FASTA reads
-            Method: prepares and writes de-replicated reads
-                    to a temporary FASTA file, calls
-                    parent method to do the actual
-                    de-replication
+            Method: de-replicates the reads with a Dereplicator,
+                    which writes them to a temporary FASTA file,
+                    and the IDs of identical reads to a
+                    temporary ID map; sequences are not kept
+                    in memory, and at most self.MaxUniques
+                    unique sequences are tracked in memory
+                    before spilling to disk
             Return: exact_match_id_map, a dictionary storing
                     de-replicated amplicon ID as key and
                     all original FASTA IDs with identical
@@ -173,25 +159,29 @@ class Swarm(CommandLineApplication):
                     unique_seqs_fp, filepath to FASTA file
                     holding only de-replicated sequences
         """
-        # creating mapping for de-replicated reads
-        seqs_to_cluster, exact_match_id_map =\
-            self._prefilter_exact_matches(parse_fasta(seq_path))
-
-        # create temporary file for storing the de-replicated reads
+        # create temporary files for storing the de-replicated reads
+        # and the IDs of the reads they stand for
         fd, unique_seqs_fp = mkstemp(
-            prefix='SwarmExactMatchFilter', suffix='.fasta')
+            prefix='SwarmExactMatchFilter', suffix='.fasta',
+            dir=self.TmpDir)
+        close(fd)
+        fd, id_map_fp = mkstemp(
+            prefix='SwarmExactMatchFilter', suffix='.txt',
+            dir=self.TmpDir)
         close(fd)
 
         self.files_to_remove.append(unique_seqs_fp)
-
-        # write de-replicated reads to file
-        unique_seqs_f = open(unique_seqs_fp, 'w')
-        for seq_id, seq in seqs_to_cluster:
-            unique_seqs_f.write('>%s_%d\n%s\n'
-                                % (seq_id,
-                                   len(exact_match_id_map[seq_id]),
-                                   seq))
-        unique_seqs_f.close()
+        self.files_to_remove.append(id_map_fp)
+
+        # write de-replicated reads to file, with their abundance
+        # after the final underscore of the label
+        dereplicator = Dereplicator(max_uniques=self.MaxUniques,
+                                    label_prefix='ExactMatch.',
+                                    record_format='>%s_%d\n%s\n',
+                                    tmp_dir=self.TmpDir)
+        dereplicator.dereplicate(parse_fasta(seq_path), unique_seqs_fp,
+                                 id_map_fp)
+        exact_match_id_map = read_id_map(id_map_fp)
 
         return exact_match_id_map, unique_seqs_fp
 
@@ -199,7 +189,7 @@ class Swarm(CommandLineApplication):
                                                 clusters,
                                                 filter_map):
         """
-            Input:  clusters, a list of cluster lists
+            Input:  clusters, an iterable of cluster lists
                     filter_map, the seq_id in each clusters
                                 is the key to the filter_map
                                 containing all seq_ids with
@@ -239,56 +229,250 @@ class Swarm(CommandLineApplication):
         return help_str
 
 
+def parse_swarm_graph(break_data, amplicon_ids):
+    """ Function  : read the pairs of amplicons linked by
+                    Swarm while growing each OTU
+
+        Parameters: break_data, the lines of Swarm's -b
+                    output; the pairs are on the lines
+                    starting with '@@', as
+                    '@@<tab>parent<tab>child<tab>...'
+                    amplicon_ids, container of the
+                    de-replicated amplicon IDs, used to
+                    tell whether labels carry abundances
+
+        Return    : parents, a dictionary of amplicon ID:
+                    ID of the amplicon it was linked from
+                    children, a dictionary of amplicon ID:
+                    list of the IDs of the amplicons linked
+                    from it, in the order Swarm linked them
+    """
+    parents = {}
+    children = {}
+    for line in break_data:
+        if not line.startswith('@@'):
+            continue
+        labels = line.rstrip('\n').split('\t')[1:3]
+        # remove the abundance information, if any, from the labels
+        parent, child = [label if label in amplicon_ids
+                         else label.rsplit("_", 1)[0]
+                         for label in labels]
+        # each amplicon is linked to its OTU only once
+        if child in parents:
+            continue
+        parents[child] = parent
+        children.setdefault(parent, []).append(child)
+    return parents, children
+
+
+def break_swarm_chains(amplicons,
+                       parents,
+                       children,
+                       abundances,
+                       abundant=100,
+                       ratio=50):
+    """ Function  : break the chains of amplicons of an OTU,
+                    with the valley model of swarm_breaker.py
+
+        Parameters: amplicons, list of the amplicon IDs of
+                    the OTU
+                    parents, children, the graph of linked
+                    amplicons returned by parse_swarm_graph;
+                    the links that are broken are removed
+                    abundances, dictionary of amplicon ID:
+                    list of the reads it stands for
+                    abundant, minimum abundance of the peaks
+                    between which chains are looked for
+                    ratio, abundance ratio of a peak to the
+                    valley linking it to a higher peak
+                    above which the chain is broken (half
+                    of it suffices if the higher peak is
+                    less than ten times as abundant)
+
+        Return    : a list of clusters, lists of amplicon IDs
+                    sorted by decreasing abundance, the
+                    cluster of the most abundant amplicon
+                    first
+    """
+    def abundance(amplicon):
+        return len(abundances[amplicon])
+
+    # sort by decreasing abundance (the sort is stable)
+    amplicons = sorted(amplicons, key=abundance, reverse=True)
+    peaks = [amplicon for amplicon in amplicons
+             if abundance(amplicon) >= abundant]
+    if len(peaks) < 2:
+        return [amplicons]
+
+    seeds = [amplicons[0]]
+    for i, start in enumerate(peaks):
+        for end in peaks[i + 1:]:
+            # the OTU graph is a tree grown from its seed, so the path
+            # between two amplicons is found walking up from the end
+            path = [end]
+            while path[-1] != start and len(path) <= len(amplicons):
+                parent = parents.get(path[-1])
+                if parent is None:
+                    break
+                path.append(parent)
+            if path[-1] != start or len(path) < 2:
+                continue
+            path.reverse()
+            path_abundances = [abundance(node) for node in path]
+            lowest = min(path_abundances)
+            if lowest == path_abundances[-1]:
+                continue
+            if (path_abundances[-1] / lowest > ratio / 2 and
+                    path_abundances[0] / path_abundances[-1] < 10) or \
+                    path_abundances[-1] / lowest >= ratio:
+                # break on the left of the rightmost lowest point,
+                # which becomes the seed of a new cluster
+                index = len(path_abundances) - 1 - \
+                    path_abundances[::-1].index(lowest)
+                left, right = path[index - 1], path[index]
+                children[left].remove(right)
+                del parents[right]
+                seeds.append(right)
+
+    clusters = []
+    seen = set()
+    for seed in seeds:
+        cluster = []
+        stack = [seed]
+        while stack:
+            amplicon = stack.pop()
+            if amplicon in seen:
+                continue
+            seen.add(amplicon)
+            cluster.append(amplicon)
+            stack.extend(reversed(children.get(amplicon, [])))
+        clusters.append(cluster)
+    # amplicons missing from the graph stay with the seed of the OTU
+    clusters[0].extend([amplicon for amplicon in amplicons
+                        if amplicon not in seen])
+    for cluster in clusters:
+        cluster.sort(key=abundance, reverse=True)
+    return clusters
+
+
 def swarm_denovo_cluster(seq_path,
                          d=1,
                          threads=1,
-                         HALT_EXEC=False):
+                         HALT_EXEC=False,
+                         max_uniques=1000000):
     """ Function  : launch the Swarm de novo OTU picker
 
         Parameters: seq_path, filepath to reads
                     d, resolution
                     threads, number of threads to use
+                    max_uniques, number of unique sequences
+                    tracked in memory while de-replicating
+                    reads; beyond it, reads are spilled
+                    to disk
 
         Return    : clusters, list of lists
+
+        All temporary files are written to a directory
+        of this call's own, removed on return, so that
+        calls can run concurrently.
     """
 
     # Check sequence file exists
     if not exists(seq_path):
         raise ValueError("%s does not exist" % seq_path)
 
-    # Instantiate the object
-    swarm = Swarm(HALT_EXEC=HALT_EXEC)
-
-    # Set the resolution
-    if d > 0:
-        swarm.Parameters['-d'].on(d)
-    else:
+    # Check the resolution
+    if d <= 0:
         raise ValueError("Resolution -d must be a positive integer.")
 
-    # Set the number of threads
-    if threads > 0:
-        swarm.Parameters['-t'].on(threads)
-    else:
+    # Check the number of threads
+    if threads <= 0:
         raise ValueError("Number of threads must be a positive integer.")
 
-    # create temporary file for Swarm OTU-map
-    f, tmp_swarm_otumap = mkstemp(prefix='temp_otumap_',
-                                  suffix='.swarm')
-    close(f)
+    # create temporary directory for the files of this call
+    scratch_dir = mkdtemp(prefix='swarm_')
+
+    try:
+        # Instantiate the object
+        swarm = Swarm(HALT_EXEC=HALT_EXEC, TmpDir=scratch_dir)
+        swarm.MaxUniques = max_uniques
 
-    swarm.Parameters['-o'].on(tmp_swarm_otumap)
+        # Set the resolution
+        swarm.Parameters['-d'].on(d)
 
-    # Remove this file later, the final OTU-map
-    # is output by swarm_breaker.py and returned
-    # as a list of lists (clusters)
-    swarm.files_to_remove.append(tmp_swarm_otumap)
+        # Set the number of threads
+        swarm.Parameters['-t'].on(threads)
 
-    # Launch Swarm
-    # set the data string to include the read filepath
-    # (to be passed as final arguments in the swarm command)
-    clusters = swarm(seq_path)
+        # Swarm OTU-map, refined by breaking chains of
+        # amplicons and returned as a list of lists (clusters)
+        swarm.Parameters['-o'].on(join(scratch_dir, 'otumap.swarm'))
 
-    remove_files(swarm.files_to_remove, error_on_missing=False)
+        # Launch Swarm
+        # set the data string to include the read filepath
+        # (to be passed as final arguments in the swarm command)
+        clusters = swarm(seq_path)
+    finally:
+        rmtree(scratch_dir, ignore_errors=True)
 
     # Return clusters
     return clusters
+
+
+def swarm_denovo_cluster_many(seq_paths,
+                              d=1,
+                              threads=1,
+                              max_workers=1,
+                              HALT_EXEC=False,
+                              max_uniques=1000000):
+    """ Function  : launch the Swarm de novo OTU picker on
+                    many read files (e.g. one per sample)
+                    concurrently
+
+        Parameters: seq_paths, list of filepaths to reads
+                    d, resolution
+                    threads, total number of threads to use;
+                    they are split between the concurrent
+                    Swarm runs, each getting threads //
+                    workers of them (at least one)
+                    max_workers, maximum number of read files
+                    clustered at once; no more than threads
+                    are used
+                    max_uniques, as for swarm_denovo_cluster
+
+        Return    : list of the clusters (lists of lists) of
+                    each read file, in the order of seq_paths
+    """
+
+    # Check sequence files exist
+    for seq_path in seq_paths:
+        if not exists(seq_path):
+            raise ValueError("%s does not exist" % seq_path)
+
+    if d <= 0:
+        raise ValueError("Resolution -d must be a positive integer.")
+
+    if threads <= 0:
+        raise ValueError("Number of threads must be a positive integer.")
+
+    if max_workers <= 0:
+        raise ValueError("Number of workers must be a positive integer.")
+
+    if not seq_paths:
+        return []
+
+    # split the threads between the workers
+    workers = min(max_workers, threads, len(seq_paths))
+    swarm_threads = threads // workers
+
+    def cluster(seq_path):
+        return lambda: swarm_denovo_cluster(seq_path, d=d,
+                                            threads=swarm_threads,
+                                            HALT_EXEC=HALT_EXEC,
+                                            max_uniques=max_uniques)
+
+    stages = StageExecutor(max_workers=workers, max_threads=threads)
+    for i, seq_path in enumerate(seq_paths):
+        stages.add_stage(i, cluster(seq_path), threads=swarm_threads)
+    results = stages.run()
+
+    return [results[i] for i in range(len(seq_paths))]
@@ -10,6 +10,7 @@
 
 from string import split, strip
 from os import popen, remove
+from os.path import abspath
 from glob import glob
 from unittest import TestCase, main
 
@@ -18,7 +19,11 @@ from cogent.parse.blast import QMEBlast9
 from bfillings.blast import (seqs_to_stream, make_subject_match_scorer,
                           make_shotgun_scorer, keep_everything_scorer,
                           ids_from_seq_lower_threshold, PsiBlast,
-                          psiblast_n_neighbors)
+                          psiblast_n_neighbors, split_records_by_residues,
+                          blast9_blocks, blast_seqs_sharded, Blastall,
+                          seqs_from_fastacmd, best_hits_from_blast9,
+                          reciprocal_best_blast_hits, _absolute_db_path)
+from bfillings.fasta_index import FastaIndex
 
 
 class BlastTests(TestCase):
@@ -144,6 +149,115 @@ MSGNIKKIVEPNSGIDYSLEKDFKIFTLSKELPITTYPSYIRLGIVIYCVKGNAKIDIYSNKHIITPKELIIILPGQLVA
             [['>a','TG'],['>b','WW']])
         self.assertRaises(TypeError, sts, 'abc', 'xyz')
 
+    def test_split_records_by_residues(self):
+        """split_records_by_residues should balance residues across shards"""
+        self.assertEqual(split_records_by_residues([10, 50, 30, 20, 40], 2),
+                         [0, 0, 1, 0, 1])
+        self.assertEqual(split_records_by_residues([5, 5, 5], 3), [0, 1, 2])
+        # never more shards than records
+        self.assertEqual(split_records_by_residues([5], 4), [0])
+        self.assertEqual(split_records_by_residues([], 4), [])
+
+    def test_blast9_blocks(self):
+        """blast9_blocks should yield the output of each query"""
+        blocks = list(blast9_blocks(self.rec))
+        self.assertEqual(len(blocks), 3)
+        self.assertEqual(blocks[0], self.rec[:8])
+        self.assertEqual(blocks[1], self.rec[8:20])
+        self.assertEqual(blocks[2], self.rec[20:])
+        self.assertEqual(list(blast9_blocks([])), [])
+
+    def test_blast_seqs_sharded_requires_m9(self):
+        """blast_seqs_sharded should only accept -m 9 output"""
+        self.assertRaises(ValueError, blast_seqs_sharded, ['>a', 'AC'],
+                          Blastall, '/tmp/out.txt', params={'-m': 8},
+                          add_seq_names=False)
+
+    def test_absolute_db_path(self):
+        """_absolute_db_path should only expand local database paths"""
+        f = open('test_adb.psq', 'w')
+        f.close()
+        try:
+            self.assertEqual(_absolute_db_path('test_adb'),
+                             abspath('test_adb'))
+        finally:
+            remove('test_adb.psq')
+        self.assertEqual(_absolute_db_path('nr'), 'nr')
+        self.assertEqual(_absolute_db_path('/db/test_adb'), '/db/test_adb')
+        self.assertEqual(_absolute_db_path(None), None)
+
+    def test_blast_seqs_sharded_relative_db(self):
+        """blast_seqs_sharded should find a database given by relative path"""
+        f = open('test_bdb', 'w')
+        f.write(self.fasta_recs)
+        f.close()
+        temp = popen('formatdb -i test_bdb -o T -p T')
+        temp.close()
+        try:
+            blast_out = blast_seqs_sharded(self.fasta_recs.split('\n'),
+                                           Blastall, 'test_sharded_out.txt',
+                                           num_shards=2, blast_db='test_bdb',
+                                           params={'-p': 'blastp',
+                                                   '-m': '9'},
+                                           add_seq_names=False,
+                                           WorkingDir='.')
+            lines = list(blast_out)
+            blast_out.close()
+            self.assertEqual(len(list(blast9_blocks(lines))), 10)
+        finally:
+            for fname in glob('formatdb.log') + \
+                    glob('test_sharded_out.txt') + glob('test_bdb*'):
+                remove(fname)
+
+    def test_blast_seqs_sharded_generator(self):
+        """blast_seqs_sharded should read a generator of seqs only once"""
+        f = open('test_bdb', 'w')
+        f.write(self.fasta_recs)
+        f.close()
+        temp = popen('formatdb -i test_bdb -o T -p T')
+        temp.close()
+        seqs = (line for line in self.fasta_recs.split('\n')
+                if line and not line.startswith('>'))
+        try:
+            blast_out = blast_seqs_sharded(seqs, Blastall,
+                                           'test_sharded_out.txt',
+                                           num_shards=2, blast_db='test_bdb',
+                                           params={'-p': 'blastp',
+                                                   '-m': '9'},
+                                           input_handler='_input_as_seqs',
+                                           WorkingDir='.')
+            lines = list(blast_out)
+            blast_out.close()
+            self.assertEqual(len(list(blast9_blocks(lines))), 10)
+        finally:
+            for fname in glob('formatdb.log') + \
+                    glob('test_sharded_out.txt') + glob('test_bdb*'):
+                remove(fname)
+
+    def test_best_hits_from_blast9(self):
+        """best_hits_from_blast9 should keep the best hit of each query"""
+        self.assertEqual(best_hits_from_blast9(self.rec2),
+            {'ece:Z4181': ('ecs:ECs3717', 211.0, 3e-54),
+             'ece:Z4182': ('cvi:CV2421', 52.8, 2e-06)})
+        self.assertEqual(best_hits_from_blast9(self.rec2,
+                                               exclude_self_hits=False),
+            {'ece:Z4181': ('ecs:ECs3717', 211.0, 3e-54),
+             'ece:Z4182': ('ece:Z4182', 187.0, 3e-47)})
+        self.assertEqual(best_hits_from_blast9([]), {})
+
+    def test_reciprocal_best_blast_hits(self):
+        """reciprocal_best_blast_hits should find reciprocal pairs"""
+        f = open('test_rbh.fasta', 'w')
+        f.write(self.fasta_recs)
+        f.close()
+        result = reciprocal_best_blast_hits('test_rbh.fasta', 'test_rbh.fasta',
+                                            exclude_self_hits=False,
+                                            num_shards=2, working_dir='.')
+        remove('test_rbh.fasta')
+        self.assertEqual(len(result), 10)
+        for id_1, id_2 in result:
+            self.assertEqual(id_1, id_2)
+
     def test_make_subject_match_scorer(self):
         """make_subject_match_scorer should keep ids matching n queries"""
         qm1 = make_subject_match_scorer(1)
@@ -220,6 +334,37 @@ MSGNIKKIVEPNSGIDYSLEKDFKIFTLSKELPITTYPSYIRLGIVIYCVKGNAKIDIYSNKHIITPKELIIILPGQLVA
         for fname in ['formatdb.log'] + glob('test_bdb*'):
             remove(fname)
 
+    def test_psiblast_n_neighbors_parallel(self):
+        "psiblast_n_neighbors with workers matches the serial results"
+        bdb_seqs = self.fasta_recs
+        f = open('test_bdb', 'w')
+        f.write(bdb_seqs)
+        f.close()
+        temp = popen('formatdb -i test_bdb -o T -p T')
+        lines = bdb_seqs.split('\n')
+        serial = psiblast_n_neighbors(lines, n=12, blast_db='test_bdb',
+                method='two-step', params={'-j': 3},
+                core_threshold=1e-50)
+        parallel = psiblast_n_neighbors(lines, n=12, blast_db='test_bdb',
+                method='two-step', params={'-j': 3},
+                core_threshold=1e-50, num_workers=3)
+        self.assertEqual(sorted(parallel.keys()), sorted(serial.keys()))
+        # the relative database was found from the scratch directories
+        self.assertTrue(parallel)
+        self.assertTrue(any(parallel.values()))
+        for query_id in serial:
+            self.assertEqual(sorted(parallel[query_id]),
+                             sorted(serial[query_id]))
+        # no checkpoint files are left behind
+        self.assertEqual(glob('checkpoint_*.chk'), [])
+        for fname in ['formatdb.log'] + glob('test_bdb*'):
+            remove(fname)
+
+    def test_psiblast_n_neighbors_unknown_method(self):
+        "psiblast_n_neighbors raises TypeError on unknown methods"
+        self.assertRaises(TypeError, psiblast_n_neighbors, ['>a', 'MKV'],
+                          method='xyz', params={'-j': 2})
+
     def test_psiblast_n_neighbors(self):
         "psiblast_n_neighbors psiblasts and stops when n neighbors are reached"
         bdb_seqs = self.fasta_recs
@@ -242,6 +387,20 @@ MSGNIKKIVEPNSGIDYSLEKDFKIFTLSKELPITTYPSYIRLGIVIYCVKGNAKIDIYSNKHIITPKELIIILPGQLVA
         for fname in ['formatdb.log'] + glob('test_bdb*'):
             remove(fname)
 
+    def test_seqs_from_fastacmd_seq_index(self):
+        """seqs_from_fastacmd should read from a FastaIndex if passed"""
+        f = open('test_bdb', 'w')
+        f.write(self.fasta_recs)
+        f.close()
+        seq_index = FastaIndex('test_bdb')
+        result = seqs_from_fastacmd(['gi|100002558|', 'gi|999|'],
+                                    'test_bdb', seq_index=seq_index)
+        seq_index.close()
+        remove('test_bdb')
+        self.assertEqual(result.keys(), ['gi|100002558| Bd2561 Bd2561 '
+            'phosphoglycolate phosphatase 3098389:3099033 forward MW:24182'])
+        self.assertTrue(result.values()[0].startswith('MKKLVIFDLDG'))
+
 
 def wrap_qmes(qmes):
     """Converts qmes into a dict of {q:{m:e}}"""
@@ -11,10 +11,12 @@
 from unittest import TestCase, main
 from os.path import exists
 from os import remove
-from tempfile import mkstemp
+from shutil import rmtree
+from tempfile import mkstemp, mkdtemp
 
 from bfillings.bwa import (BWA_index, BWA_aln, BWA_samse, BWA_sampe, BWA_bwasw,
                         create_bwa_index_from_fasta_file,
+                        get_cached_bwa_index,
                         assign_reads_to_database,
                         InvalidArgumentApplicationError,
                         MissingRequiredArgumentApplicationError)
@@ -281,6 +283,42 @@ class BWAtests(TestCase):
             if filetype not in ('StdOut', 'ExitStatus', 'StdErr'):
                 self.assertEqual(fasta_in + filetype, result.name)
 
+    def test_get_cached_bwa_index(self):
+        """Test get_cached_bwa_index
+
+        Makes sure that the index is built once and then reused.
+        """
+        _, fasta_in = mkstemp(suffix=".fna")
+        fasta = open(fasta_in, 'w')
+        fasta.write(test_fasta)
+        fasta.close()
+        self.files_to_remove.append(fasta_in)
+
+        cache_dir = mkdtemp(prefix='bwa_index_cache_')
+        try:
+            entry = get_cached_bwa_index(fasta_in, cache_dir, {'-a': 'is'})
+            entry.release()
+            for suffix in ('.amb', '.ann', '.bwt', '.pac', '.sa'):
+                self.assertTrue(exists(entry.IndexPrefix + suffix))
+
+            # same reference and params: same index
+            entry2 = get_cached_bwa_index(fasta_in, cache_dir, {'-a': 'is'})
+            entry2.release()
+            self.assertEqual(entry.IndexPrefix, entry2.IndexPrefix)
+
+            # different params: different index
+            entry3 = get_cached_bwa_index(fasta_in, cache_dir,
+                                          {'-a': 'bwtsw'})
+            entry3.release()
+            self.assertNotEqual(entry.IndexPrefix, entry3.IndexPrefix)
+
+            # the prefix is managed by the cache
+            self.assertRaises(InvalidArgumentApplicationError,
+                              get_cached_bwa_index, fasta_in, cache_dir,
+                              {'-p': '/prefix'})
+        finally:
+            rmtree(cache_dir)
+
     def test_assign_reads_to_database(self):
         """Tests for proper failure in assign_reads_to_database
         """
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2013--, biocore development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+#-----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from fcntl import flock, LOCK_EX, LOCK_NB, LOCK_SH, LOCK_UN
+from os import remove, utime
+from os.path import exists, join
+from shutil import rmtree
+from tempfile import mkdtemp, mkstemp
+
+from bfillings.cache import (ContentCache, cache_key, file_digest,
+                             stamped_file_digest)
+
+
+class ContentCacheTests(TestCase):
+
+    """Tests for the on-disk content cache"""
+
+    def setUp(self):
+        self.cache_dir = mkdtemp(prefix='bfillings_cache_test_')
+        self.calls = []
+
+    def tearDown(self):
+        rmtree(self.cache_dir, ignore_errors=True)
+
+    def build(self, contents):
+        """Return a build function writing contents to data.txt"""
+        def build_f(build_dir):
+            self.calls.append(build_dir)
+            f = open(join(build_dir, 'data.txt'), 'w')
+            f.write(contents)
+            f.close()
+        return build_f
+
+    def test_file_digest(self):
+        """file_digest returns the md5 of the file contents"""
+        _, fp = mkstemp()
+        f = open(fp, 'w')
+        f.write('ACGT')
+        f.close()
+        self.assertEqual(file_digest(fp), 'f1f8f4bf413b16ad135722aa4591043e')
+        remove(fp)
+
+    def test_stamped_file_digest(self):
+        """stamped_file_digest is recomputed when the file changes"""
+        fp = join(self.cache_dir, 'seqs.fasta')
+        with open(fp, 'w') as f:
+            f.write('ACGT')
+        self.assertEqual(stamped_file_digest(fp), file_digest(fp))
+        with open(fp, 'w') as f:
+            f.write('ACGTT')
+        utime(fp, (1, 1))
+        self.assertEqual(stamped_file_digest(fp), file_digest(fp))
+
+    def test_cache_key(self):
+        """cache_key is stable and independent of dict ordering"""
+        self.assertEqual(cache_key('abc', {'-a': 'is', '-b': 1}),
+                         cache_key('abc', {'-b': 1, '-a': 'is'}))
+        self.assertNotEqual(cache_key('abc', {'-a': 'is'}),
+                            cache_key('abc', {'-a': 'bwtsw'}))
+        self.assertNotEqual(cache_key('ab', 'c'), cache_key('a', 'bc'))
+
+    def test_get_builds_once(self):
+        """get only calls the build function for missing entries"""
+        cache = ContentCache(self.cache_dir)
+        path1 = cache.get('k1', self.build('x'))
+        path2 = cache.get('k1', self.build('y'))
+        self.assertEqual(path1, path2)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(open(join(path1, 'data.txt')).read(), 'x')
+        self.assertTrue('k1' in cache)
+        self.assertEqual(cache.entries(), ['k1'])
+
+    def test_failed_build(self):
+        """a failing build leaves no entry behind"""
+        def build_f(build_dir):
+            raise ValueError("failed")
+        cache = ContentCache(self.cache_dir)
+        self.assertRaises(ValueError, cache.get, 'k1', build_f)
+        self.assertFalse('k1' in cache)
+        self.assertEqual(cache.entries(), [])
+
+    def test_evict(self):
+        """least recently used entries are evicted beyond the size budget"""
+        cache = ContentCache(self.cache_dir, max_size=25)
+        p1 = cache.get('k1', self.build('a' * 10))
+        p2 = cache.get('k2', self.build('b' * 10))
+        utime(p1, (1, 1))
+        utime(p2, (2, 2))
+        cache.get('k3', self.build('c' * 10))
+        self.assertEqual(sorted(cache.entries()), ['k2', 'k3'])
+        self.assertEqual(cache.size(), 20)
+
+    def test_evict_skips_entries_in_use(self):
+        """entries held open are not evicted"""
+        cache = ContentCache(self.cache_dir, max_size=15)
+        entry = cache.open_entry('k1', self.build('a' * 10))
+        utime(entry.Path, (1, 1))
+        cache.get('k2', self.build('b' * 10))
+        self.assertTrue(exists(entry.Path))
+        entry.release()
+        self.assertEqual(cache.evict(), ['k1'])
+        self.assertEqual(cache.entries(), ['k2'])
+
+    def test_open_entry_concurrent_readers(self):
+        """several readers hold an existing entry at the same time"""
+        cache = ContentCache(self.cache_dir)
+        first = cache.open_entry('k1', self.build('a'))
+        # another reader can take the shared lock without waiting, while
+        # an evicting or building process cannot take the exclusive one
+        lock_file = open(cache._lock_path('k1'), 'a')
+        flock(lock_file, LOCK_SH | LOCK_NB)
+        flock(lock_file, LOCK_UN)
+        self.assertRaises(IOError, flock, lock_file, LOCK_EX | LOCK_NB)
+        lock_file.close()
+
+        second = cache.open_entry('k1', self.build('b'))
+        self.assertEqual(second.Path, first.Path)
+        self.assertEqual(len(self.calls), 1)
+        first.release()
+        self.assertTrue(exists(second.Path))
+        second.release()
+
+    def test_acquire_release(self):
+        """acquired entries are reference counted until released"""
+        cache = ContentCache(self.cache_dir, max_size=0)
+        path = cache.acquire('k1', self.build('a'))
+        self.assertEqual(cache.acquire('k1', self.build('b')), path)
+        self.assertEqual(cache.ref_count(path), 2)
+        self.assertEqual(len(self.calls), 1)
+        cache.release(path)
+        self.assertEqual(cache.evict(), [])
+        cache.release(path)
+        self.assertEqual(cache.ref_count(path), 0)
+        self.assertEqual(cache.evict(), ['k1'])
+        self.assertRaises(ValueError, cache.release, path)
+
+    def test_clear(self):
+        """clear removes all entries"""
+        cache = ContentCache(self.cache_dir)
+        cache.get('k1', self.build('a'))
+        cache.get('k2', self.build('b'))
+        self.assertEqual(sorted(cache.clear()), ['k1', 'k2'])
+        self.assertEqual(cache.entries(), [])
+        self.assertEqual(cache.MaxSize, None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2013--, biocore development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+#-----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os import listdir
+from shutil import rmtree
+from tempfile import mkdtemp
+from os.path import join
+
+from bfillings.dereplicate import Dereplicator, read_id_map, seq_digest
+
+
+class DereplicatorTests(TestCase):
+
+    """Tests for the exact dereplication engine"""
+
+    def setUp(self):
+        self.dir = mkdtemp(prefix='bfillings_derep_test_')
+        self.tmp_dir = mkdtemp(dir=self.dir)
+        self.fasta_fp = join(self.dir, 'uniques.fasta')
+        self.id_map_fp = join(self.dir, 'id_map.txt')
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def test_seq_digest(self):
+        """seq_digest tells apart all distinct sequences"""
+        seqs = ['', 'A', 'AA', 'AAAA', 'C', 'CA', 'AC', 'ACGT', 'ACGN',
+                'acgt', 'TTTTTTTTTTTTTTTTT', 'TTTTTTTTTTTTTTTTTA']
+        digests = [seq_digest(seq) for seq in seqs]
+        self.assertEqual(len(set(digests)), len(seqs))
+        self.assertEqual(len(digests[0]), 16)
+        self.assertEqual(seq_digest('ACGT'), seq_digest('ACGT'))
+
+    def dereplicate(self, max_uniques):
+        dereplicator = Dereplicator(max_uniques=max_uniques,
+                                    num_partitions=3, tmp_dir=self.tmp_dir)
+        num_uniques = dereplicator.dereplicate(seqs, self.fasta_fp,
+                                               self.id_map_fp)
+        return (num_uniques, open(self.fasta_fp).read(),
+                read_id_map(self.id_map_fp))
+
+    def test_dereplicate(self):
+        """identical sequences are collapsed in order of first occurrence"""
+        num_uniques, fasta, id_map = self.dereplicate(100)
+        self.assertEqual(num_uniques, 4)
+        self.assertEqual(fasta, expected_fasta)
+        self.assertEqual(id_map, expected_id_map)
+        self.assertEqual(listdir(self.tmp_dir), [])
+
+    def test_dereplicate_spill(self):
+        """spilling to disk gives the same output"""
+        for max_uniques in 1, 2, 3:
+            num_uniques, fasta, id_map = self.dereplicate(max_uniques)
+            self.assertEqual(num_uniques, 4)
+            self.assertEqual(fasta, expected_fasta)
+            self.assertEqual(id_map, expected_id_map)
+            self.assertEqual(listdir(self.tmp_dir), [])
+
+    def test_dereplicate_split_partition(self):
+        """partitions with more than max_uniques uniques are split again"""
+        many_seqs = [('r%d' % i, 'ACGT' * (i % 50 + 1)) for i in range(200)]
+        splits = []
+
+        class SplittingDereplicator(Dereplicator):
+            def _split_partition(self, partition_fp, id_map_f, depth):
+                splits.append(depth)
+                return Dereplicator._split_partition(self, partition_fp,
+                                                     id_map_f, depth)
+
+        Dereplicator().dereplicate(many_seqs, self.fasta_fp, self.id_map_fp)
+        expected = (open(self.fasta_fp).read(), read_id_map(self.id_map_fp))
+
+        dereplicator = SplittingDereplicator(max_uniques=2, num_partitions=2,
+                                             tmp_dir=self.tmp_dir)
+        num_uniques = dereplicator.dereplicate(many_seqs, self.fasta_fp,
+                                               self.id_map_fp)
+        self.assertEqual(num_uniques, 50)
+        self.assertTrue(splits)
+        self.assertTrue(max(splits) > 1)
+        self.assertEqual((open(self.fasta_fp).read(),
+                          read_id_map(self.id_map_fp)), expected)
+        self.assertEqual(listdir(self.tmp_dir), [])
+
+    def test_record_format(self):
+        """labels and records can be formatted for usearch"""
+        dereplicator = Dereplicator(label_prefix='',
+                                    record_format='>%s;size=%d;\n%s\n')
+        dereplicator.dereplicate(seqs[:2], self.fasta_fp, self.id_map_fp)
+        self.assertEqual(open(self.fasta_fp).read(),
+                         '>s1;size=2;\nACGT\n')
+        self.assertEqual(read_id_map(self.id_map_fp), {'s1': ['s1', 's2']})
+
+
+seqs = [('s1 comment', 'ACGT'), ('s2', 'ACGT'), ('s3', 'ACGTN'),
+        ('s4', 'GGA'), ('s5', 'ACGTN'), ('s6', 'TTTT'), ('s7', 'GGA'),
+        ('s8', 'ACGT')]
+
+expected_fasta = """>ExactMatch.s1_3
+ACGT
+>ExactMatch.s3_2
+ACGTN
+>ExactMatch.s4_2
+GGA
+>ExactMatch.s6_1
+TTTT
+"""
+
+expected_id_map = {'ExactMatch.s1': ['s1', 's2', 's8'],
+                   'ExactMatch.s3': ['s3', 's5'],
+                   'ExactMatch.s4': ['s4', 's7'],
+                   'ExactMatch.s6': ['s6']}
+
+if __name__ == "__main__":
+    main()
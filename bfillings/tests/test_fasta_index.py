@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2013--, biocore development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+#-----------------------------------------------------------------------------
+
+from glob import glob
+from unittest import TestCase, main
+from os import remove
+from os.path import exists
+from tempfile import mkstemp
+
+from bfillings.fasta_index import FastaIndex
+
+
+class FastaIndexTests(TestCase):
+
+    """Tests for the FASTA offset index"""
+
+    def setUp(self):
+        _, self.fasta_fp = mkstemp(suffix='.fasta')
+        f = open(self.fasta_fp, 'w')
+        f.write(fasta)
+        f.close()
+        self.index = FastaIndex(self.fasta_fp, cache_size=2)
+
+    def tearDown(self):
+        self.index.close()
+        remove(self.fasta_fp)
+
+    def test_ids(self):
+        """all records are indexed by the first word of their label"""
+        self.assertEqual(self.index.ids(), ['s1', 's2', 's3'])
+        self.assertEqual(len(self.index), 3)
+        self.assertTrue('s2' in self.index)
+        self.assertFalse('s4' in self.index)
+
+    def test_get_raw(self):
+        """get_raw returns the unparsed record"""
+        self.assertEqual(self.index.get_raw('s2'),
+                         '>s2 second seq\nGGGG\nTT\n')
+        self.assertEqual(self.index.get_raw('s3'), '>s3\nCCC')
+
+    def test_get_records(self):
+        """get_records returns records in the requested order, once each"""
+        self.assertEqual(self.index.get_records(['s3', 's4', 's1', 's3']),
+                         [('s3', 'CCC'), ('s1 first seq', 'ACGT')])
+        self.assertEqual(self.index.get_records(['s1', 's2', 's1', 's2']),
+                         [('s1 first seq', 'ACGT'),
+                          ('s2 second seq', 'GGGGTT')])
+        self.assertEqual(self.index.get_records([]), [])
+
+    def test_get_record(self):
+        """get_record returns a single record"""
+        self.assertEqual(self.index.get_record('s2'),
+                         ('s2 second seq', 'GGGGTT'))
+        self.assertRaises(KeyError, self.index.get_record, 's4')
+
+    def test_cache(self):
+        """only the most recently fetched records are cached"""
+        self.index.get_records(['s1', 's2'])
+        self.index.get_records(['s1'])
+        self.index.get_records(['s3'])
+        self.assertEqual(self.index._cache.keys(), ['s1', 's3'])
+
+    def test_write_records(self):
+        """write_records copies raw records in file order"""
+        _, out_fp = mkstemp(suffix='.fasta')
+        out_f = open(out_fp, 'w')
+        self.assertEqual(self.index.write_records(['s3', 's4', 's2', 's3'],
+                                                  out_f), 2)
+        out_f.close()
+        self.assertEqual(open(out_fp).read(),
+                         '>s2 second seq\nGGGG\nTT\n>s3\nCCC\n')
+        remove(out_fp)
+
+    def test_persist(self):
+        """persisted indexes are reused until the FASTA file changes"""
+        index = FastaIndex(self.fasta_fp, persist=True)
+        index.close()
+        index_fp = self.fasta_fp + '.fidx'
+        self.assertTrue(exists(index_fp))
+
+        # a stale-looking index is only used if size and mtime match
+        lines = open(index_fp).readlines()
+        f = open(index_fp, 'w')
+        f.write(lines[0] + 's9\t0\t14\n')
+        f.close()
+        index = FastaIndex(self.fasta_fp, persist=True)
+        self.assertEqual(index.ids(), ['s9'])
+        index.close()
+
+        f = open(self.fasta_fp, 'a')
+        f.write('\n>s4\nA\n')
+        f.close()
+        index = FastaIndex(self.fasta_fp, persist=True)
+        self.assertEqual(index.ids(), ['s1', 's2', 's3', 's4'])
+        self.assertEqual(index.get_raw('s3'), '>s3\nCCC\n')
+        index.close()
+        # indexes are written through uniquely named temporary files
+        self.assertEqual(glob(index_fp + '*'), [index_fp])
+        remove(index_fp)
+
+    def test_empty_file(self):
+        """empty files can be indexed"""
+        _, fp = mkstemp(suffix='.fasta')
+        index = FastaIndex(fp)
+        self.assertEqual(index.ids(), [])
+        self.assertEqual(index.get_records(['s1']), [])
+        index.close()
+        remove(fp)
+
+
+fasta = """>s1 first seq
+ACGT
+>s2 second seq
+GGGG
+TT
+>s1 duplicate
+AAAA
+>s3
+CCC"""
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,8 @@ File created on 16 Sep 2009.
 """
 from __future__ import division
 from os.path import split, exists
+from shutil import rmtree
+from tempfile import mkdtemp
 from unittest import TestCase, main
 
 from skbio.util import remove_files
@@ -23,7 +25,9 @@ from cogent.app.util import get_tmp_filename
 from bfillings.blast import blastn
 from bfillings.formatdb import (FormatDb, build_blast_db_from_seqs,
                              build_blast_db_from_fasta_path,
-                             build_blast_db_from_fasta_file)
+                             build_blast_db_from_fasta_file,
+                             release_cached_blast_db)
+from bfillings.cache import ContentCache
 
 
 class FormatDbTests(TestCase):
@@ -191,6 +195,42 @@ class FormatDbTests(TestCase):
         for fp in db_files:
             self.assertFalse(exists(fp))
 
+    def test_build_blast_db_cached(self):
+        """the builders reuse databases kept in a cache
+        """
+        cache_dir = mkdtemp(prefix='FormatDbTests')
+        try:
+            cache = ContentCache(cache_dir, max_size=0)
+            blast_db, db_files = \
+             build_blast_db_from_fasta_path(self.in_seqs1_fp, cache=cache)
+            self.assertEqual(db_files, [])
+            self.assertTrue(blast_db.startswith(cache_dir))
+            for ext in ['.nhr','.nin','.nsq']:
+                self.assertTrue(exists(blast_db + ext))
+            self.assertEqual(\
+                len(blastn(self.test_seq,blast_db=blast_db)),1)
+
+            # same sequences from an open file: same database
+            blast_db2, db_files2 = build_blast_db_from_fasta_file(\
+             open(self.in_seqs1_fp), output_dir='/tmp/', cache=cache)
+            self.assertEqual(blast_db2, blast_db)
+            self.assertEqual(cache.ref_count(split(blast_db)[0]), 2)
+
+            # a protein database of the same sequences is a different one
+            blast_db3, _ = build_blast_db_from_fasta_path(self.in_seqs1_fp,
+                is_protein=True, cache=cache)
+            self.assertNotEqual(blast_db3, blast_db)
+
+            # databases in use are not evicted
+            release_cached_blast_db(blast_db, cache)
+            self.assertEqual(cache.evict(), [])
+            release_cached_blast_db(blast_db2, cache)
+            release_cached_blast_db(blast_db3, cache)
+            self.assertEqual(len(cache.evict()), 2)
+            self.assertFalse(exists(blast_db + '.nsq'))
+        finally:
+            rmtree(cache_dir)
+
 
 in_seqs1 = """>11472286
 GATGAACGCTGGCGGCATGCTTAACACATGCAAGTCGAACGGAACACTTTGTGTTTTGAGTTAATAGTTCGATAGTAGATAGTAAATAGTGAACACTATGAACTAGTAAACTATTTAACTAGAAACTCTTAAACGCAGAGCGTTTAGTGGCGAACGGGTGAGTAATACATTGGTATCTACCTCGGAGAAGGACATAGCCTGCCGAAAGGTGGGGTAATTTCCTATAGTCCCCGCACATATTTGTTCTTAAATCTGTTAAAATGATTATATGTTTTATGTTTATTTGATAAAAAGCAGCAAGACAAATGAGTTTTATATTGGTTATACAGCAGATTTAAAAAATAGAATTAGGTCTCATAATCAGGGAGAAAACAAATCAACTAAATCTAAAATACCTTGGGAATTGGTTTACTATGAAGCCTACAAAAACCAAACATCAGCAAGGGTTAGAGAATCAAAGTTGAAACATTATGGGCAATCATTAACTAGACTTAAGAGAAGAATTGGTTTTTGAGAACAAATATGTGCGGGGTAAAGCAGCAATGCGCTCCGAGAGGAACCTCTGTCCTATCAGCTTGTTGGTAAGGTAATGGCTTACCAAGGCGACGACGGGTAGCTGGTGTGAGAGCACGACCAGCCACACTGGGACTGAGACACGGCCCAGACTCCTACGGGAGGCAGCAGTGAGGAATTTTCCACAATGGGCGCAAGCCTGATGGAGCAATGCCGCGTGAAGGATGAAGATTTTCGGATTGTAAACTTCTTTTAAGTAGGAAGATTATGACGGTACTACTTGAATAAGCATCGGCTAACTACGTGCCAGCAGCCGCGGTAATACGTAGGATGCAAGCGTTATCCGGAATTACTGGGCGTAAAGCGTGTGTAGGTGGTTTATTAAGTTAAATGTTAAATTTTCAGGCTTAACTTGGAAACCGCATTTAATACTGGTAGACTTTGAGGACAAGAGAGGCAGGCGGAATTAGCGGAGTAGCGGTGAAATGCGTAGATATCGCTAAGAACACCAATGGCGAAGGCAGCCTGCTGGTTTGCACCTGACACTGAGATACGAAAGCGTGGGGAGCGAACGGGATTAGATACCCCGGTAGTCCACGCCGTAAACGATGGTCACTAGCTGTTAGGGGCTCGACCCCTTTAGTAGCGAAGCTAACGCGTTAAGTGACCCGCCTGGGGAGTACGATCGCAAGATTAAAACTCAAAGGAATTGACGGGGACCCGCACAAGCGGTGGAACGTGAGGTTTAATTCGTCTCTAAGCGAAAAACCTTACCGAGGCTTGACATCTCCGGAAGACCTTAGAAATAAGGTTGTGCCCGAAAGGGAGCCGGATGACAGGTGCTGCATGGCTGTCGTCAGCTCGTGTTGTGAAATGTTCGGTTAAGTCCGTTAACGAGCGCAACCCTTGCTGTGTGTTGTATTTTTCACACAGGACTATCCTGGTCAACAGGGAGGAAGGTGGGGATGACGTCAAGTCAGCATGGCTCTTACGCCTCGGGCTACACTCGCGTTACAATGGCCGGTACAATGGGCTGCCAACTCGTAAGGGGGAGCTAATCCCATCAAAACCGGTCCCAGTTCGGATTGAGGGCTGCAATTCGCCCTCATGAAGTCGGAATCGCTAGTAACCGCGAATCAGCACGTCGCGGTGAATGCGTTCTCGGGTCTTGTACACACTGCCCGTCACACCACGAAAGTTAGTAACGCCCGAAGTGCCCTGTATGGGGTCCTAAGGTGGGGCTAGCGATTGGGGTG
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2013--, biocore development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+#-----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+
+from bfillings.id_index import IdIndex
+
+
+class IdIndexTests(TestCase):
+
+    """Tests for the integer indexing of ids"""
+
+    def test_indices(self):
+        """ids are indexed in order of first use"""
+        ids = IdIndex()
+        self.assertEqual(ids.indices(['b', 'a', 'b']).tolist(), [0, 1, 0])
+        self.assertEqual(ids.indices(['c', 'a']).tolist(), [2, 1])
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(ids[2], 'c')
+        self.assertEqual(ids.index('a'), 1)
+        self.assertRaises(KeyError, ids.index, 'd')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2013--, biocore development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+#-----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from bfillings.memory_model import MemoryModel, sequence_profile
+
+
+class MemoryModelTests(TestCase):
+
+    """Tests for the measurement-corrected memory estimates"""
+
+    def setUp(self):
+        self.dir = mkdtemp(prefix='bfillings_memory_model_test_')
+        self.stats_fp = join(self.dir, 'memory.json')
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def test_sequence_profile(self):
+        """sequences are counted once per distinct sequence"""
+        seqs_fp = join(self.dir, 'seqs.fasta')
+        with open(seqs_fp, 'w') as f:
+            f.write('>s1\nACGTACGT\n>s2\nacgtacgt\n>s3\nACG\n>s4\nGGGGGG\n')
+        self.assertEqual(sequence_profile(seqs_fp, minlen=4),
+                         {'num_seqs': 3, 'num_uniques': 2,
+                          'unique_residues': 14, 'max_len': 8})
+        self.assertEqual(sequence_profile(seqs_fp)['num_uniques'], 3)
+
+    def test_correction(self):
+        """estimates are scaled by the worst recent measurement"""
+        model = MemoryModel(self.stats_fp, history=2)
+        self.assertEqual(model.estimate('fast', 1000), 1000)
+        model.record('fast', 1000, 3000)
+        model.record('fast', 1000, 1500)
+        self.assertEqual(model.estimate('fast', 1000), 3000)
+        self.assertEqual(model.estimate('smallmem', 1000), 1000)
+        # older measurements are forgotten
+        model.record('fast', 1000, 500)
+        self.assertEqual(model.estimate('fast', 1000), 1500)
+
+    def test_persistence(self):
+        """measurements are shared through the stats file"""
+        MemoryModel(self.stats_fp).record('fast', 1000, 2000)
+        MemoryModel(self.stats_fp).record('fast', 1000, 1000)
+        self.assertEqual(MemoryModel(self.stats_fp).correction('fast'), 2.0)
+
+        with open(self.stats_fp, 'w') as f:
+            f.write('{"truncated')
+        self.assertEqual(MemoryModel(self.stats_fp).correction('fast'), 1.0)
+
+        model = MemoryModel()
+        model.record('fast', 1000, 4000)
+        self.assertEqual(model.correction('fast'), 4.0)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,7 +10,9 @@
 
 from __future__ import with_statement
 from cStringIO import StringIO
-from os import remove, rmdir
+from os import listdir, remove, rmdir
+from os.path import join
+from shutil import rmtree
 from tempfile import mkdtemp, mkstemp, NamedTemporaryFile
 from unittest import TestCase, main
 
@@ -223,6 +225,33 @@ class TestMothurClassifySeqs(TestCase):
             }
         self.assertEqual(res, exp_res)
 
+    def test_mothur_classify_file_cached_reference(self):
+        """prepared references are kept and reused between calls"""
+        cache_dir = mkdtemp(prefix='bfillings_mothur_ref_cache_')
+        try:
+            exp_res = mothur_classify_file(
+                StringIO(mothur_seqs), self.ref_file.name,
+                self.tax_file.name)
+            for i in range(2):
+                res = mothur_classify_file(
+                    StringIO(mothur_seqs), self.ref_file.name,
+                    self.tax_file.name, ref_cache_dir=cache_dir)
+                self.assertEqual(res, exp_res)
+            entries = [e for e in listdir(cache_dir)
+                       if not e.endswith('.lock')]
+            self.assertEqual(len(entries), 1)
+            # Mothur's training files are kept with the prepared copies
+            self.assertTrue(len(listdir(join(cache_dir, entries[0]))) > 2)
+        finally:
+            rmtree(cache_dir)
+
+    def test_mothur_classify_file_cache_dir_with_dash(self):
+        """cache directories Mothur cannot use are rejected"""
+        self.assertRaises(ValueError, mothur_classify_file,
+                          StringIO(mothur_seqs), self.ref_file.name,
+                          self.tax_file.name,
+                          ref_cache_dir='/tmp/mothur-ref-cache')
+
     def test_unclassifiable_sequence(self):
         query_file = StringIO(
             ">MostlyTs\nTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTT"
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2013--, biocore development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+#-----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from StringIO import StringIO
+
+from bfillings.rdp_assignments import parse_rdp_assignments
+from bfillings.rdp_classifier import get_rdp_lineage, parse_rdp_assignment
+
+
+class RdpAssignmentsTests(TestCase):
+
+    """Tests for the columnar fixrank assignment parser"""
+
+    def setUp(self):
+        self.lines = fixrank_assignments.splitlines(True)
+
+    def test_parse(self):
+        """assignments are parsed into arrays, chunk by chunk"""
+        for chunk_size in 1, 2, 100:
+            rdp = parse_rdp_assignments(self.lines, chunk_size)
+            self.assertEqual(rdp.SeqIds, ['X67228', 'X73443', 'AB004750'])
+            self.assertEqual(rdp.Ranks, ['norank', 'domain', 'phylum',
+                                         'class', 'order', 'family', 'genus'])
+            self.assertEqual(rdp.Taxa.shape, (3, 7))
+            # Root is not part of lineages, and quotes are stripped
+            self.assertEqual(rdp.Taxa[:, 0].tolist(), [-1, -1, -1])
+            self.assertEqual(rdp.TaxonNames[rdp.Taxa[0, 2]],
+                             'Proteobacteria')
+            self.assertEqual(rdp.Confidences[1].tolist(),
+                             [1.0, 1.0, 0.98, 0.82, 0.55, 0.55, 0.2])
+
+    def test_lineages(self):
+        """lineages match those of parse_rdp_assignment/get_rdp_lineage"""
+        rdp = parse_rdp_assignments(self.lines, 2)
+        for min_confidence in 0.0, 0.5, 0.8, 0.95, 1.0:
+            expected = {}
+            for line in self.lines:
+                seq_id, _, taxa = parse_rdp_assignment(line)
+                if taxa[0][0] == 'Root':
+                    taxa = taxa[1:]
+                lineage, confidence = get_rdp_lineage(taxa, min_confidence)
+                expected[seq_id] = (';'.join(lineage) or 'Unclassified',
+                                    confidence)
+            self.assertEqual(rdp.to_dict(min_confidence), expected)
+
+        self.assertEqual(
+            rdp.to_dict(0.8)['X73443'],
+            ('Bacteria;Firmicutes;Clostridia', 0.82))
+        self.assertEqual(rdp.to_dict(1.1)['X73443'], ('Unclassified', 1.0))
+
+    def test_write(self):
+        """assignments are written with mapped ids and unassignable ones"""
+        rdp = parse_rdp_assignments(self.lines)
+        id_map = {'X67228': 'X67228 a', 'X73443': 'X73443 b',
+                  'AB004750': 'AB004750 c'}
+        output = StringIO()
+        rdp.write(output, 0.9, id_map, ['short', 'X67228 a'])
+        self.assertEqual(output.getvalue(), (
+            "X67228 a\tBacteria;Proteobacteria;Alphaproteobacteria;"
+            "Rhizobiales\t0.900\n"
+            "X73443 b\tBacteria;Firmicutes\t0.980\n"
+            "AB004750 c\tBacteria;Proteobacteria\t1.000\n"
+            "short\tUnassignable\t1.000\n"))
+        self.assertEqual(rdp.to_dict(0.9, id_map, ['short'])['short'],
+                         ('Unassignable', 1.0))
+
+    def test_invalid(self):
+        """lines of differing or malformed ranks are rejected"""
+        self.assertRaises(ValueError, parse_rdp_assignments,
+                          [self.lines[0], 'X1\t\tRoot\tnorank\t1.0\n'])
+        self.assertRaises(ValueError, parse_rdp_assignments,
+                          ['X1\t\tRoot\tnorank\n'])
+        self.assertEqual(len(parse_rdp_assignments([])), 0)
+
+
+fixrank_assignments = """\
+X67228\t\tRoot\tnorank\t1.0\tBacteria\tdomain\t1.0\t"Proteobacteria"\tphylum\t\
+1.0\tAlphaproteobacteria\tclass\t0.9\tRhizobiales\torder\t0.9\tRhizobiaceae\t\
+family\t0.47\tRhizobium\tgenus\t0.46
+X73443\t\tRoot\tnorank\t1.0\tBacteria\tdomain\t1.0\tFirmicutes\tphylum\t0.98\t\
+Clostridia\tclass\t0.82\tClostridiales\torder\t0.55\tClostridiaceae\tfamily\t\
+0.55\tClostridium\tgenus\t0.2
+AB004750\t-\tRoot\tnorank\t1.0\tBacteria\tdomain\t1.0\tProteobacteria\tphylum\t\
+1.0\t\tclass\t0.4\tEnterobacteriales\torder\t0.3\tEnterobacteriaceae\tfamily\t\
+0.3\tEnterobacter\tgenus\t0.3
+"""
+
+if __name__ == "__main__":
+    main()
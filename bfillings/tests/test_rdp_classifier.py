@@ -12,13 +12,18 @@
 from cStringIO import StringIO
 from os import getcwd, environ, remove, listdir
 from shutil import rmtree
+from subprocess import Popen, PIPE
+import sys
 import tempfile
 from unittest import TestCase, main
+import warnings
 
 from bfillings.rdp_classifier import (RdpClassifier, RdpTrainer, assign_taxonomy,
                                    train_rdp_classifier,
                                    train_rdp_classifier_and_assign_taxonomy,
-                                   parse_rdp_assignment)
+                                   parse_rdp_assignment, get_rdp_worker,
+                                   close_rdp_workers, assign_taxonomy_chunked,
+                                   get_cached_rdp_model, RdpClassifierWorker)
 
 
 class RdpClassifierTests(TestCase):
@@ -266,6 +271,73 @@ class RdpWrapperTests(TestCase):
         for a,e in zip(actual_file_output,expected_file_headers):
             self.assertTrue(a.startswith(e))
 
+    def test_assign_taxonomy_persistent(self):
+        """ assign_taxonomy gives the same results with a persistent worker
+        """
+        def lineages(assignments):
+            # confidences are bootstrap estimates, and vary between runs
+            return dict((seq_id, lineage) for seq_id, (lineage, _)
+                        in assignments.items())
+
+        # at min_confidence 0.0 lineages do not depend on the bootstrap
+        expected = lineages(assign_taxonomy(self.test_input1,
+                                            min_confidence=0.0))
+        try:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always', RuntimeWarning)
+                for i in range(2):
+                    obs_assignments = assign_taxonomy(self.test_input1,
+                                                      min_confidence=0.0,
+                                                      persistent=True)
+                    self.assertEqual(lineages(obs_assignments), expected)
+                worker = get_rdp_worker()
+                self.assertEqual(
+                    assign_taxonomy(['>MySeq 1',
+                                     'TTCCGGTTGATCCTGCCGGACCCGACTGCTATCCGGA'],
+                                    persistent=True),
+                    {'MySeq 1': ('Unassignable', 1.0)})
+                self.assertTrue(get_rdp_worker() is worker)
+            # the JVM is only kept between batches if the classifier does
+            # not exit after each of them, which is reported once
+            self.assertEqual(worker.IsRunning, not worker.BatchExits)
+            self.assertTrue(worker.BatchExits in (0, 3))
+            exit_warnings = [w for w in caught
+                             if 'started again' in str(w.message)]
+            self.assertEqual(len(exit_warnings), min(worker.BatchExits, 1))
+        finally:
+            close_rdp_workers()
+        self.assertFalse(worker.IsRunning)
+
+    def test_assign_taxonomy_chunked(self):
+        """ assign_taxonomy_chunked writes the assignments of all chunks
+        """
+        _, output_fp = tempfile.mkstemp(prefix='RDPAssignTaxonomyTests',
+                                        suffix='.txt')
+        try:
+            assign_taxonomy_chunked(self.test_input1, output_fp,
+                                    min_confidence=0.95, chunk_size=2,
+                                    workers=2, max_memory='2000m')
+            obs_seq_ids = [line.split('\t')[0] for line in open(output_fp)]
+        finally:
+            remove(output_fp)
+        self.assertEqual(sorted(obs_seq_ids),
+                         sorted(self.expected_assignments1))
+
+    def test_assign_taxonomy_chunked_invalid(self):
+        """ assign_taxonomy_chunked checks its parameters before running
+        """
+        self.assertRaises(ValueError, assign_taxonomy_chunked,
+                          self.test_input1, '/does/not/exist', workers=0)
+        self.assertRaises(ValueError, assign_taxonomy_chunked,
+                          self.test_input1, '/does/not/exist', chunk_size=0)
+        # less than a megabyte per JVM
+        self.assertRaises(ValueError, assign_taxonomy_chunked,
+                          self.test_input1, '/does/not/exist',
+                          max_memory='1m', workers=2)
+        self.assertRaises(ValueError, assign_taxonomy_chunked,
+                          self.test_input1, '/does/not/exist',
+                          max_memory='lots')
+
     def test_train_rdp_classifier(self):
         results = train_rdp_classifier(
             self.reference_file, self.taxonomy_file, self.training_dir)
@@ -310,6 +382,94 @@ class RdpWrapperTests(TestCase):
             )}
         self.assertEqual(obs, exp)
 
+    def test_train_rdp_classifier_and_assign_taxonomy_model_cache(self):
+        model_cache_dir = tempfile.mkdtemp(prefix='RdpModelCache_')
+        exp = {'X67228': (
+            'Bacteria;Proteobacteria;Alphaproteobacteria;Rhizobiales;'
+            'Rhizobiaceae;Rhizobium', 1.0
+            )}
+        try:
+            for i in range(2):
+                self.reference_file.seek(0)
+                self.taxonomy_file.seek(0)
+                obs = train_rdp_classifier_and_assign_taxonomy(
+                    self.reference_file, self.taxonomy_file,
+                    self.test_trained_input, model_cache_dir=model_cache_dir)
+                self.assertEqual(obs, exp)
+            models = [e for e in listdir(model_cache_dir)
+                      if not e.endswith('.lock')]
+            self.assertEqual(len(models), 1)
+
+            self.reference_file.seek(0)
+            self.taxonomy_file.seek(0)
+            with get_cached_rdp_model(self.reference_file, self.taxonomy_file,
+                                      model_cache_dir) as model:
+                self.assertEqual(
+                    sorted(listdir(model.Path)),
+                    ['RdpClassifier.properties', 'bergeyTrainingTree.xml',
+                     'genus_wordConditionalProbList.txt', 'logWordPrior.txt',
+                     'wordConditionalProbIndexArr.txt'])
+                self.assertTrue(model.PropertiesFp.endswith(
+                    'RdpClassifier.properties'))
+        finally:
+            rmtree(model_cache_dir)
+
+
+class FakeRdpClassifierWorker(RdpClassifierWorker):
+    """Runs a Python stand-in for the JVM, which exits after each batch if
+    ExitAfterBatch is set, and answers OK otherwise"""
+
+    ExitAfterBatch = False
+
+    def _start(self):
+        if self.ExitAfterBatch:
+            script = 'import sys; sys.stdin.readline()'
+        else:
+            script = ('import sys\n'
+                      'for line in iter(sys.stdin.readline, ""):\n'
+                      '    sys.stdout.write("OK\\n"); sys.stdout.flush()\n')
+        self._stderr = tempfile.TemporaryFile(dir=self.TmpDir)
+        self._process = Popen([sys.executable, '-c', script], stdin=PIPE,
+                              stdout=PIPE, stderr=self._stderr)
+
+
+class RdpClassifierWorkerTests(TestCase):
+
+    """Tests of the worker protocol, without the RDP Classifier"""
+
+    def classify(self, worker, num_batches):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', RuntimeWarning)
+            for i in range(num_batches):
+                self.assertEqual(worker.classify('query.fasta', 'out.txt'),
+                                 [])
+        return caught
+
+    def test_persistent(self):
+        """the JVM is kept between batches"""
+        worker = FakeRdpClassifierWorker(idle_timeout=None)
+        try:
+            caught = self.classify(worker, 3)
+            self.assertTrue(worker.IsRunning)
+            self.assertEqual(worker.BatchExits, 0)
+            self.assertEqual(caught, [])
+        finally:
+            worker.close()
+        self.assertFalse(worker.IsRunning)
+
+    def test_exit_after_batch(self):
+        """exits after each batch are counted, and reported once"""
+        worker = FakeRdpClassifierWorker(idle_timeout=None)
+        worker.ExitAfterBatch = True
+        try:
+            caught = self.classify(worker, 3)
+            self.assertFalse(worker.IsRunning)
+            self.assertEqual(worker.BatchExits, 3)
+            self.assertEqual(len(caught), 1)
+            self.assertTrue(issubclass(caught[0].category, RuntimeWarning))
+        finally:
+            worker.close()
+
 # Sample data copied from rdp_classifier-2.0, which is licensed under
 # the GPL 2.0 and Copyright 2008 Michigan State University Board of
 # Trustees
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2013--, biocore development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+#-----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import numpy as np
+from numpy.testing import assert_almost_equal
+
+from bfillings.sortmerna_hits import (SortmernaHits, filter_hits, best_hits,
+                                      otu_map)
+
+
+class SortmernaHitsTests(TestCase):
+
+    """Tests for the columnar SortMeRNA alignment parser"""
+
+    def setUp(self):
+        self.dir = mkdtemp(prefix='bfillings_sortmerna_hits_test_')
+        self.blast_fp = join(self.dir, 'sortmerna_map.blast')
+        with open(self.blast_fp, 'w') as f:
+            f.write(blast_alignments)
+        self.sam_fp = join(self.dir, 'sortmerna_map.sam')
+        with open(self.sam_fp, 'w') as f:
+            f.write(sam_alignments)
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def test_read_blast(self):
+        """tabular alignments are parsed, skipping NULL alignments"""
+        for chunk_size in 1, 2, 100:
+            parser = SortmernaHits(chunk_size=chunk_size)
+            hits = parser.read(self.blast_fp)
+            self.assertEqual(len(hits), 4)
+            self.assertEqual([parser.QueryIds[q] for q in hits['query']],
+                             ['r1', 'r1', 'r2', 'r3'])
+            self.assertEqual([parser.SubjectIds[s] for s in hits['subject']],
+                             ['ref1', 'ref2', 'ref1', 'ref2'])
+            assert_almost_equal(hits['pid'], [97.3, 99.0, 100.0, 90.0], 5)
+            assert_almost_equal(hits['evalue'], [1e-50, 1e-60, 1e-70, 1e-5])
+            assert_almost_equal(hits['bitscore'], [418, 430, 440, 100])
+            assert_almost_equal(hits['coverage'], [100, 100, 100, 80])
+            self.assertEqual(parser.cigar(self.blast_fp, hits['offset'][3]),
+                             '10M')
+
+    def test_read_sam(self):
+        """SAM alignments are parsed, deriving identity and coverage"""
+        parser = SortmernaHits(fmt='sam', chunk_size=2)
+        hits = parser.read(self.sam_fp)
+        self.assertEqual(len(hits), 2)
+        self.assertEqual([parser.QueryIds[q] for q in hits['query']],
+                         ['r1', 'r3'])
+        assert_almost_equal(hits['pid'], [90.0, 100.0])
+        assert_almost_equal(hits['coverage'], [100.0, 80.0])
+        assert_almost_equal(hits['bitscore'], [418, 100])
+        self.assertTrue(np.isnan(hits['evalue']).all())
+        self.assertEqual(parser.cigar(self.sam_fp, hits['offset'][1]),
+                         '2S8M')
+
+    def test_filter_and_best_hits(self):
+        """hits are filtered and reduced to the best one per read"""
+        parser = SortmernaHits(chunk_size=1)
+        hits = parser.read(self.blast_fp)
+        self.assertEqual(len(filter_hits(hits, min_pid=97,
+                                         min_coverage=97)), 3)
+        self.assertEqual(len(filter_hits(hits, max_evalue=1e-55)), 2)
+
+        best = best_hits(hits)
+        self.assertEqual([parser.SubjectIds[s] for s in best['subject']],
+                         ['ref2', 'ref1', 'ref2'])
+        # the same reduction is done while reading
+        best_read = parser.read(self.blast_fp, best=True)
+        self.assertEqual(best_read.tolist(), best.tolist())
+
+    def test_otu_map(self):
+        """an OTU map is derived from the hits"""
+        parser = SortmernaHits()
+        hits = parser.read(self.blast_fp, min_pid=97, best=True)
+        self.assertEqual(otu_map(hits, parser.QueryIds, parser.SubjectIds),
+                         {'ref1': ['r2'], 'ref2': ['r1']})
+        self.assertEqual(otu_map(hits[:0], parser.QueryIds,
+                                 parser.SubjectIds), {})
+
+    def test_invalid_format(self):
+        """unknown formats are rejected"""
+        self.assertRaises(ValueError, SortmernaHits, 'bam')
+
+
+blast_alignments = """\
+r1\tref1\t97.3\t300\t8\t0\t1\t300\t10\t309\t1e-50\t418\t300M\t100
+r1\tref2\t99.0\t300\t3\t0\t1\t300\t10\t309\t1e-60\t430\t300M\t100
+random\t*\t0\t0\t0\t0\t0\t0\t0\t0\t0\t0\t*\t0
+r2\tref1\t100\t300\t0\t0\t1\t300\t10\t309\t1e-70\t440\t300M\t100
+r3\tref2\t90.0\t10\t1\t0\t3\t12\t1\t10\t1e-5\t100\t10M\t80
+"""
+
+sam_alignments = """\
+@HD\tVN:1.0\tSO:unsorted
+@PG\tID:sortmerna\tVN:2.0\tCL:sortmerna
+r1\t0\tref1\t10\t255\t10M\t*\t0\t0\tACGTACGTAC\t*\tAS:i:418\tNM:i:1
+random\t4\t*\t0\t0\t*\t*\t0\t0\tACGT\t*
+r3\t0\tref2\t1\t255\t2S8M\t*\t0\t0\tACGTACGTAC\t*\tAS:i:100\tNM:i:0
+"""
+
+if __name__ == "__main__":
+    main()
@@ -15,7 +15,7 @@ Unit tests for the SortMeRNA version 2.0 Application controller
 
 from unittest import TestCase, main
 import re
-from os import close
+from os import close, listdir
 from os.path import abspath, exists, join, dirname
 from tempfile import mkstemp, mkdtemp
 from shutil import rmtree
@@ -24,6 +24,7 @@ from skbio.util import remove_files
 from skbio.parse.sequences import parse_fasta
 
 from bfillings.sortmerna_v2 import (build_database_sortmerna,
+                                 get_cached_sortmerna_db,
                                  sortmerna_ref_cluster,
                                  sortmerna_map)
 
@@ -158,17 +159,53 @@ class SortmernaV2Tests(TestCase):
                                     "sortmerna_otus.blast")))
 
     def test_empty_result_path(self):
-        """ SortMeRNA should fail with an empty indexed database
+        """ SortMeRNA should fail with neither an indexed database
+            nor reference sequences
         """
         self.assertRaises(ValueError,
                           sortmerna_ref_cluster,
                           seq_path=self.file_read_seqs_fp,
                           sortmerna_db=None,
-                          refseqs_fp=self.file_reference_seq_fp,
+                          refseqs_fp=None,
                           result_path=join(self.output_dir,
                                            "sortmerna_otus.txt")
                           )
 
+    def test_get_cached_sortmerna_db(self):
+        """ The index registry should build an index once and reuse it
+        """
+        cache_dir = join(self.output_dir, 'index_cache')
+
+        entry = get_cached_sortmerna_db(self.file_reference_seq_fp,
+                                        cache_dir=cache_dir,
+                                        max_pos=250)
+        entry.release()
+        for ext in ['.bursttrie_0.dat', '.kmer_0.dat', '.pos_0.dat',
+                    '.stats']:
+            self.assertTrue(exists(entry.DbName + ext))
+
+        # same reference and params: same index
+        entry2 = get_cached_sortmerna_db(self.file_reference_seq_fp,
+                                         cache_dir=cache_dir,
+                                         max_pos=250)
+        entry2.release()
+        self.assertEqual(entry.DbName, entry2.DbName)
+
+        # different params: different index
+        entry3 = get_cached_sortmerna_db(self.file_reference_seq_fp,
+                                         cache_dir=cache_dir)
+        entry3.release()
+        self.assertNotEqual(entry.DbName, entry3.DbName)
+
+        # the database can be omitted, and is taken from the registry
+        cluster_map, failures, smr_files_to_remove = sortmerna_ref_cluster(
+            seq_path=self.file_read_seqs_fp,
+            refseqs_fp=self.file_reference_seq_fp,
+            result_path=join(self.output_dir, "sortmerna_otus.txt"),
+            index_cache_dir=cache_dir)
+        self.assertTrue(len(cluster_map) > 0)
+        self.assertEqual(len(listdir(cache_dir)), 4)
+
     def test_sortmerna_default_param(self):
         """ SortMeRNA version 2.0 reference OTU picking works with default settings
         """
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2013--, biocore development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+#-----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Event, Lock
+
+from bfillings.stages import StageExecutor, StageManifest
+
+
+class StageExecutorTests(TestCase):
+
+    """Tests for the dependency-aware stage executor"""
+
+    def test_run_serial(self):
+        """stages get the results of their dependencies"""
+        calls = []
+
+        def stage(name):
+            def f(*args):
+                calls.append(name)
+                return name + ''.join(args)
+            return f
+
+        for max_workers in 1, 4:
+            calls[:] = []
+            stages = StageExecutor(max_workers=max_workers)
+            stages.add_stage('a', stage('a'))
+            stages.add_stage('b', stage('b'), ['a'])
+            stages.add_stage('c', stage('c'), ['a'])
+            stages.add_stage('d', stage('d'), ['c', 'b'])
+            self.assertEqual(stages.run(),
+                             {'a': 'a', 'b': 'ba', 'c': 'ca', 'd': 'dcaba'})
+            self.assertEqual(calls[0], 'a')
+            self.assertEqual(calls[-1], 'd')
+            if max_workers == 1:
+                # serial runs follow the order of add_stage
+                self.assertEqual(calls, ['a', 'b', 'c', 'd'])
+
+    def test_run_concurrent(self):
+        """independent stages run at the same time"""
+        b_started = Event()
+        c_started = Event()
+
+        def b(a):
+            b_started.set()
+            return c_started.wait(10)
+
+        def c(a):
+            c_started.set()
+            return b_started.wait(10)
+
+        stages = StageExecutor(max_workers=2)
+        stages.add_stage('a', lambda: None)
+        stages.add_stage('b', b, ['a'])
+        stages.add_stage('c', c, ['a'])
+        results = stages.run()
+        self.assertTrue(results['b'])
+        self.assertTrue(results['c'])
+
+    def test_thread_budget(self):
+        """stages do not use more than max_threads threads at once"""
+        lock = Lock()
+        in_use = [0, 0]
+
+        def stage(threads):
+            def f():
+                lock.acquire()
+                in_use[0] += threads
+                in_use[1] = max(in_use)
+                lock.release()
+                Event().wait(0.05)
+                lock.acquire()
+                in_use[0] -= threads
+                lock.release()
+            return f
+
+        stages = StageExecutor(max_workers=4, max_threads=4)
+        for i in range(4):
+            stages.add_stage(str(i), stage(2), threads=2)
+        # clamped to the budget, so it still runs
+        stages.add_stage('big', stage(4), threads=8)
+        stages.run()
+        self.assertEqual(in_use[1], 4)
+
+    def test_errors(self):
+        """the first error is re-raised and later stages are not run"""
+        calls = []
+
+        def fail():
+            raise ValueError("failed")
+
+        for max_workers in 1, 2:
+            stages = StageExecutor(max_workers=max_workers)
+            stages.add_stage('a', fail)
+            stages.add_stage('b', lambda a: calls.append('b'), ['a'])
+            self.assertRaises(ValueError, stages.run)
+        self.assertEqual(calls, [])
+
+    def test_add_stage_errors(self):
+        """stages must be unique and depend on known stages"""
+        stages = StageExecutor()
+        stages.add_stage('a', lambda: None)
+        self.assertTrue('a' in stages)
+        self.assertRaises(ValueError, stages.add_stage, 'a', lambda: None)
+        self.assertRaises(ValueError, stages.add_stage, 'b', lambda x: None,
+                          ['c'])
+        self.assertRaises(ValueError, StageExecutor, 0)
+
+
+class StageManifestTests(TestCase):
+
+    """Tests for resuming stages from a manifest"""
+
+    def setUp(self):
+        self.dir = mkdtemp(prefix='bfillings_stages_test_')
+        self.manifest_fp = join(self.dir, 'stages.json')
+        self.input_fp = join(self.dir, 'input.txt')
+        self.write(self.input_fp, 'ACGT')
+        self.calls = []
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def write(self, fp, contents):
+        f = open(fp, 'w')
+        f.write(contents)
+        f.close()
+
+    def stages(self, minsize=1, tool_version='v1'):
+        """Two stage pipeline: copy the input, then append minsize"""
+        def copy():
+            self.calls.append('copy')
+            output_fp = join(self.dir, 'copy.txt')
+            self.write(output_fp, open(self.input_fp).read())
+            return output_fp
+
+        def append(copy_fp):
+            self.calls.append('append')
+            output_fp = join(self.dir, 'append.txt')
+            self.write(output_fp, open(copy_fp).read() + str(minsize))
+            return output_fp
+
+        manifest = StageManifest(self.manifest_fp, tool_version=tool_version)
+        stages = StageExecutor(manifest=manifest)
+        stages.add_stage('copy', copy, params={}, inputs=[self.input_fp])
+        stages.add_stage('append', append, ['copy'],
+                         params={'minsize': minsize})
+        return stages
+
+    def test_resume(self):
+        """unchanged stages are skipped, changed ones are rerun"""
+        results = self.stages().run()
+        self.assertEqual(self.calls, ['copy', 'append'])
+        self.assertEqual(self.stages().run(), results)
+        self.assertEqual(self.calls, ['copy', 'append'])
+
+        # a parameter change only reruns the affected stage
+        self.stages(minsize=2).run()
+        self.assertEqual(self.calls, ['copy', 'append', 'append'])
+        self.assertEqual(open(results['append']).read(), 'ACGT2')
+
+    def test_changed_input(self):
+        """stages are rerun when their inputs change"""
+        self.stages().run()
+        self.write(self.input_fp, 'GGGG')
+        results = self.stages().run()
+        self.assertEqual(self.calls, ['copy', 'append'] * 2)
+        self.assertEqual(open(results['append']).read(), 'GGGG1')
+
+    def test_changed_output(self):
+        """stages are rerun when their outputs were modified or removed"""
+        results = self.stages().run()
+        self.write(results['append'], 'modified output')
+        self.stages().run()
+        self.assertEqual(self.calls, ['copy', 'append', 'append'])
+
+    def test_tool_version(self):
+        """stages are rerun with another tool version"""
+        self.stages().run()
+        self.stages(tool_version='v2').run()
+        self.assertEqual(self.calls, ['copy', 'append'] * 2)
+
+    def test_corrupt_manifest(self):
+        """a corrupt manifest is ignored"""
+        self.write(self.manifest_fp, '{"format_vers')
+        self.stages().run()
+        self.assertEqual(self.calls, ['copy', 'append'])
+
+
+if __name__ == "__main__":
+    main()
@@ -16,13 +16,17 @@ Unit tests for the SumaClust version 1.0 Application controller
 from unittest import TestCase, main
 import filecmp
 from tempfile import mkstemp, mkdtemp
-from os import close
+from os import chmod, close, listdir, stat
 from os.path import exists, getsize, join
 from shutil import rmtree
 
 from skbio.util import remove_files
 
-from bfillings.sumaclust_v1 import sumaclust_denovo_cluster
+from skbio.parse.sequences import parse_fasta
+
+from bfillings.sumaclust_v1 import (sumaclust_denovo_cluster,
+                                    sumaclust_update_clusters,
+                                    _write_atomically)
 
 
 # ----------------------------------------------------------------------------
@@ -191,6 +195,122 @@ class SumaclustV1Tests(TestCase):
         self.check_clusters(clusters, result_path)
 
 
+    def test_sumaclust_update_clusters_exact_matches(self):
+        """ Reads identical to a centroid are added to its OTU
+            and both files are rewritten in place
+        """
+        records = list(parse_fasta(self.file_read_seqs))
+        centroid_label, centroid_seq = records[0]
+        otu_map_fp = join(self.output_dir, "otu_map.txt")
+        centroids_fp = join(self.output_dir, "centroids.fasta")
+        with open(otu_map_fp, 'w') as otu_map_f:
+            otu_map_f.write("s1_630\ts1_630\ts1_4572\n")
+        with open(centroids_fp, 'w') as centroids_f:
+            centroids_f.write(">%s\n%s" % (centroid_label, centroid_seq))
+        new_reads_fp = join(self.output_dir, "new_reads.fasta")
+        with open(new_reads_fp, 'w') as new_reads_f:
+            new_reads_f.write(">new_1\n%s\n>new_2 x\n%s\n"
+                              % (centroid_seq.lower(), centroid_seq))
+
+        clusters = sumaclust_update_clusters(seq_path=new_reads_fp,
+                                             otu_map_fp=otu_map_fp,
+                                             centroids_fp=centroids_fp)
+
+        expected = [['s1_630', 's1_4572', 'new_1', 'new_2']]
+        self.assertEqual(clusters, expected)
+        with open(otu_map_fp, 'U') as otu_map_f:
+            self.assertEqual(otu_map_f.read(),
+                             "s1_630\ts1_630\ts1_4572\tnew_1\tnew_2\n")
+        self.assertEqual(list(parse_fasta(centroids_fp)),
+                         [(centroid_label, centroid_seq)])
+        self.assertEqual(sorted(listdir(self.output_dir)),
+                         ['centroids.fasta', 'new_reads.fasta',
+                          'otu_map.txt'])
+
+    def test_sumaclust_update_clusters_missing_centroids(self):
+        """ SumaClust should raise ValueError if the OTU map
+            exists without its centroids
+        """
+        otu_map_fp = join(self.output_dir, "otu_map.txt")
+        with open(otu_map_fp, 'w') as otu_map_f:
+            otu_map_f.write("s1_630\ts1_630\n")
+
+        self.assertRaises(ValueError,
+                          sumaclust_update_clusters,
+                          seq_path=self.file_read_seqs,
+                          otu_map_fp=otu_map_fp,
+                          centroids_fp=join(self.output_dir, "none.fasta"))
+
+    def test_sumaclust_update_clusters_missing_otu_map(self):
+        """ SumaClust should raise ValueError if the centroids
+            exist without their OTU map
+        """
+        centroids_fp = join(self.output_dir, "centroids.fasta")
+        with open(centroids_fp, 'w') as centroids_f:
+            centroids_f.write(">s1_630\nACGT\n")
+
+        self.assertRaises(ValueError,
+                          sumaclust_update_clusters,
+                          seq_path=self.file_read_seqs,
+                          otu_map_fp=join(self.output_dir, "none.txt"),
+                          centroids_fp=centroids_fp)
+        with open(centroids_fp) as centroids_f:
+            self.assertEqual(centroids_f.read(), ">s1_630\nACGT\n")
+
+    def test_write_atomically(self):
+        """ Files are replaced whole, through unique temporary
+            files that are removed on failure
+        """
+        fp = join(self.output_dir, "otu_map.txt")
+        with open(fp, 'w') as f:
+            f.write("old\n")
+        chmod(fp, 0o640)
+
+        _write_atomically(fp, lambda f: f.write("new\n"))
+        with open(fp) as f:
+            self.assertEqual(f.read(), "new\n")
+        self.assertEqual(stat(fp).st_mode & 0o777, 0o640)
+
+        def fail(f):
+            f.write("partial")
+            raise IOError("disk full")
+        self.assertRaises(IOError, _write_atomically, fp, fail)
+        with open(fp) as f:
+            self.assertEqual(f.read(), "new\n")
+        self.assertEqual(listdir(self.output_dir), ["otu_map.txt"])
+
+    def test_sumaclust_update_clusters(self):
+        """ Growing an empty OTU map twice keeps the first OTUs
+            and assigns the new reads to them
+        """
+        records = list(parse_fasta(self.file_read_seqs))
+        otu_map_fp = join(self.output_dir, "otu_map.txt")
+        centroids_fp = join(self.output_dir, "centroids.fasta")
+        first_fp = join(self.output_dir, "first.fasta")
+        second_fp = join(self.output_dir, "second.fasta")
+        with open(first_fp, 'w') as first_f:
+            for label, seq in records[::2]:
+                first_f.write(">%s\n%s\n" % (label, seq))
+        with open(second_fp, 'w') as second_f:
+            for label, seq in records[1::2]:
+                second_f.write(">%s\n%s\n" % (label, seq))
+
+        first = sumaclust_update_clusters(seq_path=first_fp,
+                                          otu_map_fp=otu_map_fp,
+                                          centroids_fp=centroids_fp)
+        first_otus = [cluster[0] for cluster in first]
+        self.assertEqual([label.split()[0] for label, _ in
+                          parse_fasta(centroids_fp)], first_otus)
+
+        second = sumaclust_update_clusters(seq_path=second_fp,
+                                           otu_map_fp=otu_map_fp,
+                                           centroids_fp=centroids_fp)
+        self.assertEqual([cluster[0] for cluster in second][:len(first)],
+                         first_otus)
+        self.assertEqual(sorted(sum(second, [])),
+                         sorted(label.split()[0] for label, _ in records))
+
+
 # Reads to cluster
 # there are 30 reads representing 3 species (gives 3 clusters)
 reads_seqs = """>s1_630 reference=1049393 amplicon=complement(497..788)
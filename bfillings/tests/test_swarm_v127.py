@@ -19,7 +19,9 @@ from os import close
 
 from skbio.util import remove_files
 
-from bfillings.swarm_v127 import swarm_denovo_cluster
+from bfillings.swarm_v127 import (swarm_denovo_cluster,
+                                  swarm_denovo_cluster_many,
+                                  parse_swarm_graph, break_swarm_chains)
 
 
 # ----------------------------------------------------------------------------
@@ -84,6 +86,36 @@ class SwarmTests(TestCase):
             expected_cluster.sort()
             self.assertEqual(actual_cluster, expected_cluster)
 
+    def test_swarm_denovo_cluster_many(self):
+        """ swarm_denovo_cluster_many should return the clusters
+            of each read file, in order
+        """
+        clusters = swarm_denovo_cluster(seq_path=self.file_read_seqs,
+                                        d=1,
+                                        threads=1)
+        clusters_many = swarm_denovo_cluster_many([self.file_read_seqs] * 3,
+                                                  d=1,
+                                                  threads=4,
+                                                  max_workers=2)
+        self.assertEqual(clusters_many, [clusters] * 3)
+        self.assertEqual(swarm_denovo_cluster_many([]), [])
+
+    def test_swarm_denovo_cluster_many_errors(self):
+        """ swarm_denovo_cluster_many should raise a ValueError
+            on invalid inputs before clustering any file
+        """
+        self.assertRaises(ValueError,
+                          swarm_denovo_cluster_many,
+                          [self.file_read_seqs, '/does/not/exist.fasta'])
+        self.assertRaises(ValueError,
+                          swarm_denovo_cluster_many,
+                          [self.file_read_seqs],
+                          threads=0)
+        self.assertRaises(ValueError,
+                          swarm_denovo_cluster_many,
+                          [self.file_read_seqs],
+                          max_workers=0)
+
     def test_seq_path(self):
         """ Swarm should raise a ValueError if the sequences
             filepath does not exist
@@ -122,6 +154,46 @@ class SwarmTests(TestCase):
                           d=1,
                           threads=-2)
 
+class SwarmBreakerTests(TestCase):
+    """ Tests for breaking chains of amplicons """
+
+    def setUp(self):
+        # a chain of two abundant amplicons, A and C, through a rare one
+        self.break_data = ["Swarm 1.2.7\n",
+                           "@@\tA_1000\tB_5\t1\t1\t1\t1\n",
+                           "@@\tB_5\tC_500\t1\t1\t2\t2\n",
+                           "@@\tC_500\tD_1\t1\t1\t3\t3\n",
+                           "@@\tA_1000\tE_1\t1\t1\t2\t1\n"]
+        self.abundances = {'A': range(1000), 'B': range(5),
+                           'C': range(500), 'D': [0], 'E': [0]}
+
+    def test_parse_swarm_graph(self):
+        """ parse_swarm_graph should read the links between amplicons
+        """
+        parents, children = parse_swarm_graph(self.break_data,
+                                              self.abundances)
+        self.assertEqual(parents, {'B': 'A', 'C': 'B', 'D': 'C', 'E': 'A'})
+        self.assertEqual(children, {'A': ['B', 'E'], 'B': ['C'],
+                                    'C': ['D']})
+
+    def test_break_swarm_chains(self):
+        """ break_swarm_chains should break chains at deep valleys only
+        """
+        parents, children = parse_swarm_graph(self.break_data,
+                                              self.abundances)
+        clusters = break_swarm_chains(['A', 'B', 'C', 'D', 'E'], parents,
+                                      children, self.abundances)
+        self.assertEqual(clusters, [['A', 'E'], ['C', 'B', 'D']])
+
+        # a shallow valley is not broken
+        self.abundances['C'] = range(100)
+        parents, children = parse_swarm_graph(self.break_data,
+                                              self.abundances)
+        clusters = break_swarm_chains(['D', 'C', 'B', 'A', 'E'], parents,
+                                      children, self.abundances)
+        self.assertEqual(clusters, [['A', 'C', 'B', 'D', 'E']])
+
+
 # Reads to cluster
 # there are 30 reads representing 3 species (gives 3 clusters)
 reads_seqs = """>s1_630 reference=1049393 amplicon=complement(497..788)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2013--, biocore development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+#-----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+
+from bfillings.uc_parser import (ClusterDict, LabelInterner, UcClusters,
+                                  new_clusters, uc_records)
+
+
+class UcParserTests(TestCase):
+
+    """Tests for the shared .uc reader and compact cluster store"""
+
+    def test_uc_records(self):
+        """uc_records skips comments and blank lines and filters types"""
+        lines = ['# uclust --input x\n', '\n', 'S\t0\t80\t*\t*\t*\t*\t*\ta\t*\n',
+                 'H\t0\t80\t99.0\t+\t0\t0\t80M\tb c\ta\n',
+                 'N\t*\t80\t*\t*\t*\t*\t*\td\t*\n']
+        self.assertEqual([r[0] for r in uc_records(lines)], ['S', 'H', 'N'])
+        self.assertEqual([r[8] for r in uc_records(lines, 'HN')],
+                         ['b c', 'd'])
+
+    def test_label_interner(self):
+        """labels get consecutive ids"""
+        labels = LabelInterner()
+        self.assertEqual(labels.intern('a'), 0)
+        self.assertEqual(labels.intern('b'), 1)
+        self.assertEqual(labels.intern('a'), 0)
+        self.assertEqual(labels[1], 'b')
+        self.assertEqual(len(labels), 2)
+        self.assertEqual(labels.get_id('c'), None)
+
+    def test_uc_clusters(self):
+        """UcClusters behaves as a dict of lists"""
+        clusters = UcClusters()
+        clusters.add_member('c1', 'a')
+        clusters.add_cluster('c2')
+        clusters.add_member('c3', 'b')
+        clusters.add_member('c1', 'c')
+        clusters.add_member('c3', 'a')
+        self.assertEqual(clusters.keys(), ['c1', 'c2', 'c3'])
+        self.assertEqual(clusters['c1'], ['a', 'c'])
+        self.assertEqual(clusters['c2'], [])
+        self.assertEqual(clusters.to_dict(),
+                         {'c1': ['a', 'c'], 'c2': [], 'c3': ['b', 'a']})
+        self.assertEqual(clusters, {'c1': ['a', 'c'], 'c2': [],
+                                    'c3': ['b', 'a']})
+        self.assertEqual(list(clusters.Offsets), [0, 2, 2, 4])
+        self.assertEqual(list(clusters.Members), [1, 5, 4, 1])
+        self.assertTrue('c1' in clusters)
+        # labels that are only members are not clusters
+        self.assertFalse('a' in clusters)
+        self.assertRaises(KeyError, clusters.__getitem__, 'a')
+        self.assertEqual(clusters.get('x', 42), 42)
+        self.assertEqual(len(clusters), 3)
+
+    def test_uc_clusters_add_after_access(self):
+        """members can be added after the CSR arrays were built"""
+        clusters = UcClusters()
+        clusters.add_member('c1', 'a')
+        clusters.add_member('c2', 'b')
+        self.assertEqual(clusters['c1'], ['a'])
+        clusters.add_member('c1', 'c')
+        self.assertEqual(clusters.items(), [('c1', ['a', 'c']),
+                                            ('c2', ['b'])])
+
+    def test_uc_clusters_no_create(self):
+        """add_member can refuse to create clusters"""
+        clusters = UcClusters()
+        self.assertRaises(KeyError, clusters.add_member, 'c1', 'a',
+                          create=False)
+        clusters.add_cluster('c1')
+        clusters.add_member('c1', 'a', create=False)
+        self.assertEqual(clusters['c1'], ['a'])
+
+
+    def test_cluster_dict(self):
+        """ClusterDict fills a plain dict like UcClusters"""
+        clusters = new_clusters()
+        self.assertTrue(isinstance(clusters, ClusterDict))
+        self.assertRaises(KeyError, clusters.add_member, 'c1', 'a',
+                          create=False)
+        clusters.add_cluster('c1')
+        clusters.add_member('c1', 'a', create=False)
+        clusters.add_member('c2', 'b')
+        clusters.add_cluster('c2')
+        self.assertEqual(clusters, {'c1': ['a'], 'c2': ['b']})
+        self.assertTrue(isinstance(new_clusters(compact=True), UcClusters))
+
+
+if __name__ == "__main__":
+    main()
@@ -13,8 +13,10 @@
 
 Modified from Daniel McDonald's test_cd_hit.py code on Feb-4-2010 """
 
+from os import listdir
 from subprocess import Popen, PIPE, STDOUT
-from tempfile import mkstemp
+from shutil import rmtree
+from tempfile import mkdtemp, mkstemp
 
 from unittest import TestCase, main
 
@@ -25,9 +27,12 @@ from bfillings.uclust import (Uclust,
                            uclust_cluster_from_sorted_fasta_filepath,
                            get_output_filepaths, clusters_from_uc_file,
                            get_clusters_from_fasta_filepath,
+                           get_cached_sorted_fasta,
                            uclust_search_and_align_from_fasta_filepath,
                            process_uclust_pw_alignment_results,
+                           reverse_complement_block,
                            UclustParseError)
+from bfillings.uc_parser import UcClusters
 
 __author__ = "William Walters"
 __copyright__ = "Copyright 2007-2012, The Cogent Project"
@@ -245,6 +250,15 @@ class UclustConvenienceWrappers(TestCase):
         self.assertEqual(clusters_from_uc_file(self.uc_lines1),
                          (expected_clusters, expected_failures, expected_new_seeds))
 
+    def test_clusters_from_uc_file_compact(self):
+        """ clusters_from_uc_file can return compact clusters """
+        clusters, failures, new_seeds = clusters_from_uc_file(self.uc_lines1,
+                                                              compact=True)
+        self.assertTrue(isinstance(clusters, UcClusters))
+        self.assertEqual(clusters, {'s2': ['s2', 's3']})
+        self.assertEqual(failures, ['s1'])
+        self.assertEqual(new_seeds, ['s2'])
+
     def test_clusters_from_uc_file_multiple_hits(self):
         """ clusters_from_uc_file handles error_on_multiple_hits correctly
         """
@@ -320,6 +334,29 @@ class UclustConvenienceWrappers(TestCase):
                                         expected_failure_list,
                                         expected_new_seed_list))
 
+    def test_get_clusters_from_fasta_filepath_sort_cache(self):
+        """ Sorted inputs are cached and reused across runs """
+        sort_cache_dir = mkdtemp(prefix='uclust_sort_cache_')
+        try:
+            for percent_ID in 0.90, 0.90, 0.95:
+                clusters_res = get_clusters_from_fasta_filepath(
+                    self.tmp_unsorted_fasta_filepath,
+                    original_fasta_path=None, percent_ID=percent_ID,
+                    save_uc_files=False, sort_cache_dir=sort_cache_dir)
+                if percent_ID == 0.90:
+                    self.assertEqual(sorted(clusters_res[0]),
+                                     sorted(expected_cluster_list))
+            self.assertEqual(len([e for e in listdir(sort_cache_dir)
+                                  if not e.endswith('.lock')]), 1)
+
+            with get_cached_sorted_fasta(self.tmp_unsorted_fasta_filepath,
+                                         sort_cache_dir) as entry:
+                with open(entry.SortedFastaFilepath) as sorted_f:
+                    self.assertEqual(sorted_f.read().split(),
+                                     '\n'.join(sorted_dna_seqs).split())
+        finally:
+            rmtree(sort_cache_dir)
+
     def test_get_clusters_from_fasta_filepath_reference_db_only(self):
         """ Correct clusters returned when clustering against a database only
         """
@@ -471,6 +508,20 @@ class UclustConvenienceWrappers(TestCase):
         # make sure the full result objects are the same
         self.assertEqual(actual, expected)
 
+        # the results do not depend on the block size
+        for block_size in 1, 2:
+            self.assertEqual(list(process_uclust_pw_alignment_results(
+                self.search_align_out_fasta_pairs1,
+                self.search_align_out_uc1, block_size=block_size)),
+                expected)
+
+    def test_reverse_complement_block(self):
+        """reverse complements are computed for a block of sequences"""
+        self.assertEqual(reverse_complement_block(
+            ['ACGT-TTG', '', 'RYMKSWBDHVN', 'acg.n']),
+            ['CAA-ACGT', '', 'NBDHVWSMKRY', 'n.cgt'])
+        self.assertEqual(reverse_complement_block([]), [])
+
     def test_uclust_search_and_align_from_fasta_filepath(self):
         """ uclust_search_and_align_from_fasta_filepath functions as expected """
         # rev comp matches allowed (default)
@@ -12,10 +12,12 @@
 provides unit tests for the usearch.py module
 """
 
-from os import close
-from os.path import basename, join, exists
+from os import close, listdir
+from os.path import basename, join, exists, getmtime
+from resource import getrusage, RUSAGE_CHILDREN
 from shutil import rmtree
 from glob import glob
+import sys
 from unittest import TestCase, main
 from tempfile import mkstemp, mkdtemp
 
@@ -33,7 +35,8 @@ from bfillings.usearch import (clusters_from_blast_uc_file,
                             usearch_cluster_seqs,
                             enumerate_otus, assign_reads_to_otus,
                             usearch_qf, concatenate_fastas,
-                            get_retained_chimeras,
+                            get_fasta_from_uc_file,
+                            get_retained_chimeras, retain_non_chimeras,
                             assign_dna_reads_to_protein_database,
                             usearch61_ref_cluster,
                             usearch61_denovo_cluster,
@@ -48,7 +51,11 @@ from bfillings.usearch import (clusters_from_blast_uc_file,
                             merge_failures_dereplicated_seqs,
                             parse_usearch61_failures,
                             usearch61_chimera_check_denovo,
-                            usearch61_chimera_check_ref)
+                            usearch61_chimera_check_ref,
+                            usearch61_memory_estimate,
+                            choose_usearch61_strategy,
+                            usearch61_peak_memory, _children_peak_rss)
+from bfillings.memory_model import MemoryModel
 
 
 class Usearch61Tests(TestCase):
@@ -126,6 +133,9 @@ class Usearch61Tests(TestCase):
         self._dirs_to_remove = []
 
     def tearDown(self):
+        # FASTA indexes persisted beside the input files
+        remove_files([fp + '.fidx' for fp in self._files_to_remove
+                      if exists(fp + '.fidx')])
         remove_files(self._files_to_remove)
         if self._dirs_to_remove:
             for curr_dir in self._dirs_to_remove:
@@ -314,6 +324,80 @@ class Usearch61Tests(TestCase):
         for curr_cluster in clusters.values():
             self.assertTrue(curr_cluster in expected_clusters)
 
+    def test_usearch61_denovo_auto_cluster(self):
+        """ usearch61 denovo OTU picking works with the auto strategy """
+
+        output_dir = mkdtemp(prefix='UsearchOtuPickerTest_')
+        self._dirs_to_remove.append(output_dir)
+        clusters = usearch61_denovo_cluster(self.tmp_dna_seqs_1,
+                                            output_dir=output_dir,
+                                            usearch_fast_cluster='auto',
+                                            threads=2,
+                                            memory_stats_fp=join(
+                                                output_dir, 'memory.json'))
+
+        self.assertEqual(sorted(clusters.values()),
+                         [['uclust_test_seqs_%d' % i] for i in range(10)])
+        with open(join(output_dir, 'denovo_auto_strategy.log')) as log_f:
+            self.assertTrue(log_f.readline().startswith(
+                'Chose cluster_fast with 2 thread(s)'))
+
+    def test_choose_usearch61_strategy(self):
+        """ the fastest usearch61 strategy fitting the budget is chosen """
+
+        profile = {'num_seqs': 10 ** 6, 'num_uniques': 10 ** 5,
+                   'unique_residues': 3 * 10 ** 7, 'max_len': 500}
+        fast_1 = usearch61_memory_estimate(profile, 'fast', 1)
+        fast_4 = usearch61_memory_estimate(profile, 'fast', 4)
+        smallmem = usearch61_memory_estimate(profile, 'smallmem')
+        self.assertTrue(smallmem < fast_1 < fast_4)
+
+        model = MemoryModel()
+        self.assertEqual(choose_usearch61_strategy(profile, fast_4, 4),
+                         ('fast', 4, fast_4))
+        self.assertEqual(choose_usearch61_strategy(profile, fast_4 - 1, 4,
+                                                   memory_model=model)[:2],
+                         ('fast', 3))
+        self.assertEqual(choose_usearch61_strategy(profile, fast_1 - 1, 4),
+                         ('smallmem', 1, smallmem))
+        self.assertEqual(choose_usearch61_strategy(profile, fast_4, 4,
+                                                   rev=True)[0], 'smallmem')
+
+        # runs that used more memory than estimated lower the thread count
+        model.record('fast', fast_1, int(1.3 * fast_1))
+        self.assertEqual(choose_usearch61_strategy(profile, fast_4, 4,
+                                                   memory_model=model)[:2],
+                         ('fast', 1))
+
+    def test_usearch61_peak_memory(self):
+        """ the peak memory is read from usearch61 logs """
+
+        f, log_fp = mkstemp(prefix='UsearchOtuPickerTest_', suffix='.log')
+        close(f)
+        self._files_to_remove.append(log_fp)
+        with open(log_fp, 'w') as log_f:
+            log_f.write('Finished Tue Jul  1 10:00:00 2014\n'
+                        'Elapsed time 00:01\nMax memory 46.5Mb\n')
+        self.assertEqual(usearch61_peak_memory(log_fp),
+                         int(46.5 * 2 ** 20))
+        with open(log_fp, 'w') as log_f:
+            log_f.write('Elapsed time 00:01\n')
+        self.assertEqual(usearch61_peak_memory(log_fp), None)
+        self.assertEqual(usearch61_peak_memory(log_fp + '.missing'), None)
+
+    def test_children_peak_rss(self):
+        """ the peak memory of children is in bytes on every platform """
+
+        peak_rss = getrusage(RUSAGE_CHILDREN).ru_maxrss
+        platform = sys.platform
+        try:
+            sys.platform = 'darwin'
+            self.assertEqual(_children_peak_rss(), peak_rss)
+            sys.platform = 'linux2'
+            self.assertEqual(_children_peak_rss(), peak_rss * 1024)
+        finally:
+            sys.platform = platform
+
     def test_sort_by_abundance_usearch61(self):
         """ usearch61 sorts by abundance successfully """
 
@@ -711,6 +795,9 @@ class UsearchTests(TestCase):
         self._dirs_to_remove = []
 
     def tearDown(self):
+        # FASTA indexes persisted beside the input files
+        remove_files([fp + '.fidx' for fp in self._files_to_remove
+                      if exists(fp + '.fidx')])
         remove_files(self._files_to_remove)
         if self._dirs_to_remove:
             for curr_dir in self._dirs_to_remove:
@@ -734,6 +821,44 @@ class UsearchTests(TestCase):
         self.assertEqual(clusters, expected_clusters)
         self.assertEqual(failures, expected_failures)
 
+    def test_usearch_qf_removes_intermediate_files(self):
+        """ usearch_qf removes each intermediate file once by default """
+
+        output_dir = mkdtemp(prefix='usearch_qf_cleanup_')
+        self._dirs_to_remove.append(output_dir)
+        clusters, failures = usearch_qf(self.tmp_seq_filepath2,
+                                        output_dir=output_dir,
+                                        db_filepath=self.tmp_ref_database,
+                                        minsize=1,
+                                        remove_usearch_logs=True,
+                                        chimeras_retention='intersection')
+        self.assertEqual(clusters,
+                         {'1': ['Solemya', 'Solemya_seq2'],
+                          '0': ['usearch_ecoli_seq', 'usearch_ecoli_seq2']})
+        self.assertFalse(exists(join(output_dir,
+                                     'err_corrected_clusters.uc')))
+        self.assertFalse(exists(join(output_dir,
+                                     'assign_reads_to_otus.uc')))
+
+    def test_usearch_qf_resume(self):
+        """ usearch_qf skips the steps recorded in its stage manifest """
+
+        output_dir = mkdtemp(prefix='usearch_qf_resume_')
+        self._dirs_to_remove.append(output_dir)
+        kwargs = dict(output_dir=output_dir,
+                      db_filepath=self.tmp_ref_database, minsize=1,
+                      remove_usearch_logs=True,
+                      chimeras_retention='intersection',
+                      save_intermediate_files=True, resume=True)
+        expected = usearch_qf(self.tmp_seq_filepath2, **kwargs)
+        self.assertTrue(exists(join(output_dir, 'usearch_qf_stages.json')))
+        derep_fp = join(output_dir, 'dereplicated_seqs.fasta')
+        derep_mtime = getmtime(derep_fp)
+
+        self.assertEqual(usearch_qf(self.tmp_seq_filepath2, **kwargs),
+                         expected)
+        self.assertEqual(getmtime(derep_fp), derep_mtime)
+
     def test_usearch_qf_minlen(self):
         """ Main program loop test, with longer minlen """
 
@@ -895,6 +1020,38 @@ class UsearchTests(TestCase):
 
         self.assertItemsEqual(actual_logs, expected_log_names)
 
+    def test_get_fasta_from_uc_file(self):
+        """ Writes the hits or failures of a uc file to fasta """
+
+        uc_f, uc_fp = mkstemp(prefix='UsearchGetFastaTest_', suffix='.uc')
+        close(uc_f)
+        uc_f = open(uc_fp, 'w')
+        uc_f.write('# comment\n'
+                   'H\t0\t80\t99.0\t+\t0\t0\t80M\tuclust_test_seqs_1 some '
+                   'comment1\tref1\n'
+                   'N\t*\t80\t*\t*\t*\t*\t*\tuclust_test_seqs_0 some '
+                   'comment0\t*\n')
+        uc_f.close()
+        f, out_fp = mkstemp(prefix='UsearchGetFastaTest_', suffix='.fasta')
+        close(f)
+        self._files_to_remove.extend([uc_fp, out_fp])
+
+        output_fp, labels_hits = get_fasta_from_uc_file(
+            self.tmp_seq_filepath1, uc_fp, hit_type='H',
+            output_fna_filepath=out_fp)
+        self.assertEqual(labels_hits,
+                         {'uclust_test_seqs_1 some comment1': 'ref1'})
+        self.assertEqual(list(parse_fasta(open(output_fp, 'U'))),
+                         [('ref1', 'ACCCACACGGTGGATGCAACAGATCCCATACACCGAGTTGGAT'
+                           'GCTTAAGACGCATCGCGTGAGTTTTGCGTCAAGGCT')])
+        self.assertTrue(exists(self.tmp_seq_filepath1 + '.fidx'))
+
+        get_fasta_from_uc_file(self.tmp_seq_filepath1, uc_fp, hit_type='N',
+                               output_fna_filepath=out_fp)
+        self.assertEqual([label for label, seq in
+                          parse_fasta(open(out_fp, 'U'))],
+                         ['uclust_test_seqs_0 some comment0'])
+
     def test_concatenate_fastas(self):
         """ Properly concatenates two fasta files """
 
@@ -1176,6 +1333,65 @@ class UsearchTests(TestCase):
         self.assertEqual(actual_out_f,
                          self.expected_retained_chimeras_intersection)
 
+    def test_retain_non_chimeras_k_of_n(self):
+        """ Retains sequences flagged as non-chimeras by k of n detectors """
+
+        f, in_fp = mkstemp(prefix='UsearchRetainedChimeras3_',
+                           suffix='.fasta')
+        close(f)
+        in_f = open(in_fp, 'w')
+        in_f.write('>seq5\nTTATCCATT\n>seq2\nACAGGCCCCC\n>seq2\nACAG\n')
+        in_f.close()
+        f, out_f = mkstemp(prefix='UsearchKofNTest_', suffix='.fasta')
+        close(f)
+        self._files_to_remove.extend([in_fp, out_f])
+
+        in_fps = [self.tmp_retained_chimeras_seqs1,
+                  self.tmp_retained_chimeras_seqs2, in_fp]
+        retain_non_chimeras(in_fps, out_f, retention=2)
+        actual_out_f = [line.strip() for line in open(out_f, "U")]
+        # seq2 is repeated in the last file, but only counts once
+        self.assertEqual(actual_out_f, ['>seq2', 'ACAGGCCCCC', '>seq3',
+                                        'TTATCCATT', '>seq5', 'TTATCCATT'])
+
+        retain_non_chimeras(in_fps, out_f, retention='intersection')
+        self.assertEqual(open(out_f, "U").read(), '')
+
+        self.assertRaises(ValueError, retain_non_chimeras, in_fps, out_f,
+                          retention=4)
+        self.assertRaises(ValueError, get_retained_chimeras,
+                          self.tmp_retained_chimeras_seqs1,
+                          self.tmp_retained_chimeras_seqs2, out_f,
+                          chimeras_retention='all')
+
+    def test_retain_non_chimeras_spill(self):
+        """ Spilling labels to partitions gives the same output """
+
+        output_dir = mkdtemp(dir=self.tmp_dir)
+        self._dirs_to_remove.append(output_dir)
+        in_fps = []
+        for i in range(3):
+            in_fp = join(output_dir, 'in%d.fasta' % i)
+            in_f = open(in_fp, 'w')
+            for j in range(i, 60, i + 1):
+                in_f.write('>seq%d\n%s\n' % (j, 'ACGT' * (j % 7 + 1)))
+            in_f.write('>seq%d\nACGT\n' % i)
+            in_f.close()
+            in_fps.append(in_fp)
+        out_fp = join(output_dir, 'retained.fasta')
+        for retention in 'union', 'intersection', 1, 2, 3:
+            retain_non_chimeras(in_fps, out_fp, retention=retention)
+            expected = open(out_fp).read()
+            self.assertTrue(expected)
+            for max_labels, num_partitions in (1, 2), (3, 1), (5, 4):
+                retain_non_chimeras(in_fps, out_fp, retention=retention,
+                                    max_labels=max_labels,
+                                    num_partitions=num_partitions)
+                self.assertEqual(open(out_fp).read(), expected)
+                self.assertEqual(sorted(listdir(output_dir)),
+                                 ['in0.fasta', 'in1.fasta', 'in2.fasta',
+                                  'retained.fasta'])
+
     def test_assign_dna_reads_to_protein_database(self):
         """assign_dna_reads_to_protein_database wrapper functions as expected
         """
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------------
+# Copyright (c) 2013--, biocore development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+#-----------------------------------------------------------------------------
+
+"""Streaming reader and compact cluster store for .uc files
+
+The .uc format is written by uclust and usearch. Each record line has ten
+tab-separated fields; the ones used here are the record type (field 0: H for
+hit, S for seed, L for library seed, N for no hit), the cluster number
+(field 1), the query label (field 8) and the target label (field 9).
+
+Large runs produce clusters with tens of millions of members, so UcClusters
+stores sequence labels once, as integer ids, and cluster membership as
+compressed sparse row (CSR) arrays: the members of cluster i are
+members[offsets[i]:offsets[i + 1]]. Lists of labels are only built when a
+cluster is looked up.
+
+Parsers fill their clusters through add_cluster and add_member, and get
+their store from new_clusters: a ClusterDict (a plain dict of lists, filled
+directly) by default, or a UcClusters when the caller asks for compact
+storage.
+"""
+
+from array import array
+from itertools import izip
+
+
+def uc_records(uc_lines, types=None):
+    """Yields the list of fields of each record in uc_lines
+
+    uc_lines: open .uc file, or similar object
+    types: if given, only records whose type (first character) is in types
+     are yielded
+
+    Blank lines and comment lines are skipped.
+    """
+    for line in uc_lines:
+        line = line.strip()
+        if not line or line[0] == '#':
+            continue
+        if types is not None and line[0] not in types:
+            continue
+        yield line.split('\t')
+
+
+class LabelInterner(object):
+    """Maps sequence labels to consecutive integer ids and back"""
+
+    def __init__(self):
+        self._ids = {}
+        self._labels = []
+
+    def intern(self, label):
+        """Returns the id of label, assigning a new one if needed"""
+        label_id = self._ids.get(label)
+        if label_id is None:
+            label_id = len(self._labels)
+            self._ids[label] = label_id
+            self._labels.append(label)
+        return label_id
+
+    def get_id(self, label):
+        """Returns the id of label, or None if it was never interned"""
+        return self._ids.get(label)
+
+    def __getitem__(self, label_id):
+        return self._labels[label_id]
+
+    def __len__(self):
+        return len(self._labels)
+
+
+class UcClusters(object):
+    """Cluster membership stored as CSR arrays of interned label ids
+
+    Behaves as a read-only dict of cluster label: list of member labels, in
+    the order in which clusters and members were added. The lists are built
+    on access, so iterating over items() does not hold all of them at once;
+    use to_dict to get a regular dict.
+    """
+
+    _typecode = 'i'
+
+    def __init__(self):
+        self.Labels = LabelInterner()
+        # cluster label id -> cluster number, and back
+        self._cluster_numbers = {}
+        self._cluster_labels = array(self._typecode)
+        # (cluster number, member id) pairs added since the last compression
+        self._pending_clusters = array(self._typecode)
+        self._pending_members = array(self._typecode)
+        self._offsets = None
+        self._members = None
+
+    def _cluster_number(self, cluster_label, create):
+        label_id = self.Labels.intern(cluster_label) if create else \
+            self.Labels.get_id(cluster_label)
+        number = self._cluster_numbers.get(label_id)
+        if number is None:
+            if not create:
+                raise KeyError(cluster_label)
+            number = len(self._cluster_labels)
+            self._cluster_numbers[label_id] = number
+            self._cluster_labels.append(label_id)
+        return number
+
+    def add_cluster(self, cluster_label):
+        """Adds an empty cluster, if cluster_label is not a cluster yet"""
+        self._cluster_number(cluster_label, True)
+
+    def add_member(self, cluster_label, member_label, create=True):
+        """Adds member_label to the cluster cluster_label
+
+        If create is False and cluster_label is not a cluster yet, raises a
+        KeyError; otherwise the cluster is created.
+        """
+        number = self._cluster_number(cluster_label, create)
+        if self._members is not None:
+            self._decompress()
+        self._pending_clusters.append(number)
+        self._pending_members.append(self.Labels.intern(member_label))
+
+    def _decompress(self):
+        """Turns the CSR arrays back into pairs so that members can be added
+        """
+        offsets = self._offsets
+        for number in xrange(len(offsets) - 1):
+            self._pending_clusters.extend(
+                array(self._typecode, [number]) *
+                (offsets[number + 1] - offsets[number]))
+        self._pending_members = self._members
+        self._offsets = self._members = None
+
+    def _compress(self):
+        """Builds the CSR arrays from the pending pairs (stable by cluster)
+        """
+        if self._members is not None:
+            return
+        num_clusters = len(self._cluster_labels)
+        offsets = array(self._typecode, [0]) * (num_clusters + 1)
+        for number in self._pending_clusters:
+            offsets[number + 1] += 1
+        for number in xrange(num_clusters):
+            offsets[number + 1] += offsets[number]
+        members = array(self._typecode, [0]) * len(self._pending_members)
+        next_pos = offsets[:-1]
+        for number, member in izip(self._pending_clusters,
+                                   self._pending_members):
+            members[next_pos[number]] = member
+            next_pos[number] += 1
+        self._offsets = offsets
+        self._members = members
+        self._pending_clusters = array(self._typecode)
+        self._pending_members = array(self._typecode)
+
+    @property
+    def Offsets(self):
+        """CSR offsets: cluster i has members Members[Offsets[i]:Offsets[i+1]]
+        """
+        self._compress()
+        return self._offsets
+
+    @property
+    def Members(self):
+        """CSR member label ids, grouped by cluster"""
+        self._compress()
+        return self._members
+
+    def member_ids(self, number):
+        """Returns the array of member label ids of cluster number"""
+        self._compress()
+        return self._members[self._offsets[number]:self._offsets[number + 1]]
+
+    def __len__(self):
+        return len(self._cluster_labels)
+
+    def __iter__(self):
+        labels = self.Labels
+        for label_id in self._cluster_labels:
+            yield labels[label_id]
+
+    def __contains__(self, cluster_label):
+        label_id = self.Labels.get_id(cluster_label)
+        return label_id is not None and label_id in self._cluster_numbers
+
+    def __getitem__(self, cluster_label):
+        number = self._cluster_number(cluster_label, False)
+        labels = self.Labels
+        return [labels[i] for i in self.member_ids(number)]
+
+    def get(self, cluster_label, default=None):
+        if cluster_label in self:
+            return self[cluster_label]
+        return default
+
+    def keys(self):
+        return list(self)
+
+    def iteritems(self):
+        labels = self.Labels
+        for number, label_id in enumerate(self._cluster_labels):
+            yield labels[label_id], [labels[i] for i in
+                                     self.member_ids(number)]
+
+    def itervalues(self):
+        for _, members in self.iteritems():
+            yield members
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def to_dict(self):
+        """Returns the clusters as a dict of cluster label: member labels"""
+        return dict(self.iteritems())
+
+    def __eq__(self, other):
+        if isinstance(other, UcClusters):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class ClusterDict(dict):
+    """dict of cluster label: list of member labels
+
+    Has the add_cluster and add_member methods of UcClusters, so that
+    parsers can fill either one.
+    """
+
+    def add_cluster(self, cluster_label):
+        """Adds an empty cluster, if cluster_label is not a cluster yet"""
+        self.setdefault(cluster_label, [])
+
+    def add_member(self, cluster_label, member_label, create=True):
+        """Adds member_label to the cluster cluster_label
+
+        If create is False and cluster_label is not a cluster yet, raises a
+        KeyError; otherwise the cluster is created.
+        """
+        if create:
+            self.setdefault(cluster_label, []).append(member_label)
+        else:
+            self[cluster_label].append(member_label)
+
+
+def new_clusters(compact=False):
+    """Returns an empty UcClusters if compact is True, else a ClusterDict"""
+    if compact:
+        return UcClusters()
+    return ClusterDict()
@@ -19,17 +19,24 @@ a parser for the resulting .clstr file.
 Modified from cogent.app.cd_hit.py on 1-21-10, written by Daniel McDonald.
 """
 
+from itertools import islice, izip
 from os.path import splitext, basename, join
+from string import maketrans
 from tempfile import gettempdir, mkstemp
 
-from cogent import DNA
-
 from burrito.util import (CommandLineApplication, ResultPath,
                             ApplicationError, ApplicationNotFoundError)
 from burrito.parameters import ValuedParameter, FlagParameter
 from skbio.parse.sequences import parse_fasta
 from skbio.util import remove_files
 
+from bfillings.cache import ContentCache, cache_key, stamped_file_digest
+from bfillings.uc_parser import new_clusters, uc_records
+
+# IUPAC DNA complements; other characters (gaps) are left as they are
+_dna_complements = maketrans('ACGTRYMKSWBDHVNacgtrymkswbdhvn',
+                             'TGCAYRKMSWVHDBNtgcayrkmswvhdbn')
+
 
 class UclustParseError(Exception):
     pass
@@ -193,11 +200,7 @@ class Uclust(CommandLineApplication):
 
 
 def get_next_record_type(lines, types):
-    for line in lines:
-        line = line.strip()
-        if line and line[0] in types:
-            yield line.split('\t')
-    return
+    return uc_records(lines, types)
 
 
 def get_next_two_fasta_records(lines):
@@ -210,61 +213,94 @@ def get_next_two_fasta_records(lines):
     return
 
 
-def process_uclust_pw_alignment_results(fasta_pairs_lines, uc_lines):
-    """ Process results of uclust search and align """
-    alignments = get_next_two_fasta_records(fasta_pairs_lines)
-    for hit in get_next_record_type(uc_lines, 'H'):
-        matching_strand = hit[4]
-        if matching_strand == '-':
-            strand_id = '-'
-            target_rev_match = True
-        elif matching_strand == '+':
-            strand_id = '+'
-            target_rev_match = False
-        elif matching_strand == '.':
-            # protein sequence, so no strand information
-            strand_id = ''
-            target_rev_match = False
-        else:
-            raise UclustParseError("Unknown strand type: %s" % matching_strand)
-        uc_query_id = hit[8]
-        uc_target_id = hit[9]
-        percent_id = float(hit[3])
-
-        fasta_pair = alignments.next()
-
-        fasta_query_id = fasta_pair[0][0]
-        aligned_query = fasta_pair[0][1]
-
-        if fasta_query_id != uc_query_id:
-            raise UclustParseError("Order of fasta and uc files do not match." +
-                                   " Got query %s but expected %s." %
-                                   (fasta_query_id, uc_query_id))
-
-        fasta_target_id = fasta_pair[1][0]
-        aligned_target = fasta_pair[1][1]
-
-        if fasta_target_id != uc_target_id + strand_id:
-            raise UclustParseError("Order of fasta and uc files do not match." +
-                                   " Got target %s but expected %s." %
-                                   (fasta_target_id, uc_target_id + strand_id))
-
-        if target_rev_match:
-            query_id = uc_query_id + ' RC'
-            aligned_query = DNA.rc(aligned_query)
-            target_id = uc_target_id
-            aligned_target = DNA.rc(aligned_target)
-        else:
-            query_id = uc_query_id
-            aligned_query = aligned_query
-            target_id = uc_target_id
-            aligned_target = aligned_target
+def reverse_complement_block(seqs):
+    """ Returns the reverse complements of the DNA sequences in seqs
 
-        yield (query_id, target_id, aligned_query, aligned_target, percent_id)
+    The sequences are complemented and reversed all at once, as one
+    newline-joined string, rather than one at a time.
+    """
+    if not seqs:
+        return []
+    block = '\n'.join(seqs).translate(_dna_complements)[::-1]
+    return block.split('\n')[::-1]
+
+
+def process_uclust_pw_alignment_results(fasta_pairs_lines, uc_lines,
+                                        block_size=10000):
+    """ Process results of uclust search and align
+
+    Yields (query id, target id, aligned query, aligned target, percent id)
+    for each hit. Hits and their alignments are read block_size at a time,
+    and the alignments of minus strand hits are reverse complemented one
+    block at a time.
+    """
+    records = parse_fasta(fasta_pairs_lines)
+    # consecutive (query, target) records of the same iterator
+    alignments = izip(records, records)
+    hits = get_next_record_type(uc_lines, 'H')
+    while True:
+        hit_block = list(islice(hits, block_size))
+        if not hit_block:
+            break
+        alignment_block = list(islice(alignments, len(hit_block)))
+
+        results = []
+        rev_matches = []
+        for hit, fasta_pair in izip(hit_block, alignment_block):
+            matching_strand = hit[4]
+            if matching_strand == '-':
+                strand_id = '-'
+            elif matching_strand == '+':
+                strand_id = '+'
+            elif matching_strand == '.':
+                # protein sequence, so no strand information
+                strand_id = ''
+            else:
+                raise UclustParseError("Unknown strand type: %s" %
+                                       matching_strand)
+            uc_query_id = hit[8]
+            uc_target_id = hit[9]
+
+            (fasta_query_id, aligned_query), \
+                (fasta_target_id, aligned_target) = fasta_pair
+
+            if fasta_query_id != uc_query_id:
+                raise UclustParseError("Order of fasta and uc files do not "
+                                       "match. Got query %s but expected %s."
+                                       % (fasta_query_id, uc_query_id))
+
+            if fasta_target_id != uc_target_id + strand_id:
+                raise UclustParseError("Order of fasta and uc files do not "
+                                       "match. Got target %s but expected %s."
+                                       % (fasta_target_id,
+                                          uc_target_id + strand_id))
+
+            if strand_id == '-':
+                rev_matches.append(len(results))
+                uc_query_id += ' RC'
+            results.append([uc_query_id, uc_target_id, aligned_query,
+                            aligned_target, float(hit[3])])
+
+        if rev_matches:
+            rc_seqs = reverse_complement_block(
+                [results[i][2] for i in rev_matches] +
+                [results[i][3] for i in rev_matches])
+            for i, aligned_query, aligned_target in izip(
+                    rev_matches, rc_seqs, rc_seqs[len(rev_matches):]):
+                results[i][2] = aligned_query
+                results[i][3] = aligned_target
+
+        for result in results:
+            yield tuple(result)
+
+        if len(alignment_block) < len(hit_block):
+            # the alignments file is shorter than the uc file
+            break
 
 
 def clusters_from_uc_file(uc_lines,
-                          error_on_multiple_hits=True):
+                          error_on_multiple_hits=True,
+                          compact=False):
     """ Given an open .uc file, return lists (clusters, failures, new_seeds)
 
         uc_lines: open .uc file, or similar object -- this is the output
@@ -273,6 +309,9 @@ def clusters_from_uc_file(uc_lines,
          to multiple seeds, as can happen when --allhits is passed to uclust,
          throw a UclustParseError. if False, when a single query hits to
          multiple seeds, it will appear in each cluster.
+        compact: if True, clusters is returned as a
+         bfillings.uc_parser.UcClusters (a read-only dict-like object
+         storing labels as integer ids) rather than as a dict of lists
 
         This function processes all hit (H), seed (S), and no hit (N) lines
          to return all clusters, failures, and new_seeds generated in
@@ -281,14 +320,14 @@ def clusters_from_uc_file(uc_lines,
          reference database sequences.
 
     """
-    clusters = {}
+    clusters = new_clusters(compact)
     failures = []
     seeds = []
     all_hits = set()
     # the types of hit lines we're interested in here
     # are hit (H), seed (S), library seed (L) and no hit (N)
     hit_types = {}.fromkeys(list('HSNL'))
-    for record in get_next_record_type(uc_lines, hit_types):
+    for record in uc_records(uc_lines, hit_types):
         hit_type = record[0]
         # sequence identifiers from the fasta header lines only
         # (no comment data) are stored to identify a sequence in
@@ -297,17 +336,20 @@ def clusters_from_uc_file(uc_lines,
         query_id = record[8].split()[0]
         target_cluster = record[9].split()[0]
         if hit_type == 'H':
-            if error_on_multiple_hits and query_id in all_hits:
-                raise UclustParseError("Query id " + query_id + " hit multiple seeds. "
-                                       "This can happen if --allhits is "
-                                       "enabled in the call to uclust, which isn't supported by default. "
-                                       "Call clusters_from_uc_file(lines, error_on_multiple_hits=False) to "
-                                       "allow a query to cluster to multiple seeds.")
-            else:
-                # add the hit to its existing cluster (either library
-                # or new cluster)
-                clusters[target_cluster].append(query_id)
-                all_hits.add(query_id)
+            if error_on_multiple_hits:
+                # compact clusters already hold the label as an integer id
+                hit_key = clusters.Labels.intern(query_id) if compact \
+                    else query_id
+                if hit_key in all_hits:
+                    raise UclustParseError("Query id " + query_id + " hit multiple seeds. "
+                                           "This can happen if --allhits is "
+                                           "enabled in the call to uclust, which isn't supported by default. "
+                                           "Call clusters_from_uc_file(lines, error_on_multiple_hits=False) to "
+                                           "allow a query to cluster to multiple seeds.")
+                all_hits.add(hit_key)
+            # add the hit to its existing cluster (either library
+            # or new cluster)
+            clusters.add_member(target_cluster, query_id, create=False)
         elif hit_type == 'S':
             # a new seed was identified -- create a cluster with this
             # sequence as the first instance
@@ -316,7 +358,7 @@ def clusters_from_uc_file(uc_lines,
                                        "represents a cluster. Are there overlapping seq ids in your "
                                        "reference and input files or repeated seq ids in either? "
                                        "Offending seq id is %s" % query_id)
-            clusters[query_id] = [query_id]
+            clusters.add_member(query_id, query_id)
             seeds.append(query_id)
         elif hit_type == 'L':
             # a library seed was identified -- create a cluster with this
@@ -329,7 +371,7 @@ def clusters_from_uc_file(uc_lines,
                                        "represents a cluster. Are there overlapping seq ids in your "
                                        "reference and input files or repeated seq ids in either? "
                                        "Offending seq id is %s" % query_id)
-            clusters[query_id] = []
+            clusters.add_cluster(query_id)
         elif hit_type == 'N':
             # a failure was identified -- add it to the failures list
             failures.append(query_id)
@@ -368,6 +410,35 @@ def uclust_fasta_sort_from_filepath(
     return app_result
 
 
+def get_cached_sorted_fasta(fasta_filepath,
+                            cache_dir,
+                            max_size=None,
+                            HALT_EXEC=False):
+    """Returns an open cache entry holding fasta_filepath sorted by length
+
+    The sorted file, made by uclust --mergesort, is available as the
+    SortedFastaFilepath attribute of the entry, and is protected from
+    eviction until the entry is released.
+
+    Sorted files are kept in cache_dir, keyed by the md5 of the contents of
+    fasta_filepath, so that repeated runs on the same input, e.g. parameter
+    sweeps, sort it only once. Once the
+    files in cache_dir exceed max_size bytes, the least recently used ones
+    are removed (None disables eviction).
+    """
+    cache = ContentCache(cache_dir, max_size)
+    key = cache_key('uclust --mergesort', stamped_file_digest(fasta_filepath))
+
+    def sort_fasta(build_dir):
+        uclust_fasta_sort_from_filepath(
+            fasta_filepath, output_filepath=join(build_dir, 'sorted.fasta'),
+            HALT_EXEC=HALT_EXEC)
+
+    entry = cache.open_entry(key, sort_fasta)
+    entry.SortedFastaFilepath = join(entry.Path, 'sorted.fasta')
+    return entry
+
+
 def uclust_search_and_align_from_fasta_filepath(
         query_fasta_filepath,
         subject_fasta_filepath,
@@ -506,7 +577,9 @@ def get_clusters_from_fasta_filepath(
         return_cluster_maps=False,
         stable_sort=False,
         save_uc_files=True,
-        HALT_EXEC=False):
+        HALT_EXEC=False,
+        sort_cache_dir=None,
+        sort_cache_max_size=None):
     """ Main convenience wrapper for using uclust to generate cluster files
 
     A source fasta file is required for the fasta_filepath.  This will be
@@ -522,6 +595,11 @@ def get_clusters_from_fasta_filepath(
     The percent_ID parameter specifies the percent identity for a clusters,
     i.e., if 99% were the parameter, all sequences that were 99% identical
     would be grouped as a cluster.
+
+    If sort_cache_dir is given, the sorted fasta file is taken from (or
+    added to) the cache of sorted files in that directory instead of being
+    sorted again and deleted (see get_cached_sorted_fasta), with
+    sort_cache_max_size as the size budget of the cache in bytes.
     """
 
     # Create readable intermediate filenames if they are to be kept
@@ -545,8 +623,16 @@ def get_clusters_from_fasta_filepath(
 
     # Error check in case any app controller fails
     files_to_remove = []
+    sort_entry = None
     try:
-        if not suppress_sort:
+        if not suppress_sort and sort_cache_dir is not None:
+            # Reuse the sorted fasta file of an earlier run if there is one
+            sort_entry = get_cached_sorted_fasta(
+                fasta_filepath, sort_cache_dir, max_size=sort_cache_max_size,
+                HALT_EXEC=HALT_EXEC)
+            sorted_fasta_filepath = sort_entry.SortedFastaFilepath
+
+        elif not suppress_sort:
             # Sort fasta input file from largest to smallest sequence
             sort_fasta = uclust_fasta_sort_from_filepath(fasta_filepath,
                                                          output_filepath=fasta_output_filepath)
@@ -587,6 +673,9 @@ def get_clusters_from_fasta_filepath(
         remove_files(files_to_remove)
         raise ApplicationNotFoundError('uclust not found, is it properly ' +
                                        'installed?')
+    finally:
+        if sort_entry is not None:
+            sort_entry.release()
 
     # Get list of lists for each cluster
     clusters, failures, seeds = \
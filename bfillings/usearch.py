@@ -20,7 +20,15 @@ Modified from pycogent_backports/uclust.py, written by
 Greg Caporaso/William Walters
 """
 
-from os.path import splitext, abspath, join
+from hashlib import md5
+from heapq import merge
+from os import close
+from os.path import splitext, abspath, dirname, exists, getsize, join
+import re
+import sys
+from resource import getrusage, RUSAGE_CHILDREN
+from shutil import copyfileobj
+from subprocess import Popen, PIPE, STDOUT
 from tempfile import mkstemp
 
 from skbio.parse.sequences import parse_fasta
@@ -29,6 +37,14 @@ from burrito.util import (CommandLineApplication, ResultPath,
                             ApplicationError, ApplicationNotFoundError)
 from skbio.util import remove_files
 
+from bfillings.fasta_index import FastaIndex
+from bfillings.memory_model import (MemoryModel, physical_memory,
+                                    sequence_profile)
+from bfillings.stages import StageExecutor, StageManifest
+from bfillings.uc_parser import new_clusters, uc_records
+
+_max_memory_re = re.compile(r'Max memory\s+([\d.]+)\s*([kMG]?)b', re.I)
+
 
 class UsearchParseError(Exception):
     pass
@@ -250,7 +266,7 @@ class Usearch(CommandLineApplication):
 # Start functions for processing usearch output files
 
 
-def clusters_from_blast_uc_file(uc_lines, otu_id_field=1):
+def clusters_from_blast_uc_file(uc_lines, otu_id_field=1, compact=False):
     """ Parses out hit/miss sequences from usearch blast uc file
 
     All lines should be 'H'it or 'N'o hit.  Returns a dict of OTU ids: sequence
@@ -261,22 +277,19 @@ def clusters_from_blast_uc_file(uc_lines, otu_id_field=1):
     otu_id_field: uc field to use as the otu id. 1 is usearch's ClusterNr field,
      and 9 is usearch's TargetLabel field
 
+    compact: if True, the OTUs are returned as a bfillings.uc_parser.UcClusters
+     (a read-only dict-like object) rather than as a dict of lists
+
     """
 
     hit_miss_index = 0
     cluster_id_index = otu_id_field
     seq_label_index = 8
 
-    otus = {}
+    otus = new_clusters(compact)
     unassigned_seqs = []
 
-    for line in uc_lines:
-        # skip empty, comment lines
-        if line.startswith('#') or len(line.strip()) == 0:
-            continue
-
-        curr_line = line.split('\t')
-
+    for curr_line in uc_records(uc_lines, 'HN'):
         if curr_line[hit_miss_index] == 'N':
             # only retaining actual sequence label
             unassigned_seqs.append(curr_line[seq_label_index].split()[0])
@@ -286,16 +299,26 @@ def clusters_from_blast_uc_file(uc_lines, otu_id_field=1):
             curr_seq_label = curr_line[seq_label_index].split()[0]
             curr_otu_id = curr_line[cluster_id_index].split()[0]
             # Append sequence label to dictionary, or create key
-            try:
-                otus[curr_otu_id].append(curr_seq_label)
-            except KeyError:
-                otus[curr_otu_id] = [curr_seq_label]
+            otus.add_member(curr_otu_id, curr_seq_label)
 
     return otus, unassigned_seqs
 
 
 # End functions for processing usearch output files
 # Start usearch convenience functions
+def _usearch_version(command):
+    """ Returns the output of command --version, or None if it cannot run
+
+    Used to tie the records of resumable pipelines to the usearch build that
+    produced them.
+    """
+    try:
+        proc = Popen([command, '--version'], stdout=PIPE, stderr=STDOUT)
+    except OSError:
+        return None
+    return proc.communicate()[0].strip()
+
+
 def usearch_fasta_sort_from_filepath(
         fasta_filepath,
         output_filepath=None,
@@ -882,12 +905,15 @@ def usearch_cluster_seqs_ref(
     # Need to create fasta file of all hits (with reference IDs),
     # recluster failures if new clusters allowed, and create complete fasta
     # file, with unique fasta label IDs.
+    # fasta_filepath is an intermediate file, so its index is not persisted
+    seq_index = FastaIndex(fasta_filepath)
 
     if suppress_new_clusters:
         output_fna_filepath = join(output_dir, 'ref_clustered_seqs.fasta')
         output_filepath, labels_hits = get_fasta_from_uc_file(fasta_filepath,
                                                               uc_filepath, hit_type="H", output_dir=output_dir,
-                                                              output_fna_filepath=output_fna_filepath)
+                                                              output_fna_filepath=output_fna_filepath,
+                                                              seq_index=seq_index)
 
         files_to_remove.append(uc_filepath)
     else:
@@ -895,7 +921,8 @@ def usearch_cluster_seqs_ref(
         output_fna_clustered = join(output_dir, 'ref_clustered_seqs.fasta')
         output_filepath_ref_clusters,  labels_hits =\
             get_fasta_from_uc_file(fasta_filepath, uc_filepath, hit_type="H",
-                                   output_dir=output_dir, output_fna_filepath=output_fna_clustered)
+                                   output_dir=output_dir, output_fna_filepath=output_fna_clustered,
+                                   seq_index=seq_index)
 
         # get failures and recluster
         output_fna_failures =\
@@ -903,7 +930,8 @@ def usearch_cluster_seqs_ref(
         output_filepath_failures, labels_hits =\
             get_fasta_from_uc_file(fasta_filepath,
                                    uc_filepath, hit_type="N", output_dir=output_dir,
-                                   output_fna_filepath=output_fna_failures)
+                                   output_fna_filepath=output_fna_failures,
+                                   seq_index=seq_index)
 
         # de novo cluster the failures
         app_result, output_filepath_clustered_failures =\
@@ -925,6 +953,8 @@ def usearch_cluster_seqs_ref(
         files_to_remove.append(output_fna_failures)
         files_to_remove.append(output_filepath_clustered_failures)
 
+    seq_index.close()
+
     if not save_intermediate_files:
         remove_files(files_to_remove)
 
@@ -943,10 +973,16 @@ def concatenate_fastas(output_fna_clustered,
 
     output_fp = open(output_concat_filepath, "w")
 
-    for label, seq in parse_fasta(open(output_fna_clustered, "U")):
-        output_fp.write(">%s\n%s\n" % (label, seq))
-    for label, seq in parse_fasta(open(output_fna_failures, "U")):
-        output_fp.write(">%s\n%s\n" % (label, seq))
+    # Copy the records as they are rather than parsing them
+    for fasta_filepath in (output_fna_clustered, output_fna_failures):
+        fasta_f = open(fasta_filepath, "rb")
+        copyfileobj(fasta_f, output_fp)
+        if getsize(fasta_filepath) > 0:
+            fasta_f.seek(-1, 2)
+            if fasta_f.read(1) != "\n":
+                output_fp.write("\n")
+        fasta_f.close()
+    output_fp.close()
 
     return output_concat_filepath
 
@@ -993,7 +1029,8 @@ def get_fasta_from_uc_file(fasta_filepath,
                            hit_type="H",
                            output_fna_filepath=None,
                            label_prefix="",
-                           output_dir=None):
+                           output_dir=None,
+                           seq_index=None):
     """ writes fasta of sequences from uc file of type hit_type
 
     fasta_filepath:  Filepath of original query fasta file
@@ -1004,6 +1041,11 @@ def get_fasta_from_uc_file(fasta_filepath,
     label_prefix = Added before each fasta label, important when doing ref
      based OTU picking plus de novo clustering to preserve label matching.
     output_dir: output directory
+    seq_index: FastaIndex over fasta_filepath. If None, one is persisted
+     beside fasta_filepath.
+
+    Records are looked up in the index and copied without parsing, so only
+    the kept records are read.
     """
 
     hit_type_index = 0
@@ -1013,25 +1055,31 @@ def get_fasta_from_uc_file(fasta_filepath,
     labels_hits = {}
     labels_to_keep = []
 
-    for line in open(uc_filepath, "U"):
-        if line.startswith("#") or len(line.strip()) == 0:
-            continue
-        curr_line = line.split('\t')
-        if curr_line[0] == hit_type:
-            labels_hits[curr_line[seq_label_index]] =\
-                curr_line[target_label_index].strip()
-            labels_to_keep.append(curr_line[seq_label_index])
+    for curr_line in uc_records(open(uc_filepath, "U"), hit_type):
+        labels_hits[curr_line[seq_label_index]] =\
+            curr_line[target_label_index].strip()
+        labels_to_keep.append(curr_line[seq_label_index])
 
     labels_to_keep = set(labels_to_keep)
 
     out_fna = open(output_fna_filepath, "w")
 
-    for label, seq in parse_fasta(open(fasta_filepath, "U")):
+    if seq_index is None:
+        fasta_index = FastaIndex(fasta_filepath, persist=True)
+    else:
+        fasta_index = seq_index
+    seq_ids = set(label.split()[0] for label in labels_to_keep if label)
+    for seq_id, raw in fasta_index.iter_raw(seq_ids):
+        header_end = raw.index("\n")
+        label = raw[1:header_end].strip()
         if label in labels_to_keep:
             if hit_type == "H":
-                out_fna.write(">" + labels_hits[label] + "\n%s\n" % seq)
+                out_fna.write(">" + labels_hits[label] + raw[header_end:])
             if hit_type == "N":
-                out_fna.write(">" + label + "\n%s\n" % seq)
+                out_fna.write(raw)
+    if seq_index is None:
+        fasta_index.close()
+    out_fna.close()
 
     return output_fna_filepath, labels_hits
 
@@ -1050,54 +1098,203 @@ def get_retained_chimeras(output_fp_de_novo_nonchimeras,
     chimeras_retention: accepts either 'intersection' or 'union'.  Will test
      for chimeras against the full input error clustered sequence set, and
      retain sequences flagged as non-chimeras by either (union) or
-     only those flagged as non-chimeras by both (intersection)."""
-
-    de_novo_non_chimeras = []
-    reference_non_chimeras = []
-
-    de_novo_nonchimeras_f = open(output_fp_de_novo_nonchimeras, "U")
-    reference_nonchimeras_f = open(output_fp_ref_nonchimeras, "U")
-
-    output_combined_f = open(output_combined_fp, "w")
-
-    for label, seq in parse_fasta(de_novo_nonchimeras_f):
-        de_novo_non_chimeras.append(label)
-    de_novo_nonchimeras_f.close()
-    for label, seq in parse_fasta(reference_nonchimeras_f):
-        reference_non_chimeras.append(label)
-    reference_nonchimeras_f.close()
-
-    de_novo_non_chimeras = set(de_novo_non_chimeras)
-    reference_non_chimeras = set(reference_non_chimeras)
-
-    if chimeras_retention == 'union':
-        all_non_chimeras = de_novo_non_chimeras.union(reference_non_chimeras)
-    elif chimeras_retention == 'intersection':
-        all_non_chimeras =\
-            de_novo_non_chimeras.intersection(reference_non_chimeras)
-
-    de_novo_nonchimeras_f = open(output_fp_de_novo_nonchimeras, "U")
-    reference_nonchimeras_f = open(output_fp_ref_nonchimeras, "U")
-
-    # Save a list of already-written labels
-    labels_written = []
-
-    for label, seq in parse_fasta(de_novo_nonchimeras_f):
-        if label in all_non_chimeras:
-            if label not in labels_written:
-                output_combined_f.write('>%s\n%s\n' % (label, seq))
-                labels_written.append(label)
-    de_novo_nonchimeras_f.close()
-    for label, seq in parse_fasta(reference_nonchimeras_f):
-        if label in all_non_chimeras:
-            if label not in labels_written:
-                output_combined_f.write('>%s\n%s\n' % (label, seq))
-                labels_written.append(label)
-    reference_nonchimeras_f.close()
-
-    output_combined_f.close()
-
-    return output_combined_fp
+     only those flagged as non-chimeras by both (intersection). See
+     retain_non_chimeras for merging the output of more detectors."""
+
+    return retain_non_chimeras([output_fp_de_novo_nonchimeras,
+                                output_fp_ref_nonchimeras],
+                               output_combined_fp,
+                               retention=chimeras_retention)
+
+
+def retain_non_chimeras(non_chimeras_fps,
+                        output_fp,
+                        retention='union',
+                        max_labels=1000000,
+                        num_partitions=16):
+    """ Writes the sequences flagged as non-chimeras by enough detectors
+
+    non_chimeras_fps: filepaths of the non-chimera fastas written by each
+     chimera detector.
+    output_fp: filepath to write retained sequences to.
+    retention: 'union' to retain sequences flagged as non-chimeras by any
+     detector, 'intersection' to retain those flagged by all of them, or an
+     integer k to retain those flagged by at least k of them.
+    max_labels: maximum number of distinct labels counted in memory at a time
+    num_partitions: number of hash partitions the records of labels beyond
+     max_labels are spilled to; a partition with more than max_labels labels
+     is split again into as many partitions
+
+    Sequences are written once, in the order of their first occurrence in
+    non_chimeras_fps. Each input is read once. The first max_labels distinct
+    labels are counted in memory, and their first occurrences written to a
+    temporary file; the records of any other label are spilled to hash
+    partitions, which are counted one at a time. Temporary files are written
+    next to output_fp.
+    """
+    num_inputs = len(non_chimeras_fps)
+    if retention == 'union':
+        min_count = 1
+    elif retention == 'intersection':
+        min_count = num_inputs
+    elif isinstance(retention, int) and 1 <= retention <= num_inputs:
+        min_count = retention
+    else:
+        raise ValueError("retention must be 'union', 'intersection' or an "
+                         "integer between 1 and %d, not %r"
+                         % (num_inputs, retention))
+    if max_labels < 1 or num_partitions < 1:
+        raise ValueError("max_labels and num_partitions must be at least 1.")
+
+    tmp_dir = dirname(abspath(output_fp))
+
+    def tmp_file(prefix):
+        fd, fp = mkstemp(dir=tmp_dir, prefix=prefix, suffix='.txt')
+        close(fd)
+        return fp
+
+    # label -> count * num_inputs + index of the last input it was seen in,
+    # so that labels repeated within an input are only counted once
+    seen = {}
+    firsts_fp = tmp_file('retained_chimeras_')
+    partition_fps = []
+    result_fps = []
+    try:
+        firsts_f = open(firsts_fp, 'w')
+        partition_fs = None
+        read_number = 0
+        for input_index, non_chimeras_fp in enumerate(non_chimeras_fps):
+            non_chimeras_f = open(non_chimeras_fp, "U")
+            for label, seq in parse_fasta(non_chimeras_f):
+                value = seen.get(label)
+                if value is not None:
+                    if value % num_inputs != input_index:
+                        seen[label] = (value // num_inputs + 1) * \
+                            num_inputs + input_index
+                elif len(seen) < max_labels:
+                    firsts_f.write('%020d\t%s\t%s\n'
+                                   % (read_number, seq, label))
+                    seen[label] = num_inputs + input_index
+                else:
+                    if partition_fs is None:
+                        partition_fps.extend(
+                            tmp_file('retained_chimeras_part_')
+                            for i in range(num_partitions))
+                        partition_fs = [open(fp, 'w')
+                                        for fp in partition_fps]
+                    digest = md5(label).digest()
+                    partition_fs[ord(digest[0]) % num_partitions].write(
+                        '%020d\t%d\t%s\t%s\n'
+                        % (read_number, input_index, seq, label))
+                read_number += 1
+            non_chimeras_f.close()
+        firsts_f.close()
+        if partition_fs is not None:
+            for partition_f in partition_fs:
+                partition_f.close()
+
+        for partition_fp in partition_fps:
+            result_fps.append(_count_non_chimeras_partition(
+                partition_fp, num_inputs, min_count, max_labels,
+                num_partitions, tmp_file))
+            remove_files([partition_fp])
+
+        min_value = min_count * num_inputs
+
+        def retained_firsts():
+            with open(firsts_fp, "U") as firsts_f:
+                for line in firsts_f:
+                    label = line.rstrip('\n').split('\t', 2)[2]
+                    if seen[label] >= min_value:
+                        yield line
+
+        result_fs = [open(fp, "U") for fp in result_fps]
+        output_f = open(output_fp, "w")
+        for line in merge(retained_firsts(), *result_fs):
+            _, seq, label = line.rstrip('\n').split('\t', 2)
+            output_f.write('>%s\n%s\n' % (label, seq))
+        output_f.close()
+        for result_f in result_fs:
+            result_f.close()
+    finally:
+        remove_files([fp for fp in [firsts_fp] + partition_fps + result_fps
+                      if exists(fp)])
+
+    return output_fp
+
+
+def _count_non_chimeras_partition(partition_fp, num_inputs, min_count,
+                                  max_labels, num_partitions, tmp_file,
+                                  depth=1):
+    """ Counts the labels of one partition spilled by retain_non_chimeras
+
+    Returns the path of a file of "<read number>\\t<seq>\\t<label>" lines of
+    the first occurrences of the labels seen in at least min_count inputs,
+    sorted by read number. A partition with more than max_labels labels is
+    split on byte depth of the md5 digests of the labels, and its parts are
+    counted in turn.
+    """
+    if num_partitions > 1 and depth < 16:
+        labels = set()
+        with open(partition_fp, "U") as partition_f:
+            for line in partition_f:
+                labels.add(line.rstrip('\n').split('\t', 3)[3])
+                if len(labels) > max_labels:
+                    break
+        too_many_labels = len(labels) > max_labels
+        del labels
+        if too_many_labels:
+            part_fps = [tmp_file('retained_chimeras_part_')
+                        for i in range(num_partitions)]
+            result_fps = []
+            try:
+                part_fs = [open(fp, 'w') for fp in part_fps]
+                with open(partition_fp, "U") as partition_f:
+                    for line in partition_f:
+                        label = line.rstrip('\n').split('\t', 3)[3]
+                        digest = md5(label).digest()
+                        part_fs[ord(digest[depth]) % num_partitions].write(
+                            line)
+                for part_f in part_fs:
+                    part_f.close()
+                for part_fp in part_fps:
+                    result_fps.append(_count_non_chimeras_partition(
+                        part_fp, num_inputs, min_count, max_labels,
+                        num_partitions, tmp_file, depth + 1))
+                    remove_files([part_fp])
+                merged_fp = tmp_file('retained_chimeras_')
+                result_fs = [open(fp, "U") for fp in result_fps]
+                with open(merged_fp, 'w') as merged_f:
+                    merged_f.writelines(merge(*result_fs))
+                for result_f in result_fs:
+                    result_f.close()
+            finally:
+                remove_files([fp for fp in part_fps + result_fps
+                              if exists(fp)])
+            return merged_fp
+
+    # label -> [read number, seq, count, index of the last input]
+    partition = {}
+    order = []
+    with open(partition_fp, "U") as partition_f:
+        for line in partition_f:
+            read_number, input_index, seq, label = \
+                line.rstrip('\n').split('\t', 3)
+            record = partition.get(label)
+            if record is None:
+                record = [read_number, seq, 0, None, label]
+                partition[label] = record
+                order.append(record)
+            if record[3] != input_index:
+                record[2] += 1
+                record[3] = input_index
+
+    result_fp = tmp_file('retained_chimeras_')
+    with open(result_fp, 'w') as result_f:
+        for read_number, seq, count, _, label in order:
+            if count >= min_count:
+                result_f.write('%s\t%s\t%s\n' % (read_number, seq, label))
+    return result_fp
 
 
 def assign_reads_to_otus(original_fasta,
@@ -1182,7 +1379,10 @@ def usearch_qf(
     usersort=True,
     suppress_new_clusters=False,
     chimeras_retention="union",
-    verbose=False
+    verbose=False,
+    max_workers=1,
+    threads=None,
+    resume=False
 ):
     """ Main convenience wrapper for using usearch to filter/cluster seqs
 
@@ -1238,6 +1438,17 @@ def usearch_qf(
      for chimeras against the full input error clustered sequence set, and
      retain sequences flagged as non-chimeras by either (union) or
      only those flagged as non-chimeras by both (intersection).
+    verbose = print the name of each step as it starts.
+    max_workers = maximum number of steps run at once. Steps whose inputs
+     are ready, such as de novo and reference based chimera detection, are
+     run concurrently when this is greater than 1.
+    threads = maximum number of threads used at once by the usearch calls
+     (each uses one); defaults to max_workers.
+    resume = If True, record each step in usearch_qf_stages.json in
+     output_dir, and skip the steps whose inputs, parameters and usearch
+     version are unchanged since they were recorded. Use with
+     save_intermediate_files, so that the outputs of earlier steps are kept
+     for later runs.
     """
 
     # Save a list of intermediate filepaths in case they are to be removed.
@@ -1249,11 +1460,23 @@ def usearch_qf(
 
     fasta_filepath = abspath(fasta_filepath)
 
-    try:
+    # Create .uc file of clusters file, to identify original sequences
+    # later
+    output_uc_filepath = output_dir + 'err_corrected_clusters.uc'
+
+    # Each stage returns the filepath its dependents read; stages that only
+    # depend on earlier stages (e.g. the two chimera checks) can run at once.
+    if resume:
+        manifest = StageManifest(join(output_dir, 'usearch_qf_stages.json'),
+                                 tool_version=_usearch_version('usearch'))
+    else:
+        manifest = None
+    stages = StageExecutor(max_workers=max_workers, max_threads=threads,
+                           manifest=manifest)
 
+    def sort_by_length():
         if verbose:
             print "Sorting sequences by length..."
-        # Sort seqs by length
         app_result, output_filepath_len_sorted =\
             usearch_fasta_sort_from_filepath(fasta_filepath, output_filepath=
                                              join(
@@ -1262,12 +1485,11 @@ def usearch_qf(
                                              save_intermediate_files=save_intermediate_files,
                                              remove_usearch_logs=remove_usearch_logs,
                                              working_dir=output_dir, HALT_EXEC=HALT_EXEC)
+        return output_filepath_len_sorted
 
-        intermediate_files.append(output_filepath_len_sorted)
-
+    def dereplicate(output_filepath_len_sorted):
         if verbose:
             print "Dereplicating sequences..."
-        # Dereplicate sequences
         app_result, output_filepath_dereplicated =\
             usearch_dereplicate_exact_subseqs(output_filepath_len_sorted,
                                               output_filepath=join(
@@ -1277,9 +1499,9 @@ def usearch_qf(
                                               maxrejects=maxrejects, save_intermediate_files=save_intermediate_files,
                                               remove_usearch_logs=remove_usearch_logs,
                                               working_dir=output_dir, HALT_EXEC=HALT_EXEC)
+        return output_filepath_dereplicated
 
-        intermediate_files.append(output_filepath_dereplicated)
-
+    def sort_by_abundance(output_filepath_dereplicated):
         if verbose:
             print "Sorting by abundance..."
         # Sort by abundance, initially no filter based on seqs/otu
@@ -1291,16 +1513,12 @@ def usearch_qf(
                                       usersort=True, sizein=sizein, sizeout=sizeout, minsize=0,
                                       remove_usearch_logs=remove_usearch_logs, working_dir=output_dir,
                                       HALT_EXEC=HALT_EXEC)
+        return output_fp
 
-        intermediate_files.append(output_fp)
-
+    def cluster_error_correction(output_fp):
         if verbose:
             print "Clustering sequences for error correction..."
 
-        # Create .uc file of clusters file, to identify original sequences
-        # later
-        output_uc_filepath = output_dir + 'err_corrected_clusters.uc'
-
         app_result, error_clustered_output_fp =\
             usearch_cluster_error_correction(output_fp,
                                              output_filepath=join(output_dir,
@@ -1311,88 +1529,69 @@ def usearch_qf(
                                              remove_usearch_logs=remove_usearch_logs,
                                              save_intermediate_files=save_intermediate_files,
                                              working_dir=output_dir, HALT_EXEC=HALT_EXEC)
+        return error_clustered_output_fp
 
-        intermediate_files.append(error_clustered_output_fp)
-        intermediate_files.append(output_uc_filepath)
-
-        # Series of conditional tests, using generic 'output_fp' name so the
-        # conditional filtering, if any/all are selected, do not matter.
-        if de_novo_chimera_detection:
+    def chimera_filter_de_novo(error_clustered_output_fp):
+        if verbose:
+            print "Performing de novo chimera detection..."
+        app_result, output_fp_de_novo_nonchimeras =\
+            usearch_chimera_filter_de_novo(error_clustered_output_fp,
+                                           abundance_skew=abundance_skew, output_chimera_filepath=
+                                           join(
+                                               output_dir,
+                                               'de_novo_chimeras.fasta'),
+                                           output_non_chimera_filepath=join(
+                                               output_dir,
+                                               'de_novo_non_chimeras.fasta'), usersort=True,
+                                           save_intermediate_files=save_intermediate_files,
+                                           remove_usearch_logs=remove_usearch_logs, working_dir=output_dir,
+                                           HALT_EXEC=HALT_EXEC)
+        return output_fp_de_novo_nonchimeras
+
+    def chimera_filter_ref_based(error_clustered_output_fp):
+        if verbose:
+            print "Performing reference based chimera detection..."
+        app_result, output_fp_ref_nonchimeras =\
+            usearch_chimera_filter_ref_based(error_clustered_output_fp,
+                                             db_filepath=db_filepath, output_chimera_filepath=
+                                             join(
+                                                 output_dir,
+                                                 'reference_chimeras.fasta'),
+                                             output_non_chimera_filepath=
+                                             join(output_dir, 'reference_non_chimeras.fasta'), usersort=True,
+                                             save_intermediate_files=save_intermediate_files, rev=rev,
+                                             remove_usearch_logs=remove_usearch_logs, working_dir=output_dir,
+                                             HALT_EXEC=HALT_EXEC)
+        return output_fp_ref_nonchimeras
+
+    def retain_chimeras(output_fp_de_novo_nonchimeras,
+                        output_fp_ref_nonchimeras):
+        if verbose:
+            print "Finding %s of non-chimeras..." % chimeras_retention
+        output_fp = get_retained_chimeras(
+            output_fp_de_novo_nonchimeras, output_fp_ref_nonchimeras,
+            output_combined_fp=
+            join(output_dir, 'combined_non_chimeras.fasta'),
+            chimeras_retention=chimeras_retention)
+        return output_fp
+
+    def filter_cluster_size(output_fp):
+        if verbose:
+            print "Filtering by cluster size..."
+        app_result, output_fp =\
+            usearch_sort_by_abundance(output_fp, output_filepath=
+                                      join(output_dir, 'abundance_sorted_minsize_' + str(minsize) +
+                                           '.fasta'),
+                                      minsize=minsize, sizein=sizein, sizeout=sizeout,
+                                      remove_usearch_logs=remove_usearch_logs, working_dir=output_dir,
+                                      HALT_EXEC=HALT_EXEC)
+        return output_fp
 
-            if verbose:
-                print "Performing de novo chimera detection..."
-            app_result, output_fp_de_novo_nonchimeras =\
-                usearch_chimera_filter_de_novo(error_clustered_output_fp,
-                                               abundance_skew=abundance_skew, output_chimera_filepath=
-                                               join(
-                                                   output_dir,
-                                                   'de_novo_chimeras.fasta'),
-                                               output_non_chimera_filepath=join(
-                                                   output_dir,
-                                                   'de_novo_non_chimeras.fasta'), usersort=True,
-                                               save_intermediate_files=save_intermediate_files,
-                                               remove_usearch_logs=remove_usearch_logs, working_dir=output_dir,
-                                               HALT_EXEC=HALT_EXEC)
-
-            intermediate_files.append(output_fp_de_novo_nonchimeras)
-
-            output_fp = output_fp_de_novo_nonchimeras
-
-        if reference_chimera_detection:
-            if verbose:
-                print "Performing reference based chimera detection..."
-
-            app_result, output_fp_ref_nonchimeras =\
-                usearch_chimera_filter_ref_based(error_clustered_output_fp,
-                                                 db_filepath=db_filepath, output_chimera_filepath=
-                                                 join(
-                                                     output_dir,
-                                                     'reference_chimeras.fasta'),
-                                                 output_non_chimera_filepath=
-                                                 join(output_dir, 'reference_non_chimeras.fasta'), usersort=True,
-                                                 save_intermediate_files=save_intermediate_files, rev=rev,
-                                                 remove_usearch_logs=remove_usearch_logs, working_dir=output_dir,
-                                                 HALT_EXEC=HALT_EXEC)
-
-            intermediate_files.append(output_fp_ref_nonchimeras)
-
-            output_fp = output_fp_ref_nonchimeras
-
-        # get intersection or union if both ref and de novo chimera detection
-        if de_novo_chimera_detection and reference_chimera_detection:
-            if verbose:
-                print "Finding %s of non-chimeras..." % chimeras_retention
-            output_fp = get_retained_chimeras(
-                output_fp_de_novo_nonchimeras, output_fp_ref_nonchimeras,
-                output_combined_fp=
-                join(output_dir, 'combined_non_chimeras.fasta'),
-                chimeras_retention=chimeras_retention)
-
-            intermediate_files.append(output_fp)
-
-        if cluster_size_filtering:
-            # Test for empty filepath following filters, raise error if all seqs
-            # have been removed
-            if verbose:
-                print "Filtering by cluster size..."
-            # chimera detection was not performed, use output file of step 4 as input
-            # to filtering by cluster size
-            if not (reference_chimera_detection and de_novo_chimera_detection):
-                output_fp = error_clustered_output_fp
-            app_result, output_fp =\
-                usearch_sort_by_abundance(output_fp, output_filepath=
-                                          join(output_dir, 'abundance_sorted_minsize_' + str(minsize) +
-                                               '.fasta'),
-                                          minsize=minsize, sizein=sizein, sizeout=sizeout,
-                                          remove_usearch_logs=remove_usearch_logs, working_dir=output_dir,
-                                          HALT_EXEC=HALT_EXEC)
-
-            intermediate_files.append(output_fp)
-
-        # cluster seqs
-        # Should we add in option to use alternative OTU picking here?
-        # Seems like it will be a bit of a mess...maybe after we determine
-        # if usearch_qf should become standard.
+    # cluster seqs
+    # Should we add in option to use alternative OTU picking here?
+    # Seems like it will be a bit of a mess...maybe after we determine
+    # if usearch_qf should become standard.
+    def cluster(output_fp):
         if refseqs_fp:
             if verbose:
                 print "Clustering against reference sequences..."
@@ -1422,21 +1621,20 @@ def usearch_qf(
                                      remove_usearch_logs=remove_usearch_logs, working_dir=output_dir,
                                      HALT_EXEC=HALT_EXEC)
 
-        intermediate_files.append(output_filepath)
-
-        # Enumerate the OTUs in the clusters
-        if not suppress_new_clusters:
-            if verbose:
-                print "Enumerating OTUs..."
-            output_filepath =\
-                enumerate_otus(output_filepath, output_filepath=
-                               join(output_dir, 'enumerated_otus.fasta'),
-                               label_prefix=label_prefix,
-                               label_suffix=label_suffix, count_start=count_start,
-                               retain_label_as_comment=retain_label_as_comment)
-
-            intermediate_files.append(output_filepath)
+        return output_filepath
 
+    def enumerate_clusters(output_filepath):
+        if verbose:
+            print "Enumerating OTUs..."
+        output_filepath =\
+            enumerate_otus(output_filepath, output_filepath=
+                           join(output_dir, 'enumerated_otus.fasta'),
+                           label_prefix=label_prefix,
+                           label_suffix=label_suffix, count_start=count_start,
+                           retain_label_as_comment=retain_label_as_comment)
+        return output_filepath
+
+    def assign_reads(output_filepath):
         # Get original sequence label identities
         if verbose:
             print "Assigning sequences to clusters..."
@@ -1447,8 +1645,84 @@ def usearch_qf(
                                                          global_alignment=global_alignment,
                                                          remove_usearch_logs=remove_usearch_logs, working_dir=output_dir,
                                                          HALT_EXEC=HALT_EXEC)
+        return clusters_file
+
+    # params list the arguments each stage depends on, so that resumed runs
+    # only redo the stages affected by a change
+    stages.add_stage('len_sorted', sort_by_length, params={},
+                     inputs=[fasta_filepath])
+    stages.add_stage('dereplicated', dereplicate, ['len_sorted'],
+                     params={'minlen': minlen, 'w': w, 'slots': slots,
+                             'sizeout': sizeout, 'maxrejects': maxrejects})
+    stages.add_stage('abundance_sorted', sort_by_abundance, ['dereplicated'],
+                     params={'sizein': sizein, 'sizeout': sizeout})
+    stages.add_stage('error_corrected', cluster_error_correction,
+                     ['abundance_sorted'],
+                     params={'percent_id_err': percent_id_err,
+                             'sizein': sizein, 'sizeout': sizeout, 'w': w,
+                             'slots': slots, 'maxrejects': maxrejects},
+                     outputs=[output_uc_filepath])
+
+    # Series of conditional stages, tracking the name of the stage whose
+    # output is the filtered sequence set so that the conditional filtering,
+    # if any/all are selected, do not matter.
+    filtered_stage = 'abundance_sorted'
+    if de_novo_chimera_detection:
+        stages.add_stage('de_novo_non_chimeras', chimera_filter_de_novo,
+                         ['error_corrected'],
+                         params={'abundance_skew': abundance_skew})
+        filtered_stage = 'de_novo_non_chimeras'
+    if reference_chimera_detection:
+        stages.add_stage('reference_non_chimeras', chimera_filter_ref_based,
+                         ['error_corrected'], params={'rev': rev},
+                         inputs=[db_filepath])
+        filtered_stage = 'reference_non_chimeras'
+    # get intersection or union if both ref and de novo chimera detection
+    if de_novo_chimera_detection and reference_chimera_detection:
+        stages.add_stage('combined_non_chimeras', retain_chimeras,
+                         ['de_novo_non_chimeras', 'reference_non_chimeras'],
+                         params={'chimeras_retention': chimeras_retention})
+        filtered_stage = 'combined_non_chimeras'
+
+    if cluster_size_filtering:
+        # chimera detection was not performed, use output file of step 4 as
+        # input to filtering by cluster size
+        if not (reference_chimera_detection and de_novo_chimera_detection):
+            filtered_stage = 'error_corrected'
+        stages.add_stage('cluster_size_filtered', filter_cluster_size,
+                         [filtered_stage],
+                         params={'minsize': minsize, 'sizein': sizein,
+                                 'sizeout': sizeout})
+        filtered_stage = 'cluster_size_filtered'
+
+    stages.add_stage('clustered', cluster, [filtered_stage],
+                     params={'percent_id': percent_id, 'sizein': sizein,
+                             'sizeout': sizeout, 'w': w, 'slots': slots,
+                             'maxrejects': maxrejects, 'rev': rev,
+                             'suppress_new_clusters': suppress_new_clusters},
+                     inputs=[refseqs_fp])
+    otus_stage = 'clustered'
+
+    # Enumerate the OTUs in the clusters
+    if not suppress_new_clusters:
+        stages.add_stage('enumerated_otus', enumerate_clusters, ['clustered'],
+                         params={'label_prefix': label_prefix,
+                                 'label_suffix': label_suffix,
+                                 'count_start': count_start,
+                                 'retain_label_as_comment':
+                                 retain_label_as_comment})
+        otus_stage = 'enumerated_otus'
+
+    stages.add_stage('assigned_reads', assign_reads, [otus_stage],
+                     params={'percent_id': percent_id,
+                             'global_alignment': global_alignment},
+                     inputs=[fasta_filepath])
 
-        intermediate_files.append(clusters_file)
+    try:
+        results = stages.run()
+        clusters_file = results['assigned_reads']
+        intermediate_files.extend(results.values())
+        intermediate_files.append(output_uc_filepath)
 
     except ApplicationError:
         raise ApplicationError('Error running usearch. Possible causes are '
@@ -1725,7 +1999,8 @@ def usearch61_ref_cluster(seq_path,
                           sizeorder=False,
                           suppress_new_clusters=False,
                           threads=1.0,
-                          HALT_EXEC=False
+                          HALT_EXEC=False,
+                          resume=False
                           ):
     """ Returns dictionary of cluster IDs:seq IDs
 
@@ -1756,6 +2031,11 @@ def usearch61_ref_cluster(seq_path,
      reference clusters.
     threads: Specify number of threads used per core per CPU
     HALT_EXEC: application controller option to halt execution.
+    resume: If True, record the abundance sorting and reference clustering
+     steps in usearch61_ref_cluster_stages.json in output_dir, and skip them
+     when their inputs, parameters and usearch61 version are unchanged since
+     they were recorded (e.g. when only the de novo clustering parameters
+     change). Only useful with save_intermediate_files, the default.
 
     Description of analysis workflows
     ---------------------------------
@@ -1782,8 +2062,15 @@ def usearch61_ref_cluster(seq_path,
 
     seq_path = abspath(seq_path)
 
-    try:
+    if resume:
+        manifest = StageManifest(join(output_dir,
+                                      'usearch61_ref_cluster_stages.json'),
+                                 tool_version=_usearch_version('usearch61'))
+    else:
+        manifest = None
+    stages = StageExecutor(manifest=manifest)
 
+    def sort_by_abundance():
         if verbose:
             print "Presorting sequences according to abundance..."
         intermediate_fasta, dereplicated_uc, app_result =\
@@ -1796,13 +2083,12 @@ def usearch61_ref_cluster(seq_path,
                                             output_dir,
                                             'abundance_sorted.uc'),
                                         threads=threads)
-        if not save_intermediate_files:
-            files_to_remove.append(intermediate_fasta)
-            files_to_remove.append(dereplicated_uc)
+        return intermediate_fasta, dereplicated_uc
 
+    def cluster_ref(sorted_fps):
         if verbose:
             print "Performing reference based clustering..."
-        clusters_fp, app_result = usearch61_cluster_ref(intermediate_fasta,
+        clusters_fp, app_result = usearch61_cluster_ref(sorted_fps[0],
                                                         refseqs_fp, percent_id, rev, minlen, output_dir,
                                                         remove_usearch_logs, wordlength, usearch61_maxrejects,
                                                         usearch61_maxaccepts, HALT_EXEC,
@@ -1810,7 +2096,25 @@ def usearch61_ref_cluster(seq_path,
                                                             output_dir,
                                                             'ref_clustered.uc'),
                                                         threads=threads)
+        return clusters_fp
+
+    stages.add_stage('abundance_sorted', sort_by_abundance,
+                     params={'rev': rev, 'minlen': minlen}, inputs=[seq_path])
+    stages.add_stage('ref_clustered', cluster_ref, ['abundance_sorted'],
+                     params={'percent_id': percent_id, 'rev': rev,
+                             'minlen': minlen, 'wordlength': wordlength,
+                             'usearch61_maxrejects': usearch61_maxrejects,
+                             'usearch61_maxaccepts': usearch61_maxaccepts},
+                     inputs=[refseqs_fp])
+
+    try:
+
+        results = stages.run()
+        intermediate_fasta, dereplicated_uc = results['abundance_sorted']
+        clusters_fp = results['ref_clustered']
         if not save_intermediate_files:
+            files_to_remove.append(intermediate_fasta)
+            files_to_remove.append(dereplicated_uc)
             files_to_remove.append(clusters_fp)
 
         clusters, failures =\
@@ -1874,7 +2178,9 @@ def usearch61_denovo_cluster(seq_path,
                              sizeorder=False,
                              threads=1.0,
                              HALT_EXEC=False,
-                             file_prefix="denovo_"
+                             file_prefix="denovo_",
+                             memory_budget=None,
+                             memory_stats_fp=None
                              ):
     """ Returns dictionary of cluster IDs:seq IDs
 
@@ -1891,7 +2197,9 @@ def usearch61_denovo_cluster(seq_path,
     wordlength: word length to use for clustering
     usearch_fast_cluster: Use usearch61 fast cluster option, not as memory
      efficient as the default cluster_smallmem option, requires sorting by
-     length, and does not allow reverse strand matching.
+     length, and does not allow reverse strand matching. If 'auto', the
+     option and the number of threads are chosen to fit memory_budget (see
+     choose_usearch61_strategy).
     usearch61_sort_method:  Sort sequences by abundance or length by using
      functionality provided by usearch61, or do not sort by using None option.
     otu_prefix: label to place in front of OTU IDs, used to prevent duplicate
@@ -1899,8 +2207,15 @@ def usearch61_denovo_cluster(seq_path,
     usearch61_maxrejects: Number of rejects allowed by usearch61
     usearch61_maxaccepts: Number of accepts allowed by usearch61
     sizeorder: used for clustering based upon abundance of seeds
-    threads: Specify number of threads used per core per CPU
+    threads: Specify number of threads used per core per CPU; with
+     usearch_fast_cluster='auto', the maximum number of threads
     HALT_EXEC: application controller option to halt execution.
+    memory_budget: with usearch_fast_cluster='auto', memory in bytes the
+     clustering may use; defaults to 80% of the physical memory
+    memory_stats_fp: with usearch_fast_cluster='auto', JSON file in which
+     the measured peak memory of runs is kept to correct the estimates of
+     later runs given the same file; None (the default) keeps no
+     measurements
     """
 
     files_to_remove = []
@@ -1910,6 +2225,24 @@ def usearch61_denovo_cluster(seq_path,
         output_dir = abspath(output_dir) + '/'
     seq_path = abspath(seq_path)
 
+    strategy = None
+    if usearch_fast_cluster == 'auto':
+        memory_model = MemoryModel(memory_stats_fp)
+        strategy, cluster_threads, base_estimate = choose_usearch61_strategy(
+            sequence_profile(seq_path, minlen), memory_budget, threads, rev,
+            wordlength, memory_model)
+        usearch_fast_cluster = strategy == 'fast'
+        if usearch_fast_cluster:
+            threads = cluster_threads
+        _log_usearch61_auto(
+            "Chose cluster_%s with %d thread(s): estimated peak memory "
+            "%d bytes (uncorrected %d bytes)"
+            % (strategy, cluster_threads,
+               memory_model.estimate(strategy, base_estimate),
+               base_estimate),
+            output_dir, file_prefix, remove_usearch_logs, verbose)
+        children_peak_rss = _children_peak_rss()
+
     try:
         if verbose and usearch61_sort_method is not None and\
                 not usearch_fast_cluster:
@@ -1943,6 +2276,7 @@ def usearch61_denovo_cluster(seq_path,
             print "Clustering sequences de novo..."
 
         if usearch_fast_cluster:
+            log_name = "fast_clustered.log"
             clusters_fp, app_result = usearch61_fast_cluster(
                 intermediate_fasta,
                 percent_id, minlen, output_dir, remove_usearch_logs, wordlength,
@@ -1953,6 +2287,7 @@ def usearch61_denovo_cluster(seq_path,
             if not save_intermediate_files:
                 files_to_remove.append(clusters_fp)
         else:
+            log_name = "smallmem_clustered.log"
             clusters_fp, app_result =\
                 usearch61_smallmem_cluster(intermediate_fasta, percent_id,
                                            minlen, rev, output_dir, remove_usearch_logs, wordlength,
@@ -1973,6 +2308,20 @@ def usearch61_denovo_cluster(seq_path,
         raise ApplicationNotFoundError('usearch61 not found, is it properly ' +
                                        'installed?')
 
+    if strategy is not None and not HALT_EXEC:
+        peak_rss = None
+        if not remove_usearch_logs:
+            peak_rss = usearch61_peak_memory(join(output_dir, log_name))
+        if peak_rss is None and _children_peak_rss() > children_peak_rss:
+            # the clustering run is the largest child so far
+            peak_rss = _children_peak_rss()
+        if peak_rss is not None:
+            memory_model.record(strategy, base_estimate, peak_rss)
+            _log_usearch61_auto(
+                "Measured peak memory of cluster_%s: %d bytes"
+                % (strategy, peak_rss),
+                output_dir, file_prefix, remove_usearch_logs, verbose)
+
     if usearch61_sort_method == 'abundance' and not usearch_fast_cluster:
         de_novo_clusters, failures =\
             parse_usearch61_clusters(open(clusters_fp, "U"), otu_prefix)
@@ -1991,6 +2340,101 @@ def usearch61_denovo_cluster(seq_path,
     return clusters
 
 
+def usearch61_memory_estimate(profile, strategy, threads=1, wordlength=8):
+    """ Returns a rough estimate, in bytes, of the peak memory of usearch61
+        de novo clustering
+
+    profile: dict returned by sequence_profile for the input sequences
+    strategy: 'fast' (cluster_fast) or 'smallmem' (cluster_smallmem)
+    threads: number of threads of cluster_fast
+    wordlength: word length used for clustering
+
+    cluster_fast holds all the unique sequences in memory, and each of its
+    threads has a word index; cluster_smallmem streams the input and only
+    indexes the centroids, taken here to be a quarter of the unique
+    sequences. These are starting points, corrected by MemoryModel from
+    measured runs.
+    """
+    word_index = 4 * 4 ** wordlength
+    seqs = 2 * profile['unique_residues'] + 256 * profile['num_uniques']
+    if strategy == 'fast':
+        per_thread = word_index + 64 * profile['max_len'] + 2 ** 24
+        return 2 ** 25 + seqs + threads * per_thread
+    return 2 ** 25 + seqs // 4 + word_index
+
+
+def choose_usearch61_strategy(profile,
+                              memory_budget=None,
+                              max_threads=1,
+                              rev=False,
+                              wordlength=8,
+                              memory_model=None):
+    """ Returns (strategy, threads, uncorrected estimate) for usearch61 de
+        novo clustering of the sequences described by profile
+
+    memory_budget: memory in bytes the run may use; defaults to 80% of the
+     physical memory
+    max_threads: maximum number of threads
+    rev: True if reverse strand matching is needed, which only
+     cluster_smallmem supports
+    memory_model: MemoryModel correcting the estimates
+
+    cluster_fast is chosen with the most threads that fit the budget;
+    cluster_smallmem, which is single threaded, is chosen when cluster_fast
+    does not fit with one thread, or when rev is True.
+    """
+    if memory_model is None:
+        memory_model = MemoryModel()
+    if memory_budget is None:
+        memory = physical_memory()
+        memory_budget = int(0.8 * memory) if memory else float('inf')
+
+    if not rev:
+        for threads in range(max(int(max_threads), 1), 0, -1):
+            base_estimate = usearch61_memory_estimate(profile, 'fast',
+                                                      threads, wordlength)
+            if memory_model.estimate('fast', base_estimate) <= memory_budget:
+                return 'fast', threads, base_estimate
+    return 'smallmem', 1, usearch61_memory_estimate(profile, 'smallmem', 1,
+                                                    wordlength)
+
+
+def usearch61_peak_memory(log_fp):
+    """ Returns the peak memory in bytes reported in a usearch61 log file,
+        or None if the log does not report it
+    """
+    if not exists(log_fp):
+        return None
+    with open(log_fp, 'U') as log_f:
+        match = _max_memory_re.search(log_f.read())
+    if match is None:
+        return None
+    unit = {'': 1, 'k': 2 ** 10, 'm': 2 ** 20, 'g': 2 ** 30}
+    return int(float(match.group(1)) * unit[match.group(2).lower()])
+
+
+def _children_peak_rss():
+    """ Returns the peak resident memory in bytes of the largest child
+
+    ru_maxrss is in bytes on OS X, and in kilobytes on Linux and the BSDs.
+    """
+    peak_rss = getrusage(RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak_rss
+    return peak_rss * 1024
+
+
+def _log_usearch61_auto(message, output_dir, file_prefix,
+                        remove_usearch_logs, verbose):
+    """ Records a decision or measurement of the 'auto' strategy """
+    if verbose:
+        print message
+    if not remove_usearch_logs:
+        with open(join(output_dir, file_prefix + 'auto_strategy.log'),
+                  'a') as log_f:
+            log_f.write(message + '\n')
+
+
 #   Start fasta sorting functions
 def sort_by_abundance_usearch61(seq_path,
                                 output_dir='.',
@@ -2417,44 +2861,48 @@ def usearch61_chimera_check_ref(abundance_fp,
 #   Start parsing functions
 
 
-def parse_dereplicated_uc(dereplicated_uc_lines):
+def parse_dereplicated_uc(dereplicated_uc_lines, compact=False):
     """ Return dict of seq ID:dereplicated seq IDs from dereplicated .uc lines
 
     dereplicated_uc_lines: list of lines of .uc file from dereplicated seqs from
      usearch61 (i.e. open file of abundance sorted .uc data)
+    compact: if True, returns a bfillings.uc_parser.UcClusters (a read-only
+     dict-like object) rather than a dict of lists
     """
 
-    dereplicated_clusters = {}
+    dereplicated_clusters = new_clusters(compact)
 
     seed_hit_ix = 0
     seq_id_ix = 8
     seed_id_ix = 9
 
-    for line in dereplicated_uc_lines:
-        if line.startswith("#") or len(line.strip()) == 0:
-            continue
-        curr_line = line.strip().split('\t')
+    for curr_line in uc_records(dereplicated_uc_lines, 'SH'):
         if curr_line[seed_hit_ix] == "S":
-            dereplicated_clusters[curr_line[seq_id_ix]] = []
+            dereplicated_clusters.add_cluster(curr_line[seq_id_ix])
         if curr_line[seed_hit_ix] == "H":
             curr_seq_id = curr_line[seq_id_ix]
-            dereplicated_clusters[curr_line[seed_id_ix]].append(curr_seq_id)
+            dereplicated_clusters.add_member(curr_line[seed_id_ix],
+                                             curr_seq_id, create=False)
 
     return dereplicated_clusters
 
 
 def parse_usearch61_clusters(clustered_uc_lines,
                              otu_prefix='denovo',
-                             ref_clustered=False):
+                             ref_clustered=False,
+                             compact=False):
     """ Returns dict of cluster ID:seq IDs
 
     clustered_uc_lines: lines from .uc file resulting from de novo clustering
     otu_prefix: string added to beginning of OTU ID.
     ref_clustered: If True, will attempt to create dict keys for clusters as
      they are read from the .uc file, rather than from seed lines.
+    compact: if True, the clusters are returned as a
+     bfillings.uc_parser.UcClusters (a read-only dict-like object) rather
+     than as a dict of lists
     """
 
-    clusters = {}
+    clusters = new_clusters(compact)
     failures = []
 
     seed_hit_ix = 0
@@ -2462,25 +2910,20 @@ def parse_usearch61_clusters(clustered_uc_lines,
     seq_id_ix = 8
     ref_id_ix = 9
 
-    for line in clustered_uc_lines:
-        if line.startswith("#") or len(line.strip()) == 0:
-            continue
-        curr_line = line.strip().split('\t')
+    for curr_line in uc_records(clustered_uc_lines, 'SHN'):
         if curr_line[seed_hit_ix] == "S":
             # Need to split on semicolons for sequence IDs to handle case of
             # abundance sorted data
-            clusters[otu_prefix + curr_line[otu_id_ix]] =\
-                [curr_line[seq_id_ix].split(';')[0].split()[0]]
+            clusters.add_member(otu_prefix + curr_line[otu_id_ix],
+                                curr_line[seq_id_ix].split(';')[0].split()[0])
         if curr_line[seed_hit_ix] == "H":
             curr_id = curr_line[seq_id_ix].split(';')[0].split()[0]
             if ref_clustered:
-                try:
-                    clusters[otu_prefix + curr_line[ref_id_ix]].append(curr_id)
-                except KeyError:
-                    clusters[otu_prefix + curr_line[ref_id_ix]] = [curr_id]
+                clusters.add_member(otu_prefix + curr_line[ref_id_ix],
+                                    curr_id)
             else:
-                clusters[otu_prefix +
-                         curr_line[otu_id_ix]].append(curr_id)
+                clusters.add_member(otu_prefix + curr_line[otu_id_ix],
+                                    curr_id, create=False)
         if curr_line[seed_hit_ix] == "N":
             failures.append(curr_line[seq_id_ix].split(';')[0])
 
@@ -2527,20 +2970,30 @@ def merge_failures_dereplicated_seqs(failures,
 
 def parse_usearch61_failures(seq_path,
                              failures,
-                             output_fasta_fp):
+                             output_fasta_fp,
+                             seq_index=None):
     """ Parses seq IDs from failures list, writes to output_fasta_fp
 
     seq_path: filepath of original input fasta file.
     failures: list/set of failure seq IDs
     output_fasta_fp: path to write parsed sequences
+    seq_index: FastaIndex over seq_path. If None, one is persisted beside
+     seq_path, so that later calls on the same file skip indexing it.
+
+    The failures are looked up in the index and copied in file order without
+    parsing, so only the failed records are read. If a seq ID occurs more
+    than once in seq_path, only its first record is written.
     """
 
     parsed_out = open(output_fasta_fp, "w")
 
-    for label, seq in parse_fasta(open(seq_path), "U"):
-        curr_label = label.split()[0]
-        if curr_label in failures:
-            parsed_out.write(">%s\n%s\n" % (label, seq))
+    if seq_index is None:
+        fasta_index = FastaIndex(seq_path, persist=True)
+    else:
+        fasta_index = seq_index
+    fasta_index.write_records(failures, parsed_out)
+    if seq_index is None:
+        fasta_index.close()
     parsed_out.close()
     return output_fasta_fp
 